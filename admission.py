@@ -0,0 +1,163 @@
+# admission.py
+"""
+Webhook 入口的准入控制（背压与削峰）。
+
+同时处理的 Webhook 不超过 max_inflight 个，其余按到达顺序排队，队列长度不超过 max_queue：
+    - 队列已满：立即返回 429；
+    - 排队超过 queue_timeout 秒仍未轮到：返回 503；
+    - 应用正在退出：返回 503。
+拒绝时附带 Retry-After（根据最近的平均处理时间和排队长度估算），AllValue 会稍后重发，
+不会长时间占用服务器线程。被接受的请求最多排队 queue_timeout 秒，突发流量下延迟可预期。
+
+参数通过环境变量 WEBHOOK_MAX_INFLIGHT / WEBHOOK_MAX_QUEUE / WEBHOOK_QUEUE_TIMEOUT 设置。
+
+多店铺时每个店铺有自己的准入控制，名额为全局名额的均分（fair_share），它们共用一个全局准入控制
+（parent）：先在店铺自己的名额内被接受，再获得全局名额。一个店铺的突发流量只会占满它自己的名额，
+其他店铺仍有名额可用；所有店铺合计占用的 Waitress 线程不超过全局的 max_inflight + max_queue。
+全局上限由 webhook_budget() 根据 Waitress 线程数 (SERVE_THREADS) 计算，
+至少留出 WEBHOOK_RESERVED_THREADS 个线程给管理页面和 /healthz。
+"""
+
+import collections
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_INFLIGHT = int(os.environ.get("WEBHOOK_MAX_INFLIGHT", 4))
+DEFAULT_MAX_QUEUE = int(os.environ.get("WEBHOOK_MAX_QUEUE", 2))
+DEFAULT_QUEUE_TIMEOUT = float(os.environ.get("WEBHOOK_QUEUE_TIMEOUT", 5))
+RESERVED_THREADS = int(os.environ.get("WEBHOOK_RESERVED_THREADS", 2))
+MAX_RETRY_AFTER = 60
+EWMA_ALPHA = 0.2
+
+
+class Overloaded(Exception):
+    """请求未被接受。status 为 HTTP 状态码，retry_after 为建议的重试秒数。"""
+
+    def __init__(self, status, reason, retry_after):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def webhook_budget(threads=None, reserved=RESERVED_THREADS):
+    """全局准入控制的 (max_inflight, max_queue)：两者之和不超过 Waitress 线程数减去预留线程数。"""
+    if threads is None:
+        threads = int(os.environ.get("SERVE_THREADS", 8))
+    budget = max(threads - reserved, 1)
+    max_inflight = min(DEFAULT_MAX_INFLIGHT, budget)
+    max_queue = min(DEFAULT_MAX_QUEUE, budget - max_inflight)
+    if (max_inflight, max_queue) != (DEFAULT_MAX_INFLIGHT, DEFAULT_MAX_QUEUE):
+        logger.warning(f"Waitress 线程数为 {threads}，Webhook 全局名额调整为处理 {max_inflight} 个、"
+                       f"排队 {max_queue} 个。")
+    return max_inflight, max_queue
+
+
+def fair_share(parent, shops):
+    """每个店铺的 (max_inflight, max_queue)：全局名额按店铺数均分，每个店铺至少可以处理 1 个。"""
+    return max(1, parent.max_inflight // shops), parent.max_queue // shops
+
+
+class AdmissionController:
+    def __init__(self, max_inflight=DEFAULT_MAX_INFLIGHT, max_queue=DEFAULT_MAX_QUEUE,
+                 queue_timeout=DEFAULT_QUEUE_TIMEOUT, is_draining=None, parent=None):
+        self.parent = parent
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.is_draining = is_draining or (lambda: False)
+        self._lock = threading.Lock()
+        self._waiters = collections.deque()  # 按到达顺序排队，每个等待者一个 Event
+        self._inflight = 0
+        self._service_seconds = None  # 处理时间的指数移动平均
+        self._wait_seconds = 0.0
+        self.admitted = 0
+        self.rejected = collections.Counter()
+        self.peak_queue = 0
+
+    def _retry_after(self):
+        if self._service_seconds is None:
+            return 1
+        estimate = self._service_seconds * (len(self._waiters) + 1) / self.max_inflight
+        return max(1, min(MAX_RETRY_AFTER, math.ceil(estimate)))
+
+    def _reject(self, status, reason):
+        self.rejected[reason] += 1
+        retry_after = self._retry_after()
+        logger.warning(f"Webhook 已拒绝 ({reason})：处理中 {self._inflight}，排队 {len(self._waiters)}，"
+                       f"{retry_after} 秒后重试。")
+        return Overloaded(status, reason, retry_after)
+
+    def acquire(self):
+        """获取处理名额，必要时排队等待；未被接受时抛出 Overloaded。"""
+        with self._lock:
+            if self.is_draining():
+                raise self._reject(503, "draining")
+            if self._inflight < self.max_inflight and not self._waiters:
+                self._inflight += 1
+                self.admitted += 1
+                return
+            if len(self._waiters) >= self.max_queue:
+                raise self._reject(429, "queue_full")
+            event = threading.Event()
+            self._waiters.append(event)
+            self.peak_queue = max(self.peak_queue, len(self._waiters))
+
+        started = time.monotonic()
+        event.wait(self.queue_timeout)
+        with self._lock:
+            if not event.is_set():  # 超时，且在此期间没有被 release() 唤醒
+                self._waiters.remove(event)
+                raise self._reject(503, "queue_timeout")
+            self.admitted += 1
+            self._wait_seconds += time.monotonic() - started
+
+    def release(self, service_seconds):
+        with self._lock:
+            if self._service_seconds is None:
+                self._service_seconds = service_seconds
+            else:
+                self._service_seconds += EWMA_ALPHA * (service_seconds - self._service_seconds)
+            if self._waiters:
+                self._waiters.popleft().set()  # 名额直接交给队首，处理中数量不变
+            else:
+                self._inflight -= 1
+
+    @contextmanager
+    def admit(self):
+        """获得处理名额（有 parent 时在本地名额内被接受后再获得 parent 的名额），未被接受时抛出 Overloaded。"""
+        if self.parent is not None:
+            with self._admit_local(), self.parent.admit():
+                yield
+        else:
+            with self._admit_local():
+                yield
+
+    @contextmanager
+    def _admit_local(self):
+        self.acquire()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_inflight": self.max_inflight,
+                "max_queue": self.max_queue,
+                "inflight": self._inflight,
+                "queued": len(self._waiters),
+                "peak_queue": self.peak_queue,
+                "admitted": self.admitted,
+                "rejected": dict(self.rejected),
+                "avg_service_ms": round(self._service_seconds * 1000) if self._service_seconds is not None else None,
+                "avg_queue_wait_ms": round(self._wait_seconds * 1000 / self.admitted) if self.admitted else 0,
+            }
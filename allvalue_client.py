@@ -0,0 +1,113 @@
+# allvalue_client.py
+"""
+AllValue GraphQL 请求封装。
+
+访问令牌由 token_manager.token_provider 缓存和刷新，调用方不再自行获取令牌。
+请求因认证失败被拒绝（HTTP 401/403 或 GraphQL 认证错误）时，刷新一次令牌并重试一次。
+
+所有请求经过 rate_limiter.api_limiter 限流（多店铺时由调用方传入各店铺自己的令牌和限流器）；被限流（HTTP 429 或 GraphQL 限流错误）时
+等待限流器的退避时间后重试，最多 MAX_THROTTLE_RETRIES 次，不会因限流丢单。
+"""
+
+import logging
+import time
+
+import requests
+
+from rate_limiter import PRIORITY_LIVE, api_limiter
+from token_manager import token_provider
+
+logger = logging.getLogger(__name__)
+
+AUTH_HTTP_STATUSES = (401, 403)
+AUTH_ERROR_CODES = {"UNAUTHENTICATED", "UNAUTHORIZED", "ACCESS_DENIED", "FORBIDDEN", "INVALID_TOKEN"}
+THROTTLE_ERROR_CODES = {"THROTTLED", "RATE_LIMITED", "TOO_MANY_REQUESTS"}
+MAX_THROTTLE_RETRIES = 6
+
+
+class ThrottledError(requests.exceptions.RequestException):
+    """多次重试后仍被 AllValue 限流。"""
+    pass
+
+
+def _has_error(data, codes, phrases):
+    for error in data.get("errors") or []:
+        code = str((error.get("extensions") or {}).get("code", "")).upper()
+        if code in codes:
+            return True
+        message = str(error.get("message", "")).lower()
+        if any(phrase in message for phrase in phrases):
+            return True
+    return False
+
+
+def _has_auth_error(data):
+    return _has_error(data, AUTH_ERROR_CODES, ("access token",))
+
+
+def _has_throttle_error(data):
+    return _has_error(data, THROTTLE_ERROR_CODES, ("throttl", "rate limit", "too many requests"))
+
+
+def _retry_after(resp):
+    try:
+        return float(resp.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _send(endpoint, token, payload, timeout, priority, limiter):
+    """在限流器控制下发送一次请求，返回 (resp, data, throttled)。认证失败时 data 为 None。"""
+    limiter.acquire(priority)
+    started = time.monotonic()
+    throttled, retry_after, latency = False, None, None
+    try:
+        resp = requests.post(endpoint, headers={"Custom-AllValue-Access-Token": token},
+                             json=payload, timeout=timeout)
+        latency = time.monotonic() - started
+        if resp.status_code == 429:
+            throttled, retry_after = True, _retry_after(resp)
+            return resp, None, True
+        if resp.status_code in AUTH_HTTP_STATUSES:
+            return resp, None, False
+        resp.raise_for_status()
+        data = resp.json()
+        throttled = _has_throttle_error(data)
+        return resp, data, throttled
+    finally:
+        limiter.release(latency, throttled=throttled, retry_after=retry_after)
+
+
+def post_graphql(endpoint, query, variables=None, timeout=10, priority=PRIORITY_LIVE, tokens=None, limiter=None):
+    """
+    发送 GraphQL 请求并返回解析后的 JSON（可能包含 errors，由调用方处理）。
+    tokens / limiter 默认为全局的 token_provider / api_limiter。
+    网络错误或非认证类 HTTP 错误按 requests 异常抛出，多次限流后抛出 ThrottledError；
+    令牌不可用时抛出 TokenUnavailableError。
+    """
+    tokens = tokens or token_provider
+    limiter = limiter or api_limiter
+    payload = {"query": query, "variables": variables or {}}
+    token = tokens.get_token()
+    auth_retried = False
+    throttle_retries = 0
+    while True:
+        resp, data, throttled = _send(endpoint, token, payload, timeout, priority, limiter)
+
+        if throttled:
+            throttle_retries += 1
+            if throttle_retries > MAX_THROTTLE_RETRIES:
+                raise ThrottledError(f"AllValue 请求连续 {throttle_retries} 次被限流")
+            continue  # 限流器已暂停发送，重新排队即可
+
+        auth_failed = data is None or _has_auth_error(data)
+        if not auth_failed:
+            return data
+        if auth_retried:
+            logger.error("刷新令牌后 AllValue 请求仍认证失败。")
+            if data is None:
+                resp.raise_for_status()
+            return data
+        logger.warning(f"AllValue 请求认证失败 (HTTP {resp.status_code})，刷新令牌后重试。")
+        token = tokens.invalidate(token)
+        auth_retried = True
@@ -1,83 +1,67 @@
+import atexit
 import datetime
+import functools
 import hashlib
-import json
-import logging
 import os
+import sqlite3
+import threading
+import time
 
 import requests
-import win32print
 from apscheduler.schedulers.background import BackgroundScheduler
-from flask import Flask, request, jsonify, render_template, redirect, url_for, abort
+from flask import (
+    Flask, Response, request, jsonify, render_template, redirect, url_for, abort, stream_with_context
+)
 
-import print_helper
-import print_helper_pdf
-import print_helper_old
+import order_transfer
+import print_backends
+import print_retry
 from database import (
-    init_db, get_setting, set_setting,
-    insert_or_update_order, get_all_orders, update_order, get_order_by_db_id
+    init_db, get_setting, set_setting, NEW_ORDER_STATUS,
+    insert_or_update_order, get_all_orders, update_order, order_exists, get_order_state, search_orders,
+    get_orders_by_db_ids, find_order_db_ids, update_orders_status, get_sales_report, load_prep_list
 )
-from token_manager import get_allvalue_access_token
-
-
-weasyprint_logger = logging.getLogger('weasyprint')
-weasyprint_logger.setLevel(logging.DEBUG)
-weasyprint_logger.addHandler(logging.StreamHandler())
+from kitchen_prep import FULFILLED_STATUS, prep_list
+from leases import init_lease_tables, lease_manager
+from log_config import configure_logging, log_context, update_log_context
+from lifecycle import inflight
+from polling import AdaptivePoller
+from printer_inventory import printer_inventory
+from print_routing import (
+    load_targets, parse_routes, select_items, dispatch_to_targets, dispatch_batch_to_targets, summarize_status
+)
+from receipt_cache import receipt_cache, make_key
+from retention import init_retention_tables, run_retention, find_order_by_db_id, find_order_by_order_id
+from token_manager import TokenUnavailableError
+from shops import shop_registry, webhook_admission
+from uptime_store import HEARTBEAT_INTERVAL, init_uptime_tables
+from admission import Overloaded
+from allvalue_client import post_graphql
+from backfill import split_time_range, iter_sharded, prefetch_ordered
+from rate_limiter import PRIORITY_BACKFILL, PRIORITY_LIVE
+
+# 配置日志：记录经队列由后台线程输出，级别和限流见 log_config.py（需在创建 Flask 应用之前配置）
+configure_logging()
 app = Flask(__name__)
 
-# 配置日志
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-app.logger.setLevel(logging.INFO)
-
-shop = "一品滋味"
-ALLVALUE_GRAPHQL_ENDPOINT = f"https://{shop}.myallvalue.com/admin/api/open/graphql/v202108"
-ALLVALUE_WEBHOOK_SECRET = os.environ.get("ALLVALUE_WEBHOOK_SECRET")
-TIME_FILE = "uptime.json"
-first_request = True
-scheduler_started = False
+FETCH_PAGE_RETRIES = 3  # 订单列表单页请求的网络错误重试次数
+BACKFILL_RETRY_DELAY = 60  # 启动补单失败后的重试间隔（秒），每次翻倍
+BACKFILL_RETRY_MAX_DELAY = 30 * 60
 
 # 初始化 APScheduler
 scheduler = BackgroundScheduler()
 
-def record_uptime(end_time=None):
-    """记录时间到 uptime.json。"""
-    data = {}
-    try:
-        if os.path.exists(TIME_FILE):
-            with open(TIME_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-    except json.JSONDecodeError:
-        app.logger.warning("uptime.json 文件损坏，重新创建。")
-    except FileNotFoundError:
-        app.logger.warning("uptime.json 文件不存在，创建新文件")
-    except IOError as e:
-        app.logger.error(f"读取uptime.json文件失败:{e}")
-
-    # 只记录 end_time
+def record_uptime(shop, end_time=None):
+    """记录店铺的同步水位 end_time 到共享数据库。"""
     if end_time:
-        data["end_time"] = end_time.isoformat()
-
-    try:
-        with open(TIME_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=4)
-    except IOError as e:
-        app.logger.error(f"写入 uptime.json 文件失败: {e}")
+        shop.uptime_store.record_watermark(end_time)
 
-def get_last_uptime():
-    """获取上次记录的 end_time（UTC）。"""
-    try:
-        if os.path.exists(TIME_FILE):
-            with open(TIME_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                end_time_str = data.get("end_time")
-                if end_time_str:
-                    app.logger.info(f"从 {TIME_FILE} 中读取时间: end_time={end_time_str}")
-                    return datetime.datetime.fromisoformat(end_time_str) # 只返回 end_time
-        else:
-            app.logger.warning(f"{TIME_FILE}文件不存在")
-            return None
-    except Exception as e:
-        app.logger.error(f"读取{TIME_FILE}文件失败:{e}")
-        return None
+def get_last_uptime(shop):
+    """获取店铺上次记录的 end_time（UTC）。"""
+    end_time = shop.uptime_store.get_watermark()
+    if end_time:
+        app.logger.info(f"读取店铺 {shop.key} 的同步水位: end_time={end_time.isoformat()}")
+    return end_time
 
 def to_millis(dt: datetime.datetime) -> int:
     """将Python datetime转成UTC毫秒时间戳"""
@@ -89,48 +73,57 @@ def to_millis(dt: datetime.datetime) -> int:
     delta = dt - epoch
     return int(delta.total_seconds() * 1000)
 
-def fetch_missing_orders(start_time):
-    """请求指定时间段内的遗漏订单，支持分页，使用毫秒级 created_at_range。"""
-    if not start_time:
-        app.logger.warning("开始时间为空，无法请求遗漏订单。")
-        return []
-
-    access_token = get_allvalue_access_token()
-    if not access_token:
-        app.logger.error("无法获取 AllValue 访问令牌，无法请求遗漏订单。")
-        return []
+class MissingOrdersFetchError(Exception):
+    """遗漏订单列表未能完整拉取。调用方不应推进时间水位，下次轮询会重新拉取该时间段。"""
+    pass
 
-    end_time = datetime.datetime.utcnow() # 获取当前时间作为结束时间
-    start_ts = to_millis(start_time)
-    end_ts = to_millis(end_time)
 
-    if start_ts > end_ts:
-        app.logger.error("start_ts 大于 end_ts，无法请求遗漏订单。")
-        return []
+def fetch_orders_page(shop, gql_query, variables):
+    """
+    以补单优先级请求一页订单列表。限流由 post_graphql 等待重试；网络错误按指数退避重试，
+    仍失败时抛出 MissingOrdersFetchError，而不是丢弃剩余的时间段。
+    """
+    for attempt in range(FETCH_PAGE_RETRIES + 1):
+        try:
+            data = post_graphql(shop.endpoint, gql_query, variables, priority=PRIORITY_BACKFILL,
+                                tokens=shop.token_provider, limiter=shop.api_limiter)
+        except TokenUnavailableError as e:
+            raise MissingOrdersFetchError(f"无法获取 AllValue 访问令牌: {e}")
+        except requests.exceptions.RequestException as e:
+            if attempt == FETCH_PAGE_RETRIES:
+                raise MissingOrdersFetchError(f"请求遗漏订单失败: {e}")
+            delay = 2 ** attempt
+            app.logger.warning(f"请求遗漏订单失败: {e}，{delay} 秒后重试 ({attempt + 1}/{FETCH_PAGE_RETRIES})")
+            time.sleep(delay)
+            continue
 
-    # 使用正确的 GraphQL 查询语句
-    gql_query = """
-    query Orders($query: String!, $first: Int!, $after: String) {
-      orders(query: $query, first: $first, after: $after) {
-        edges {
-          cursor
-          node {
-            nodeId
-            name
-          }
-        }
-        pageInfo {
-          hasNextPage
-        }
+        if "errors" in data:
+            app.logger.error(f"GraphQL Error: {data['errors']}")
+            raise MissingOrdersFetchError(f"GraphQL Error: {data['errors']}")
+        return data
+
+
+ORDERS_PAGE_QUERY = """
+query Orders($query: String!, $first: Int!, $after: String) {
+  orders(query: $query, first: $first, after: $after) {
+    edges {
+      cursor
+      node {
+        nodeId
+        name
+        createdAt
       }
     }
-    """
-
-    headers = {
-        "Custom-AllValue-Access-Token": access_token
+    pageInfo {
+      hasNextPage
     }
+  }
+}
+"""
+
 
-    orders = []
+def iter_order_pages(shop, start_ts, end_ts):
+    """按页产出 [start_ts, end_ts]（毫秒，闭区间）内已支付订单的 nodeId、name 和 createdAt。"""
     has_next_page = True
     after_cursor = None
     page_size = 50  # 每次请求50个订单
@@ -145,165 +138,659 @@ def fetch_missing_orders(start_time):
             "first": page_size,
             "after": after_cursor
         }
+        data = fetch_orders_page(shop, ORDERS_PAGE_QUERY, variables)
+
+        orders_conn = data.get("data", {}).get("orders", {})
+        edges = orders_conn.get("edges", [])
+        yield [edge["node"] for edge in edges if edge.get("node")]  # 只保存 nodeId、name 和 createdAt
+
+        page_info = orders_conn.get("pageInfo", {})
+        has_next_page = page_info.get("hasNextPage", False)
+        if edges:  # 避免 edges 为空时报错
+            after_cursor = edges[-1].get("cursor")
+
+
+def iter_missing_orders(shop, start_time, end_time=None):
+    """
+    按创建顺序逐个产出指定时间段内的遗漏订单，使用毫秒级 created_at_range。
+    时间段按分片并发拉取，页面到达即产出；任何一页最终拉取失败都会抛出 MissingOrdersFetchError。
+    """
+    if not start_time:
+        app.logger.warning("开始时间为空，无法请求遗漏订单。")
+        return
+
+    end_time = end_time or datetime.datetime.utcnow() # 默认以当前时间作为结束时间
+    start_ts = to_millis(start_time)
+    end_ts = to_millis(end_time)
+
+    if start_ts > end_ts:
+        app.logger.error("start_ts 大于 end_ts，无法请求遗漏订单。")
+        return
+
+    shards = split_time_range(start_ts, end_ts)
+    if len(shards) > 1:
+        app.logger.info(f"补单时间段切分为 {len(shards)} 个分片并发拉取。")
+    yield from iter_sharded(shards, functools.partial(iter_order_pages, shop))
+
+class BackfillProgress:
+    """启动补单进度，供 /healthz 查询。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.state = "pending"  # pending / running / done / failed / standby / takeover
+        self.total = 0
+        self.processed = 0
+        self.failed = 0
+        self.started_at = None
+        self.finished_at = None
+
+    def update(self, **fields):
+        with self._lock:
+            for key, value in fields.items():
+                setattr(self, key, value)
+
+    def increment(self, ok):
+        with self._lock:
+            if ok:
+                self.processed += 1
+            else:
+                self.failed += 1
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "total": self.total,
+                "processed": self.processed,
+                "failed": self.failed,
+                "started_at": self.started_at.isoformat() if self.started_at else None,
+                "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            }
 
+
+backfill_progress = {shop.key: BackfillProgress() for shop in shop_registry}
+bootstrap_lock = threading.Lock()
+bootstrapped = False
+shutdown_started = False
+
+
+def order_created_at(order, default):
+    """订单列表中的 createdAt（ISO 时间或毫秒时间戳）转换为 UTC 时间，无法解析时返回 default。"""
+    value = order.get("createdAt")
+    try:
+        if isinstance(value, (int, float)) or str(value).isdigit():
+            return datetime.datetime.utcfromtimestamp(int(value) / 1000)
+        created = datetime.datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except (TypeError, ValueError, OverflowError):
+        return default
+    if created.tzinfo is not None:
+        created = created.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return created
+
+
+def backfill_missing_orders(shop, start_time, should_print, progress=None, end_time=None):
+    """
+    拉取店铺 start_time 至 end_time（默认当前时间）的遗漏订单并按创建顺序处理，
+    返回 (新补齐的订单数量, 最早一个处理失败的订单的创建时间，全部成功时为 None)。
+    已入库的订单会被跳过，避免重复打印。订单详情并发预取，入库和打印仍按顺序逐个进行。
+    调用方不能把水位推进到失败订单的创建时间之后，否则这些订单（例如详情请求被限流）再也不会被拉取。
+    """
+    missing_orders = (order for order in iter_missing_orders(shop, start_time, end_time)
+                      if not order_exists(shop.order_id(order.get("name"))))
+    fetch_details = lambda order: fetch_order_details(order.get("nodeId"), PRIORITY_BACKFILL, shop=shop)
+
+    count = 0
+    failed_since = None
+    for order, details in prefetch_ordered(missing_orders, fetch_details):
+        count += 1
+        if progress:
+            progress.update(total=count)
+        order_id = order.get("nodeId")  # 从 iter_missing_orders 的结果中提取 nodeId
+        ok = False
         try:
-            resp = requests.post(ALLVALUE_GRAPHQL_ENDPOINT, headers=headers, json={"query": gql_query, "variables": variables}, timeout=10)
-            resp.raise_for_status()
-            data = resp.json()
-
-            if "errors" in data:
-                app.logger.error(f"GraphQL Error: {data['errors']}")
-                break
-
-            orders_conn = data.get("data", {}).get("orders", {})
-            edges = orders_conn.get("edges", [])
-            for edge in edges:
-                node = edge.get("node")
-                if node:
-                    orders.append(node)  # 只保存 nodeId 和 name
-
-            page_info = orders_conn.get("pageInfo", {})
-            has_next_page = page_info.get("hasNextPage", False)
-            if edges:  # 避免 edges 为空时报错
-                after_cursor = edges[-1].get("cursor")
-
-        except requests.exceptions.Timeout:
-            app.logger.error("请求遗漏订单超时")
-            break
-        except requests.exceptions.RequestException as e:
-            app.logger.error(f"请求遗漏订单失败: {e}")
-            break
+            # 传递 nodeId 和预取的详情给 process_order_webhook
+            ok = process_order_webhook(order_id, should_print=should_print, raw_order_data=details.result(),
+                                       shop=shop, order_name=order.get("name"))
+            if ok:
+                app.logger.info(f"成功补齐订单：{order_id}")
+        except OrderProcessingError as e:
+            app.logger.error(f"补齐订单 {order_id} 失败: {e}")
         except Exception as e:
-            app.logger.exception(f"获取遗漏订单时发生未知错误: {e}")
-            break
+            app.logger.exception(f"补齐订单 {order_id} 时发生未知错误: {e}")
+        if not ok:
+            created_at = order_created_at(order, start_time)
+            failed_since = created_at if failed_since is None else min(failed_since, created_at)
+        if progress:
+            progress.increment(ok)
+
+    if failed_since is not None:
+        shop.uptime_store.hold(failed_since)  # 心跳也不能越过失败的订单
+        app.logger.warning(f"店铺 {shop.key} 有遗漏订单未能补齐，下次从 {failed_since} 重新拉取。")
+    if count:
+        app.logger.info(f"店铺 {shop.key} 共处理 {count} 个遗漏订单")
+    else:
+        app.logger.info(f"店铺 {shop.key} 未发现遗漏订单。")
+    return count, failed_since
 
-    return orders
 
-def poll_orders():
-    """轮询获取遗漏订单的任务函数。"""
-    app.logger.info("开始轮询获取遗漏订单...")
-    start_time = get_last_uptime()
+def ingest_lease(shop):
+    """店铺轮询和补单的租约名称。多实例时只有持有该租约的实例轮询该店铺。"""
+    return f"ingest:{shop.key}"
+
+
+def poll_orders(shop):
+    """轮询获取店铺遗漏订单的任务函数，返回本次补齐的订单数量。"""
+    if not lease_manager.holds(ingest_lease(shop)):
+        app.logger.debug(f"店铺 {shop.key} 的轮询由其他实例负责，本实例跳过。")
+        return 0
+    app.logger.info(f"开始轮询获取店铺 {shop.key} 的遗漏订单...")
+    start_time = get_last_uptime(shop)
     end_time = datetime.datetime.utcnow()
     if start_time is None:
         start_time = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    found, failed_since = 0, None
     if start_time and start_time < end_time:
         app.logger.info(f"轮询时间范围：{start_time} 到 {end_time}")
-        missing_orders = fetch_missing_orders(start_time)
-        if missing_orders:
-            app.logger.info(f"发现 {len(missing_orders)} 个遗漏订单")
-            for order in missing_orders:
-                order_id = order.get("nodeId")  # 从 fetch_missing_orders 的返回结果中提取 nodeId
-                try:
-                    # 传递 nodeId 给 process_order_webhook
-                    process_order_webhook(order_id, should_print=get_setting('auto_print_enabled') == 'true')
-                    app.logger.info(f"成功补齐订单：{order_id}")
-                except OrderProcessingError as e:
-                    app.logger.error(f"补齐订单 {order_id} 失败: {e}")
-                except Exception as e:
-                    app.logger.exception(f"补齐订单 {order_id} 时发生未知错误: {e}")
-        else:
-            app.logger.info("未发现遗漏订单。")
+        found, failed_since = backfill_missing_orders(shop, start_time,
+                                                      should_print=shop.get_setting('auto_print_enabled') == 'true',
+                                                      end_time=end_time)
     else:
         app.logger.info("没有需要轮询的时间范围。")
-    record_uptime(end_time=datetime.datetime.utcnow())
-
-@app.before_request
-def initialize():
-    """在应用首次请求前初始化相关功能。"""
-    global first_request
-    global scheduler_started
-    if first_request:
-        init_db()
+    # 记录本次查询的起点时间而非结束时间，避免轮询期间新建的订单落入两次轮询之间的空档；
+    # 有订单补齐失败时水位停在最早的失败订单，下次轮询重新拉取
+    record_uptime(shop, end_time=min(end_time, failed_since) if failed_since else end_time)
+    return found
 
-        polling_enabled = get_setting('polling_enabled') == 'true'
 
-        if polling_enabled:
-            if not scheduler_started:
-                scheduler.add_job(func=poll_orders, trigger="interval", hours=1, id='poll_orders_job')
-                scheduler.start()
-                scheduler_started = True
-                app.logger.info("已启动轮询任务。")
+# 每个店铺一个轮询器，按各自的 Webhook 健康状况调整间隔
+pollers = {shop.key: AdaptivePoller(scheduler, functools.partial(poll_orders, shop), shop.webhook_health,
+                                    job_id=f'poll_orders_job_{shop.key}', get_setting=shop.get_setting)
+           for shop in shop_registry}
+
+
+def start_polling():
+    """启动所有店铺的自适应轮询（已启动时无操作）。"""
+    for poller in pollers.values():
+        poller.start()
+
+
+def stop_polling():
+    for poller in pollers.values():
+        poller.stop()
+
+
+def beat(shop):
+    """
+    写入店铺的心跳。心跳在各实例间共享，只由持有 ingest 租约的实例写入，热备实例不推进它；
+    刚接管租约时等 _on_ingest_acquired 设置 hold 之后再写入。
+    """
+    if lease_manager.holds(ingest_lease(shop)) and backfill_progress[shop.key].state != "standby":
+        shop.uptime_store.beat()
+
+
+def start_heartbeat(shop):
+    """每隔几秒记录一次店铺的存活心跳，下次启动时据此只补齐真正的停机时间段。"""
+    beat(shop)
+    scheduler.add_job(func=beat, args=(shop,), trigger="interval", seconds=HEARTBEAT_INTERVAL,
+                      id=f'heartbeat_job_{shop.key}', replace_existing=True, max_instances=1, coalesce=True)
+
+
+def run_startup_backfill(shop, start_time):
+    """
+    检查店铺停机期间的遗漏订单（只入库不打印），在后台线程中执行。
+    心跳立即开始写入，但在补单完成（水位推进到 start_time 之后）之前不会超过 start_time，
+    补单中途崩溃或失败时下次启动仍会覆盖这段时间；补单失败时按退避间隔安排重试。
+    """
+    progress = backfill_progress[shop.key]
+    if not lease_manager.holds(ingest_lease(shop)):
+        # 热备实例：由持有租约的实例补单，接管租约时再补齐遗漏订单
+        app.logger.info(f"店铺 {shop.key} 由其他实例负责补单，本实例作为热备运行。")
+        progress.update(state="standby")
+        start_heartbeat(shop)
+        return
+    if start_time:
+        shop.uptime_store.hold(start_time)
+    start_heartbeat(shop)
+    _startup_backfill(shop, start_time, attempt=0)
+
+
+def _startup_backfill(shop, start_time, attempt):
+    progress = backfill_progress[shop.key]
+    progress.update(state="running", started_at=datetime.datetime.utcnow())
+    retry_from = None
+    try:
+        with pollers[shop.key].poll_lock:  # 与轮询互斥，避免同一时间段被并发补单
+            end_time = datetime.datetime.utcnow()
+            if start_time and start_time < end_time:
+                app.logger.info(f"开始检查店铺 {shop.key} 的遗漏订单，时间范围：{start_time} 到 {end_time}")
+                _, failed_since = backfill_missing_orders(shop, start_time, should_print=False, progress=progress,
+                                                          end_time=end_time)
+                if failed_since:
+                    end_time = min(end_time, failed_since)
+                    retry_from = failed_since
+            record_uptime(shop, end_time=end_time)
+        progress.update(state="failed" if retry_from else "done")
+    except Exception as e:
+        app.logger.exception(f"店铺 {shop.key} 启动补单失败: {e}")
+        progress.update(state="failed")
+        retry_from = start_time
+    finally:
+        progress.update(finished_at=datetime.datetime.utcnow())
+    if retry_from and not shutdown_started:
+        delay = min(BACKFILL_RETRY_MAX_DELAY, BACKFILL_RETRY_DELAY * 2 ** attempt)
+        app.logger.warning(f"店铺 {shop.key} 的启动补单未完成，{delay} 秒后从 {retry_from} 重试。")
+        scheduler.add_job(func=_retry_startup_backfill, args=(shop, retry_from, attempt + 1), trigger="date",
+                          run_date=datetime.datetime.now() + datetime.timedelta(seconds=delay),
+                          id=f'backfill_retry_job_{shop.key}', replace_existing=True)
+
+
+def _retry_startup_backfill(shop, start_time, attempt):
+    if not lease_manager.holds(ingest_lease(shop)):
+        return  # 租约已转给其他实例，由它负责补单
+    _startup_backfill(shop, start_time, attempt)
+
+
+def _on_ingest_acquired(shop):
+    """热备实例接管了店铺的租约：立即轮询一次，补齐原实例停止后遗漏的订单并按设置打印。"""
+    if backfill_progress[shop.key].state != "standby":
+        return  # 启动时获得租约，由启动补单处理
+    app.logger.warning(f"接管店铺 {shop.key} 的轮询，立即补齐遗漏订单。")
+    # 补齐之前心跳不能越过原实例停止的时间，接管后的补单中途失败时下次仍从那里开始
+    recovery_start = shop.uptime_store.recovery_start()
+    if recovery_start:
+        shop.uptime_store.hold(recovery_start)
+    backfill_progress[shop.key].update(state="takeover")
+    threading.Thread(target=pollers[shop.key].poll_now, name=f"takeover-poll-{shop.key}", daemon=True).start()
+
+
+def _on_ingest_lost(shop):
+    backfill_progress[shop.key].update(state="standby")
+
+
+def bootstrap_app():
+    """
+    应用启动初始化：建表、启动轮询、预加载打印后端，并在后台补齐停机期间的订单。
+    由启动入口显式调用，任何 HTTP 请求都不承担这些工作。重复调用无副作用。
+    """
+    global bootstrapped
+    with bootstrap_lock:
+        if bootstrapped:
+            return
+        init_db()
+        init_retention_tables()
+        print_retry.init_print_retry_tables()
+        init_lease_tables()
+        init_uptime_tables()
+        for shop in shop_registry:
+            shop.uptime_store.import_legacy_file()
+        load_prep_list()
+
+        # 每天凌晨低峰期归档过期订单并回收数据库空间（多实例时只由一个实例执行）
+        scheduler.add_job(func=lease_manager.run_exclusive, args=("retention", run_retention), trigger="cron",
+                          hour=4, id='retention_job', replace_existing=True, max_instances=1)
+        if not scheduler.running:
+            scheduler.start()
+        # 多实例时每个店铺只由一个实例轮询；该实例停止续约后，其他实例在几秒内接管
+        for shop in shop_registry:
+            lease_manager.keep(ingest_lease(shop), on_acquired=functools.partial(_on_ingest_acquired, shop),
+                               on_lost=functools.partial(_on_ingest_lost, shop))
+        lease_manager.start(scheduler)
+        printer_inventory.start(scheduler)  # 后台刷新打印机清单和状态
+        print_retry_queue.start(scheduler)  # 继续重启前未完成的打印重试
+
+        if get_setting('polling_enabled') == 'true':
+            start_polling()
         else:
             app.logger.info("轮询任务未启用。")
 
-        # 首次请求时也检查遗漏订单
-        start_time = get_last_uptime()
-        end_time = datetime.datetime.utcnow()
-        if start_time and end_time and start_time < end_time:
-            app.logger.info(f"开始检查遗漏订单，时间范围：{start_time} 到 {end_time}")
-            missing_orders = fetch_missing_orders(start_time)
-            if missing_orders:
-                app.logger.info(f"发现 {len(missing_orders)} 个遗漏订单")
-                for order in missing_orders:
-                    order_id = order.get("nodeId")  # 从 fetch_missing_orders 的返回结果中提取 nodeId
-                    try:
-                        # 传递 nodeId 给 process_order_webhook
-                        process_order_webhook(order_id, should_print=False)
-                        app.logger.info(f"成功补齐订单：{order_id}")
-                    except OrderProcessingError as e:
-                        app.logger.error(f"补齐订单 {order_id} 失败: {e}")
-                    except Exception as e:
-                        app.logger.exception(f"补齐订单 {order_id} 时发生未知错误: {e}")
-            else:
-                app.logger.info("未发现遗漏订单。")
+        print_backends.preload_async(get_setting('print_method') or 'escpos')
+
+        # 在写入新的心跳之前确定各店铺的停机时间段，各店铺并行补单
+        for shop in shop_registry:
+            recovery_start = shop.uptime_store.recovery_start()
+            threading.Thread(target=run_startup_backfill, args=(shop, recovery_start),
+                             name=f"startup-backfill-{shop.key}", daemon=True).start()
+        atexit.register(shutdown_app)  # 未经 serve.py 退出（如调试服务器）时同样记录退出时间
+        bootstrapped = True
+
+
+@app.route("/healthz")
+def healthz():
+    """就绪检查：初始化完成即可接收 Webhook，同时报告启动补单进度。"""
+    body = {
+        "ready": bootstrapped,
+        "shops": {shop.key: {
+            "domain": shop.domain,
+            "backfill": backfill_progress[shop.key].to_dict(),
+            "polling": pollers[shop.key].status(),
+            "api_limiter": shop.api_limiter.stats(),
+            "webhook_admission": shop.webhook_admission.stats(),
+        } for shop in shop_registry},
+        "webhook_admission": webhook_admission.stats(),
+        "leases": lease_manager.status(),
+        "inflight": inflight.snapshot(),
+        "receipt_cache": receipt_cache.stats(),
+        "printers": printer_inventory.status(),
+        "print_retry": print_retry_queue.status() if bootstrapped else {},
+    }
+    return jsonify(body), 200 if bootstrapped else 503
+
+SEARCH_PAGE_SIZE = 20
 
-        record_uptime(end_time=datetime.datetime.utcnow())
-        first_request = False
 
 @app.route("/")
 def index():
-    orders = get_all_orders()
-    return render_template("index.html", orders=orders)
+    query = (request.args.get("q") or "").strip()
+    if not query:
+        return render_template("index.html", orders=get_all_orders(), query="")
+
+    page = request.args.get("page", 1, type=int)
+    orders, total = search_orders(query, page, SEARCH_PAGE_SIZE)
+    return render_template("index.html", orders=orders, query=query, page=page, total=total,
+                           page_count=(total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE)
+
+@app.route("/api/orders/search")
+def search_orders_api():
+    """全文检索订单，按相关度排序并分页。参数: q, page, per_page。"""
+    query = (request.args.get("q") or "").strip()
+    page = max(request.args.get("page", 1, type=int), 1)
+    per_page = min(max(request.args.get("per_page", SEARCH_PAGE_SIZE, type=int), 1), 100)
+    if not query:
+        return jsonify({"status": "fail", "msg": "Missing query parameter q"}), 400
+    orders, total = search_orders(query, page, per_page)
+    return jsonify({"query": query, "page": page, "per_page": per_page, "total": total, "orders": orders}), 200
+
+@app.route("/api/orders/export")
+def export_orders_api():
+    """
+    流式导出订单。参数: format (ndjson / csv)，since、until（本地日期 YYYY-MM-DD，包含），status（状态前缀）。
+    直接从数据库游标逐行输出，导出全年订单也不会一次性载入内存。
+    """
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in order_transfer.FORMATS:
+        return jsonify({"status": "fail", "msg": f"Unsupported format: {fmt}"}), 400
+    try:
+        since, until = request.args.get("since"), request.args.get("until")
+        order_transfer.local_date_to_utc(since)
+        order_transfer.local_date_to_utc(until)
+    except ValueError:
+        return jsonify({"status": "fail", "msg": "since/until must be YYYY-MM-DD"}), 400
+
+    lines = order_transfer.export_lines(fmt, since, until, request.args.get("status"))
+    filename = f"orders-{datetime.date.today().isoformat()}.{fmt}"
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return Response(stream_with_context(lines), mimetype=f"{mimetype}; charset=utf-8",
+                    headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+@app.route("/api/orders/import", methods=["POST"])
+def import_orders_api():
+    """批量导入 NDJSON（请求体逐行读取），按 order_id 幂等写入。"""
+    lines = (line.decode("utf-8-sig") for line in request.stream)
+    imported, skipped = order_transfer.import_ndjson(lines)
+    return jsonify({"status": "success", "imported": imported, "skipped": skipped}), 200
+
+REPORT_DEFAULT_DAYS = {"hour": 1, "day": 30, "week": 84, "month": 365}
+
+
+def _report_args():
+    """解析报表参数 period、start、end（本地日期），缺省时按周期取最近一段时间。格式错误抛出 ValueError。"""
+    period = request.args.get("period", "day")
+    if period not in REPORT_DEFAULT_DAYS:
+        raise ValueError(f"Unsupported period: {period}")
+    end = request.args.get("end") or datetime.date.today().isoformat()
+    end_date = datetime.date.fromisoformat(end)
+    start = request.args.get("start") or (end_date - datetime.timedelta(days=REPORT_DEFAULT_DAYS[period] - 1)).isoformat()
+    datetime.date.fromisoformat(start)
+    return period, start, end
+
+@app.route("/api/reports/sales")
+def sales_report_api():
+    """销售报表：各周期的订单数、分货币营业额，以及区间内销量最高的商品。"""
+    try:
+        period, start, end = _report_args()
+    except ValueError as e:
+        return jsonify({"status": "fail", "msg": str(e)}), 400
+    return jsonify(get_sales_report(period, start, end)), 200
+
+@app.route("/reports")
+def reports():
+    try:
+        period, start, end = _report_args()
+    except ValueError as e:
+        return str(e), 400
+    return render_template("reports.html", report=get_sales_report(period, start, end))
 
 @app.route("/print/<string:order_db_id_from_route>")
 def print_order_route(order_db_id_from_route):
-    order_record = get_order_by_db_id(order_db_id_from_route)
+    order_record = find_order_by_db_id(order_db_id_from_route)
     if not order_record:
         return "订单未找到", 404
 
-    order_data_to_print = order_record["order_json"]
-    printer_name_setting = get_setting('default_printer')
-    print_method_setting = get_setting('print_method')
-
-    if not printer_name_setting:
+    order_data_to_print = ensure_shop_name(order_record["order_json"])
+    shop = shop_registry.for_order(order_data_to_print)
+    targets = load_targets(shop.get_setting)
+    if not targets:
         return "打印失败：未在系统中设置目标打印机。", 500
 
     app.logger.info(f"手动打印请求：订单 {order_data_to_print.get('order_id')} (DB ID: {order_db_id_from_route})。")
-    success = dispatch_print_job(order_data_to_print, printer_name_setting, print_method_setting)
+    print_func = functools.partial(print_to_target, db_id=int(order_db_id_from_route))
+    status = summarize_status(dispatch_to_targets(order_data_to_print, targets, print_func,
+                                                  executor=shop.print_executor))
+    update_order(order_db_id_from_route, status, keep_fulfilled=True) # 使用从路由获取的数据库ID
 
-    if success:
-        update_order(order_db_id_from_route, "已打印") # 使用从路由获取的数据库ID
+    if status == "已打印":
         return redirect(url_for('index'))
     else:
-        return f"打印失败 (方式: {print_method_setting or 'escpos'})。请检查应用日志获取详细信息。", 500
+        return f"{status}。请检查应用日志获取详细信息。", 500
+
+BULK_PRINT_LIMIT = 200
+
+
+def _parse_bulk_selection(payload):
+    """从请求体中解析订单 ID 列表或筛选条件，返回 ID 列表。"""
+    if payload.get("ids"):
+        return [int(db_id) for db_id in payload["ids"]]
+    order_filter = payload.get("filter") or {}
+    created_date = order_filter.get("date")
+    if created_date == "today":
+        created_date = datetime.date.today().isoformat()
+    if not order_filter.get("status") and not created_date:
+        raise ValueError("必须提供 ids 或 filter (status / date)")
+    return find_order_db_ids(status_prefix=order_filter.get("status"), created_date=created_date)
+
+
+def _bulk_payload():
+    """兼容 JSON 请求和页面表单提交（filter_status / filter_date）。"""
+    if request.is_json:
+        return request.get_json() or {}
+    return {"filter": {"status": request.form.get("filter_status"), "date": request.form.get("filter_date")}}
+
+
+@app.route("/print/bulk", methods=["POST"])
+def bulk_print_route():
+    """批量重打：按 ID 列表或筛选条件选择订单，合并为一个打印批次并在一个事务中更新状态。"""
+    try:
+        db_ids = _parse_bulk_selection(_bulk_payload())
+    except (TypeError, ValueError) as e:
+        return jsonify({"status": "fail", "msg": str(e)}), 400
+    if len(db_ids) > BULK_PRINT_LIMIT:
+        return jsonify({"status": "fail", "msg": f"一次最多打印 {BULK_PRINT_LIMIT} 个订单"}), 400
+
+    targets_by_shop = {shop.key: load_targets(shop.get_setting) for shop in shop_registry}
+    if not any(targets_by_shop.values()):
+        return jsonify({"status": "fail", "msg": "未在系统中设置目标打印机。"}), 500
+
+    order_records = get_orders_by_db_ids(db_ids)
+    orders_data = [ensure_shop_name(record["order_json"]) for record in order_records]
+    app.logger.info(f"批量打印请求：{len(order_records)} 个订单。")
+
+    # 各店铺的打印路由可能不同，按店铺分组分别合并打印
+    results = [{} for _ in orders_data]
+    indices_by_shop = {}
+    for i, order_data in enumerate(orders_data):
+        indices_by_shop.setdefault(shop_registry.for_order(order_data).key, []).append(i)
+    for shop_key, indices in indices_by_shop.items():
+        shop_results = dispatch_batch_to_targets([orders_data[i] for i in indices], targets_by_shop[shop_key],
+                                                 dispatch_print_batch_to_target,
+                                                 executor=shop_registry.by_key(shop_key).print_executor,
+                                                 db_ids=[order_records[i]["id"] for i in indices])
+        for i, result in zip(indices, shop_results):
+            results[i] = result
+
+    statuses = {record["id"]: summarize_status(result) for record, result in zip(order_records, results)}
+    update_orders_status(statuses, keep_fulfilled=True)  # 重打已出餐的订单不改变其状态
+
+    found_ids = set(statuses)
+    summary = [{"id": record["id"], "order_id": record["order_id"], "success": statuses[record["id"]] == "已打印",
+                "status": statuses[record["id"]], "targets": result}
+               for record, result in zip(order_records, results)]
+    summary += [{"id": db_id, "order_id": None, "success": False, "status": "订单未找到"}
+                for db_id in db_ids if db_id not in found_ids]
+    printed = sum(1 for item in summary if item["success"])
+
+    if not request.is_json:
+        return redirect(url_for('index'))
+    return jsonify({"status": "success", "requested": len(db_ids), "printed": printed,
+                    "failed": len(summary) - printed, "results": summary}), 200
+
+
+@app.route("/orders/bulk-status", methods=["POST"])
+def bulk_status_route():
+    """批量修改订单状态。请求体: {"ids": [...]} 或 {"filter": {...}}，以及 "status"。"""
+    payload = request.get_json() or {}
+    status = payload.get("status")
+    if not status:
+        return jsonify({"status": "fail", "msg": "Missing status"}), 400
+    try:
+        db_ids = _parse_bulk_selection(payload)
+    except (TypeError, ValueError) as e:
+        return jsonify({"status": "fail", "msg": str(e)}), 400
+    update_orders_status({db_id: status for db_id in db_ids})
+    return jsonify({"status": "success", "updated": len(db_ids)}), 200
+
+
+@app.route("/orders/<int:order_db_id>/fulfill", methods=["POST"])
+def fulfill_order_route(order_db_id):
+    """厨房出餐：标记订单已完成，从备餐汇总中移出。"""
+    if not find_order_by_db_id(order_db_id):
+        return jsonify({"status": "fail", "msg": "Order not found"}), 404
+    update_order(order_db_id, FULFILLED_STATUS)
+    if not request.is_json:
+        return redirect(url_for('index'))
+    return jsonify({"status": "success", "order_status": FULFILLED_STATUS}), 200
+
+
+@app.route("/api/printers")
+def printers_api():
+    """打印机清单和健康状态（后台定时刷新的缓存结果）。"""
+    return jsonify(printer_inventory.status()), 200
+
+
+@app.route("/api/kitchen/prep-list")
+def prep_list_api():
+    """备餐汇总：未完成订单中各商品（按规格区分）待制作的数量。"""
+    return jsonify(prep_list.snapshot()), 200
+
+
+@app.route("/kitchen/prep-list/print", methods=["POST"])
+def print_prep_list_route():
+    """
+    将备餐汇总打印到厨房打印机（第一个厨房单目标，未配置时使用默认打印机）。
+    多店铺时由请求参数 shop 指定使用哪个店铺的打印路由，缺省为第一个店铺。
+    """
+    shop = _shop_from_request()
+    if shop is None:
+        return jsonify({"status": "fail", "msg": "Unknown shop"}), 404
+    targets = load_targets(shop.get_setting)
+    kitchen_targets = [target for target in targets if target["template"] == "kitchen"] or targets
+    if not kitchen_targets:
+        return jsonify({"status": "fail", "msg": "未配置打印机"}), 400
+    printer = kitchen_targets[0]["printer"]
+
+    backend = print_backends.get_backend("escpos")
+    data = backend.generate_prep_list_ticket(prep_list.snapshot())
+    try:
+        backend.send_raw(data, printer, doc_name="Prep List")
+    except Exception as e:
+        app.logger.error(f"打印备餐汇总到 {printer} 失败: {e}")
+        return jsonify({"status": "fail", "msg": str(e)}), 500
+    app.logger.info(f"备餐汇总已发送到打印机 {printer}")
+    return jsonify({"status": "success", "printer": printer}), 200
+
+
+@app.route("/api/orders/<string:order_id>")
+def get_order_api(order_id):
+    """按订单号查询订单（包括已归档的订单）。"""
+    order_record = find_order_by_order_id(order_id)
+    if not order_record:
+        return jsonify({"status": "fail", "msg": "Order not found"}), 404
+    return jsonify(order_record), 200
+
+def _shop_from_request():
+    """请求参数 (查询字符串或表单) 中的 shop 对应的店铺，缺省为第一个店铺，未知的 key 返回 None。"""
+    key = request.values.get("shop")
+    return shop_registry.by_key(key) if key else shop_registry.default
+
+
+@app.context_processor
+def inject_shops():
+    return {"shops": list(shop_registry)}
+
+
+# 可以按店铺覆盖的设置项；轮询开关作用于所有店铺，只有全局设置
+SHOP_SETTING_KEYS = ("default_printer", "auto_print_enabled", "print_method", "business_hours", "print_routes")
+
+
+def shop_settings(shop):
+    """店铺级设置页面：各设置项保存为 "设置项@店铺 key"，留空表示沿用全局设置。"""
+    if request.method == "POST":
+        print_routes = (request.form.get("print_routes") or "").strip()
+        try:
+            parse_routes(print_routes)
+        except ValueError as e:
+            return f"保存失败：{e}", 400
+        for key in SHOP_SETTING_KEYS:
+            value = (request.form.get(key) or "").strip() if key != "print_routes" else print_routes
+            set_setting(f"{key}@{shop.key}", value)
+        return redirect(url_for("settings", shop=shop.key))
+    overrides = {key: get_setting(f"{key}@{shop.key}") or "" for key in SHOP_SETTING_KEYS}
+    return render_template("settings.html", shop=shop, overrides=overrides,
+                           defaults={key: get_setting(key) or "" for key in SHOP_SETTING_KEYS},
+                           printers=printer_inventory.printer_names(),
+                           printer_problems={name: printer_inventory.health_problem(name)
+                                             for name in printer_inventory.printer_names()})
+
 
 @app.route("/settings", methods=["GET", "POST"])
 def settings():
+    if request.values.get("shop"):
+        shop = shop_registry.by_key(request.values["shop"])
+        if shop is None:
+            return "店铺不存在", 404
+        return shop_settings(shop)
     if request.method == "POST":
         default_printer = request.form.get("default_printer")
         auto_print_enabled = request.form.get("auto_print_enabled") == 'on'
         polling_enabled = request.form.get("polling_enabled") == 'on'
         print_method = request.form.get("print_method")
+        business_hours = (request.form.get("business_hours") or "").strip()
+        print_routes = (request.form.get("print_routes") or "").strip()
+        try:
+            parse_routes(print_routes)
+        except ValueError as e:
+            return f"保存失败：{e}", 400
 
         set_setting("default_printer", default_printer)
         set_setting("auto_print_enabled", str(auto_print_enabled).lower())
         set_setting("polling_enabled", str(polling_enabled).lower())
         set_setting("print_method", print_method)
+        set_setting("business_hours", business_hours)
+        set_setting("print_routes", print_routes)
 
-        global scheduler_started
-        if polling_enabled and not scheduler_started:
-            scheduler.add_job(func=poll_orders, trigger="interval", hours=1, id='poll_orders_job')
-            if not scheduler.running:
-                scheduler.start()
-            scheduler_started = True
-            app.logger.info("已启动轮询任务。")
-        elif not polling_enabled and scheduler_started:
-            try:
-                scheduler.remove_job('poll_orders_job')
-                scheduler_started = False
-                app.logger.info("已停止轮询任务。")
-            except Exception as e:
-                app.logger.error(f"无法移除轮询任务: {e}")
+        if polling_enabled:
+            start_polling()
+        else:
+            stop_polling()
 
         return redirect(url_for("settings"))
     return render_template("settings.html",
@@ -311,30 +798,30 @@ def settings():
                            auto_print_enabled=get_setting('auto_print_enabled') == 'true',
                            polling_enabled=get_setting('polling_enabled') == 'true',
                            print_method=get_setting('print_method')or 'escpos',
-                           printers=[printer[2] for printer in win32print.EnumPrinters(2)])
-
-def verify_webhook_signature(request):
-    """验证 Webhook 签名。"""
+                           business_hours=get_setting('business_hours') or '',
+                           print_routes=get_setting('print_routes') or '',
+                           printers=printer_inventory.printer_names(),
+                           printer_problems={name: printer_inventory.health_problem(name)
+                                             for name in printer_inventory.printer_names()})
+
+def verify_webhook_signature(request, shop):
+    """使用店铺的密钥验证 Webhook 签名。"""
     md5_received = request.headers.get('X-AllValue-MD5')
-    shop_domain = request.headers.get('X-AllValue-Shop-Domain')
-
-    if not md5_received or not shop_domain:
-        app.logger.warning("缺少必要的 header: X-AllValue-MD5 或 X-AllValue-Shop-Domain")
+    if not md5_received:
+        app.logger.warning("缺少必要的 header: X-AllValue-MD5")
+        return False
+    if not shop.webhook_secret:
+        app.logger.warning(f"店铺 {shop.key} 未配置 Webhook 密钥。")
         return False
 
     message = request.get_data()
-    data_to_hash = f"{message.decode('utf-8')}{ALLVALUE_WEBHOOK_SECRET}"
+    data_to_hash = f"{message.decode('utf-8')}{shop.webhook_secret}"
     md5_calculated = hashlib.md5(data_to_hash.encode('utf-8')).hexdigest()
 
     if md5_calculated != md5_received:
         app.logger.warning(f"Invalid webhook signature. Calculated: {md5_calculated}, Received: {md5_received}")
         return False
 
-    # 验证 shop_domain
-    if shop_domain != f"{shop}.myallvalue.com":
-        app.logger.warning(f"Invalid shop domain. Received: {shop_domain}")
-        return False
-
     return True
 
 class OrderProcessingError(Exception):
@@ -418,16 +905,13 @@ def get_default_printer():
     return get_setting('default_printer') or ''
 
 
-def fetch_order_details(access_token, nodeId):
-    """从 AllValue API 获取订单详细信息。"""
+def fetch_order_details(nodeId, priority=PRIORITY_LIVE, shop=None):
+    """从 AllValue API 获取订单详细信息。shop 默认为第一个店铺。"""
+    shop = shop or shop_registry.default
     if not nodeId:
         app.logger.error("order_node_id is None or empty")
         raise OrderProcessingError("order_node_id is None or empty")
 
-    headers = {
-        "Custom-AllValue-Access-Token": access_token
-    }
-
     # 修正后的 GraphQL 查询语句
     gql_query = """
     query OrderDetails($nodeId: NodeID!) {
@@ -477,17 +961,11 @@ def fetch_order_details(access_token, nodeId):
         "nodeId": nodeId
     }
 
-    payload = {
-        "query": gql_query,
-        "variables": variables
-    }
-
-    app.logger.debug(f"Sending GraphQL query for order details with payload: {payload}")
+    app.logger.debug(f"Sending GraphQL query for order details with variables: {variables}")
 
     try:
-        resp = requests.post(ALLVALUE_GRAPHQL_ENDPOINT, headers=headers, json=payload, timeout=10)
-        resp.raise_for_status()
-        data = resp.json()
+        data = post_graphql(shop.endpoint, gql_query, variables, priority=priority,
+                            tokens=shop.token_provider, limiter=shop.api_limiter)
 
         if "errors" in data:
             app.logger.error(f"GraphQL Error: {data['errors']}")
@@ -495,58 +973,108 @@ def fetch_order_details(access_token, nodeId):
 
         return data["data"]["order"]
 
+    except TokenUnavailableError as e:
+        app.logger.error(f"无法获取 AllValue 访问令牌: {e}")
+        raise OrderProcessingError(f"无法获取 AllValue 访问令牌: {e}")
     except requests.exceptions.RequestException as e:
         app.logger.error(f"fetch_order_details error: {e}")
         raise OrderProcessingError(f"fetch_order_details error: {e}")
 
 
-def persist_order_data(order_data):
-    """将订单数据持久化到数据库"""
+def persist_order_data(order_data, status=NEW_ORDER_STATUS):
+    """将订单数据持久化到数据库；status 为 None 时保留已有订单的状态。"""
     if not order_data:
         raise OrderProcessingError("order_data is None")
-    order_id = insert_or_update_order(order_data)
+    order_id = insert_or_update_order(order_data, status)
     if not order_id:
         raise OrderProcessingError("insert_or_update_order failed")
     return order_id
 
 
 def print_order_if_enabled(order_data, db_order_id_to_update, should_print=True):
-    if get_setting('auto_print_enabled') == 'true' and should_print:
-        printer_name_setting = get_default_printer()  # 从设置中获取打印机名称
-        print_method_setting = get_setting('print_method')  # 从设置中获取打印方法
+    shop = shop_registry.for_order(order_data)
+    if shop.get_setting('auto_print_enabled') == 'true' and should_print:
+        targets = load_targets(shop.get_setting)  # 店铺的打印路由，未配置时为默认打印机
 
-        if not printer_name_setting:
+        if not targets:
             app.logger.warning(f"自动打印订单 {order_data.get('order_id')} 失败：打印机名称未在设置中配置。")
             update_order(db_order_id_to_update, "打印失败 (未配置打印机)")  # 更新状态
+            print_retry.record_failure(db_order_id_to_update, {"name": "default", "printer": None},
+                                       print_retry.ERROR_NO_PRINTER, "未配置打印机")
             return False
 
-        app.logger.info(f"自动打印已启用。尝试为订单 {order_data.get('order_id')} 调用 dispatch_print_job。")
-        success = dispatch_print_job(order_data, printer_name_setting, print_method_setting)
+        app.logger.info(f"自动打印已启用。将订单 {order_data.get('order_id')} 分发到 {len(targets)} 个打印目标。")
+        print_func = functools.partial(print_to_target, db_id=db_order_id_to_update)  # 失败的目标自动重试
+        results = dispatch_to_targets(ensure_shop_name(order_data), targets, print_func, executor=shop.print_executor)
 
-        # 基于 dispatch_print_job 的结果更新数据库状态
-        if success:
-            update_order(db_order_id_to_update, "已打印")
-        else:
-            update_order(db_order_id_to_update, "打印失败")
-        return success
+        # 基于各打印目标的结果更新数据库状态；重试结束后会再次更新
+        status = summarize_status(results)
+        update_order(db_order_id_to_update, status)
+        return status == "已打印"
 
     app.logger.info(f"订单 {order_data.get('order_id')}：自动打印未启用或本次无需打印。")
     update_order(db_order_id_to_update, "未打印 (自动打印禁用或无需)")  # 更新状态
     return None
 
 
-def process_order_webhook(order_node_id, should_print=True):
-    """处理订单 Webhook 的主逻辑。"""
-    db_order_id = None  # 用于存储数据库中的订单ID
+@inflight.track("order")
+def process_order_webhook(order_node_id, should_print=True, priority=PRIORITY_LIVE, raw_order_data=None, shop=None,
+                          order_name=None):
+    """
+    处理订单 Webhook 的主逻辑。补单时传入 PRIORITY_BACKFILL，API 请求会给实时 Webhook 让行；
+    已预取订单详情时通过 raw_order_data 传入，不再重复请求。shop 默认为第一个店铺。
+
+    多个实例共用数据库时，先获得该订单的租约，同一订单只由一个实例入库和打印，其他实例正在处理时
+    直接返回 True。补单时传入 order_name，获得租约后如果订单已被其他实例入库则跳过。
+    租约只防止并发处理；订单是否已处理过由共享数据库中的记录判断（见 already_handled），
+    重发的 Webhook 和 orders/updated 只更新订单内容，不会再次自动打印。
+    """
+    shop = shop or shop_registry.default
     try:
-        access_token = get_allvalue_access_token()
-        if not access_token:
-            app.logger.error("无法获取Access Token，处理 Webhook 失败。")
-            # 这里可能需要一个机制来处理 db_order_id 未知的情况，或不更新状态
-            return False  # 直接返回失败
+        with log_context(order_id=order_name or order_node_id, stage="backfill" if order_name else "webhook",
+                         shop=shop.key), lease_manager.claim(f"order:{shop.key}:{order_node_id}") as claimed:
+            if not claimed:
+                app.logger.info(f"订单 {order_node_id} 正由其他实例处理，本实例跳过。")
+                return True
+            if order_name and order_exists(shop.order_id(order_name)):
+                app.logger.info(f"订单 {order_name} 已由其他实例入库，跳过。")
+                return True
+            return _process_order(order_node_id, should_print, priority, raw_order_data, shop)
+    except sqlite3.Error as e:
+        app.logger.error(f"获取订单 {order_node_id} 的租约失败: {e}")
+        return False
 
-        raw_order_data = fetch_order_details(access_token, order_node_id)
+
+def already_handled(state):
+    """
+    已入库的订单是否已被某个实例处理过：状态已离开入库时的初始状态（已打印、打印失败、自动打印禁用等），
+    或已有打印记录（打印后、更新状态前崩溃）。入库后、打印前崩溃的订单仍会在重发时打印。
+    """
+    return state["status"] != NEW_ORDER_STATUS or print_retry.has_print_history(state["id"])
+
+
+def _process_order(order_node_id, should_print, priority, raw_order_data, shop):
+    db_order_id = None  # 用于存储数据库中的订单ID
+    try:
+        if raw_order_data is None:
+            # 令牌由店铺的 token_provider 缓存，失效时自动刷新
+            raw_order_data = fetch_order_details(order_node_id, priority, shop=shop)
         order_data_parsed = parse_order_data(raw_order_data)  # 重命名以区分
+        # 标记订单所属店铺；订单号加上店铺前缀，避免不同店铺的订单号冲突
+        order_data_parsed["order_id"] = shop.order_id(order_data_parsed.get("order_id"))
+        update_log_context(order_id=order_data_parsed["order_id"])
+        order_data_parsed["shop_key"] = shop.key
+        order_data_parsed["shop_name"] = shop.name
+
+        state = get_order_state(order_data_parsed["order_id"])
+        if state and state["archived"]:
+            app.logger.info(f"订单 {order_data_parsed['order_id']} 已归档，跳过。")
+            return True
+        if state and already_handled(state):
+            # 重发或更新的 Webhook：更新订单内容，保留状态，不再自动打印（需要时可手动重打）
+            persist_order_data(order_data_parsed, status=None)
+            app.logger.info(f"订单 {order_data_parsed['order_id']} 已处理过（{state['status']}），只更新订单内容。")
+            return True
 
         # 先持久化订单，获取数据库中的ID
         db_order_id = persist_order_data(order_data_parsed)  # 这个ID用于更新状态
@@ -554,6 +1082,11 @@ def process_order_webhook(order_node_id, should_print=True):
             app.logger.error(f"持久化订单 {order_data_parsed.get('order_id')} 失败。")
             return False  # 持久化失败，则不继续打印
 
+        # 后台预渲染各打印目标的小票，首次自动打印直接使用缓存。缓存只用一次，
+        # 补单 (should_print=False) 和未启用自动打印的订单没有人会取用，不预渲染
+        if should_print and shop.get_setting('auto_print_enabled') == 'true':
+            prerender_order(order_data_parsed)
+
         # 调用 print_order_if_enabled，它内部会根据结果更新数据库状态
         # print_order_if_enabled 现在返回 True(成功发送), False(发送失败), None(未尝试)
         print_attempt_result = print_order_if_enabled(order_data_parsed, db_order_id, should_print)
@@ -578,46 +1111,220 @@ def process_order_webhook(order_node_id, should_print=True):
         return False
 
 
-def dispatch_print_job(order_data_for_printing, printer_name_from_settings, print_method_from_settings):
+def ensure_shop_name(order_data):
+    """补充模板需要的店铺名。应在分发到多个打印线程之前调用，避免并发修改同一个字典。"""
+    if 'shop_name' not in order_data:
+        order_data['shop_name'] = shop_registry.for_order(order_data).name  # 旧订单没有记录店铺名
+    return order_data
+
+
+def render_cached(backend, order_data, method, template):
+    """优先使用入库时预渲染的小票字节（只用一次），否则在打印时渲染，保证打印时间准确。"""
+    key = make_key(order_data, method, template, backend.template_version(template))
+    return receipt_cache.take_or_render(key, lambda: backend.render(order_data, template))
+
+
+def prerender_order(order_data):
+    """即将自动打印的订单入库后，在后台为每个打印目标渲染小票并放入缓存。"""
+    ensure_shop_name(order_data)
+    for target in load_targets(shop_registry.for_order(order_data).get_setting):
+        subset = select_items(order_data, target)
+        if subset is None:
+            continue
+        try:
+            backend = print_backends.get_backend(target["method"])
+        except (KeyError, ImportError):
+            continue
+        if not hasattr(backend, 'render'):
+            continue
+        key = make_key(subset, target["method"], target["template"], backend.template_version(target["template"]))
+        receipt_cache.prerender(key, lambda b=backend, o=subset, t=target["template"]: b.render(o, t))
+
+
+@inflight.track("print")
+def attempt_print_job(order_data_for_printing, printer_name_from_settings, print_method_from_settings,
+                      template="receipt"):
     """
-    根据打印方法设置，分发打印任务到相应的打印助手。
+    根据打印方法设置，分发打印任务到相应的打印助手，返回 (是否成功, 错误类别, 错误信息)。
+    打印机名称直接传给后端，不修改系统默认打印机，因此多个目标可以并行打印。
+    支持预渲染的后端优先发送缓存中的小票字节。
     """
-    success = False
+    # 打印在线程池中执行，不继承调用方的日志上下文
+    with log_context(order_id=order_data_for_printing.get('order_id'), stage="print",
+                     shop=order_data_for_printing.get('shop_key')):
+        return _attempt_print_job(order_data_for_printing, printer_name_from_settings, print_method_from_settings,
+                                  template)
+
+
+def _attempt_print_job(order_data_for_printing, printer_name_from_settings, print_method_from_settings, template):
     actual_print_method = print_method_from_settings or 'escpos' # 默认使用escpos
+    ensure_shop_name(order_data_for_printing)
+
+    try:
+        backend = print_backends.get_backend(actual_print_method)
+    except KeyError:
+        app.logger.error(f"未知的打印方式 '{actual_print_method}'。")
+        return False, print_retry.ERROR_CONFIG, f"未知的打印方式 {actual_print_method}"
+    except ImportError as e:
+        app.logger.error(f"加载打印后端 '{actual_print_method}' 失败: {e}")
+        return False, print_retry.ERROR_CONFIG, f"加载打印后端失败: {e}"
+
+    order_id = order_data_for_printing.get('order_id')
+    problem = printer_inventory.wait_until_healthy(printer_name_from_settings)
+    if problem:
+        app.logger.error(f"打印机 '{printer_name_from_settings}' 不可用 ({problem})，跳过订单 {order_id} 的{template}。")
+        return False, print_retry.ERROR_PRINTER_UNAVAILABLE, problem
+    app.logger.info(f"分发任务：使用{actual_print_method}打印助手将订单 {order_id} "
+                    f"的{template}发送到 '{printer_name_from_settings or '默认打印机'}'")
+    try:
+        if not hasattr(backend, 'render'):
+            ok = backend.print_order(order_data_for_printing, printer_name=printer_name_from_settings,
+                                     template=template)
+        else:
+            data = render_cached(backend, order_data_for_printing, actual_print_method, template)
+            if not data:
+                app.logger.error(f"订单 {order_id} 的{template}渲染失败。")
+                return False, print_retry.ERROR_RENDER, "小票渲染失败"
+            ok = backend.print_rendered(data, printer_name_from_settings, order_id)
+    except Exception as e:
+        app.logger.exception(f"发送订单 {order_id} 的{template}到打印机时出错: {e}")
+        return False, print_retry.ERROR_SPOOL, str(e)
+    if not ok:
+        return False, print_retry.ERROR_SPOOL, "发送到打印队列失败"
+    return True, None, None
+
+
+def dispatch_print_job(order_data_for_printing, printer_name_from_settings, print_method_from_settings,
+                       template="receipt"):
+    """打印一次，只返回是否成功，不安排重试。"""
+    ok, _, _ = attempt_print_job(order_data_for_printing, printer_name_from_settings, print_method_from_settings,
+                                 template)
+    return ok
+
+
+def attempt_print_to_target(order_data, target):
+    return attempt_print_job(order_data, target["printer"], target["method"], target["template"])
+
+
+def print_to_target(order_data, target, db_id=None):
+    """
+    打印路由的单个目标。传入订单的数据库 ID 时，失败的打印交给重试队列，
+    成功时结束该目标之前的待重试作业（没有时记录为已完成），供重试结束后汇总订单状态。
+    """
+    ok, error_class, message = attempt_print_to_target(order_data, target)
+    if db_id is not None:
+        if ok:
+            print_retry.record_success(db_id, target)
+        else:
+            print_retry.record_failure(db_id, target, error_class, message)
+    return ok
+
+
+def _load_order_for_retry(db_id):
+    record = find_order_by_db_id(db_id)
+    return ensure_shop_name(record["order_json"]) if record else None
+
+
+def _on_print_retry_finished(db_id):
+    """重试作业结束（成功或放弃）后，根据各目标最近一次的结果更新订单状态。"""
+    results = print_retry.order_print_results(db_id)
+    if results:  # None 表示还有目标在重试中
+        update_order(db_id, summarize_status(results), keep_fulfilled=True)
+
+
+def _attempt_retry(order_data, target):
+    subset = select_items(order_data, target)
+    if subset is None:
+        return True, None, None  # 订单内容已变化，该目标不再需要打印
+    return attempt_print_to_target(subset, target)
+
+
+print_retry_queue = print_retry.PrintRetryQueue(_attempt_retry, _load_order_for_retry, _on_print_retry_finished)
+
+
+def _record_batch_result(db_ids, target, ok, error_class=None, message=None):
+    """与 print_to_target 相同，把批量打印的结果记入重试队列：成功时结束待重试作业，失败时安排重试。"""
+    for db_id in db_ids or []:
+        if ok:
+            print_retry.record_success(db_id, target)
+        else:
+            print_retry.record_failure(db_id, target, error_class, message)
+
+
+def dispatch_print_batch_to_target(orders_data, target, db_ids=None):
+    """
+    批量打印到单个目标，返回与 orders_data 一一对应的成功标志列表。
+    支持批量接口的后端 (ESC/POS) 将所有小票合并为一个打印作业；其他后端逐个打印。
+    传入与 orders_data 一一对应的 db_ids 时记录每个订单的打印结果，避免重试队列再次打印已重打成功的订单。
+    """
+    if not orders_data:
+        return []
+    try:
+        backend = print_backends.get_backend(target["method"])
+    except (KeyError, ImportError) as e:
+        app.logger.error(f"加载打印后端 '{target['method']}' 失败: {e}")
+        _record_batch_result(db_ids, target, False, print_retry.ERROR_CONFIG, f"加载打印后端失败: {e}")
+        return [False] * len(orders_data)
+
+    problem = printer_inventory.wait_until_healthy(target["printer"])
+    if problem:
+        app.logger.error(f"打印机 '{target['printer']}' 不可用 ({problem})，跳过 {len(orders_data)} 个订单的批量打印。")
+        _record_batch_result(db_ids, target, False, print_retry.ERROR_PRINTER_UNAVAILABLE, problem)
+        return [False] * len(orders_data)
+
+    if not hasattr(backend, 'print_orders'):
+        return [print_to_target(order_data, target, db_id=db_id)
+                for order_data, db_id in zip(orders_data, db_ids or [None] * len(orders_data))]
+
+    try:
+        with inflight.track("print"):
+            success = backend.print_orders(orders_data, printer_name=target["printer"], template=target["template"])
+    except Exception as e:
+        app.logger.exception(f"批量打印到 '{target['printer']}' 时出错: {e}")
+        _record_batch_result(db_ids, target, False, print_retry.ERROR_SPOOL, str(e))
+        return [False] * len(orders_data)
+    _record_batch_result(db_ids, target, bool(success), print_retry.ERROR_SPOOL, "发送到打印队列失败")
+    return [success] * len(orders_data)
+
+def shutdown_app(drain_timeout=30):
+    """优雅退出：停止轮询和心跳，等待进行中的订单和打印任务完成，最后写入同步水位和心跳。只执行一次，重复调用返回 None。"""
+    global shutdown_started
+    if shutdown_started:
+        return None
+    shutdown_started = True
+    inflight.draining = True
+    leading = [shop for shop in shop_registry if lease_manager.holds(ingest_lease(shop))]
+    if scheduler.running:
+        app.logger.info("正在停止轮询任务...")
+        scheduler.shutdown(wait=True)  # 等待正在执行的轮询结束
+
+    pending = inflight.snapshot()
+    if pending:
+        app.logger.info(f"等待进行中的任务完成: {pending}")
+    if not inflight.wait_idle(drain_timeout):
+        # 不推进水位，让下次启动时的补单覆盖这些未完成的订单
+        app.logger.warning(f"等待 {drain_timeout} 秒后仍有未完成的任务: {inflight.snapshot()}，本次不更新退出时间。")
+        return False
+
+    for shop in leading:  # 热备的店铺没有轮询，不推进水位
+        shop.uptime_store.mark_stopped()
+    lease_manager.release_all()  # 其他实例无需等待租约过期即可接管
+    app.logger.info("已记录退出时间，应用已安全停止。")
+    return True
 
-    # 确保 shop_name 存在于 order_data 中 (见下方关于问题3的讨论)
-    # 如果决定由 app.py 统一添加 shop_name:
-    if 'shop_name' not in order_data_for_printing:
-        order_data_for_printing['shop_name'] = shop # 使用 app.py 中的全局 shop 变量
-
-    if actual_print_method == 'pdf':
-        app.logger.info(f"分发任务：使用PDF打印助手处理订单 {order_data_for_printing.get('order_id')}")
-        success = print_helper_pdf.print_order(
-            order_data_for_printing,
-            printer_name=printer_name_from_settings
-        )
-    else: # 'escpos'
-        app.logger.info(f"分发任务：使用ESC/POS打印助手处理订单 {order_data_for_printing.get('order_id')}")
-        if printer_name_from_settings:
-            try:
-                win32print.SetDefaultPrinter(printer_name_from_settings)
-            except Exception as e:
-                app.logger.error(f"设置默认打印机 '{printer_name_from_settings}' 失败: {e}")
-                return False # 无法设置默认打印机，打印可能失败
-
-        success = print_helper.print_order(order_data_for_printing)
-
-    return success
 
 @app.route('/webhook', methods=['POST'])
 def handle_webhook():
-    polling_enabled = get_setting('polling_enabled') == 'true'
-    if polling_enabled:
-        app.logger.info("轮询已启用，忽略 Webhook 请求。")
-        return jsonify({"status": "ignored", "msg": "Polling is enabled, Webhook ignored."}), 200
-
-    if not verify_webhook_signature(request):
+    # 轮询只作为兜底：Webhook 始终处理，轮询会跳过已入库的订单
+    shop_domain = request.headers.get('X-AllValue-Shop-Domain')
+    shop = shop_registry.by_domain(shop_domain)
+    if shop is None:
+        app.logger.warning(f"Unknown shop domain. Received: {shop_domain}")
+        abort(401)
+    if not verify_webhook_signature(request, shop):
+        shop.webhook_health.record_signature_failure()
         abort(401)
+    shop.webhook_health.record_delivery()
 
     data = request.get_json()
     if not data:
@@ -631,9 +1338,21 @@ def handle_webhook():
             app.logger.error("Webhook data does not contain nodeId")
             return jsonify({"status": "fail", "msg": "Webhook data does not contain nodeId"}), 400
 
-        if process_order_webhook(order_node_id):
+        # 各店铺独立的处理名额，已满时快速拒绝，让 AllValue 稍后重发，而不是占着连接等待
+        try:
+            with shop.webhook_admission.admit():
+                processed = process_order_webhook(order_node_id, shop=shop)
+        except Overloaded as e:
+            shop.uptime_store.hold(datetime.datetime.utcnow())  # 如果 AllValue 不再重发，下次启动时补单
+            response = jsonify({"status": "fail", "msg": f"Server busy ({e.reason})"})
+            response.headers["Retry-After"] = str(e.retry_after)
+            return response, e.status
+
+        if processed:
             return jsonify({"status": "success"}), 200
         else:
+            # 心跳不再越过这个时间，即使没有启用轮询，下次启动时的补单也会拉取该订单
+            shop.uptime_store.hold(datetime.datetime.utcnow())
             return jsonify({"status": "fail", "msg": "Failed to process order webhook"}), 500
     else:
         app.logger.warning(f"Received webhook with unknown topic: {topic}")
@@ -641,4 +1360,7 @@ def handle_webhook():
 
 
 if __name__ == "__main__":
+    # debug 模式下由重载器启动的子进程负责提供服务，只在子进程中初始化
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        bootstrap_app()
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,215 @@
+# bench_receipts.py
+"""
+小票渲染基准测试。
+
+覆盖 print_helper.generate_print_text、print_helper_pdf.generate_receipt_html
+和 print_helper_pdf.generate_pdf_from_html_content，在 1~200 个商品行的合成订单上
+记录每次渲染的耗时与内存峰值，并与保存的基线比较，超过阈值即判定为退化。
+
+用法:
+    python bench_receipts.py                     # 与基线比较，退化时返回码为 1
+    python bench_receipts.py --update-baseline   # 以本次结果覆盖基线
+    python bench_receipts.py --sizes 1 50 200 --repeat 5 --threshold 1.3
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+BASELINE_FILE = "bench_baselines.json"
+DEFAULT_SIZES = [1, 5, 20, 50, 100, 200]
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 1.5  # 耗时或内存峰值超过基线的 1.5 倍视为退化
+
+# 较长的中文商品名和规格值，用于覆盖自动换行和多字节编码的开销
+CJK_ITEM_NAMES = [
+    "招牌秘制红烧牛肉面（大碗加量版）配手工拉面与特制辣椒油",
+    "四川麻辣香锅双人套餐含虾滑肥牛午餐肉土豆片藕片宽粉",
+    "广式蜜汁叉烧双拼烧鹅饭配例汤及时令青菜一份",
+    "手打柠檬鸭屎香柠檬茶少冰三分糖加珍珠加椰果",
+]
+CJK_OPTION_VALUES = [
+    "微辣（可根据口味调整辣度）",
+    "不要香菜不要葱花多放蒜末",
+    "加一份卤蛋和一份豆腐皮",
+    "打包带走需要一次性餐具两套",
+]
+
+
+def build_sample_order(item_count):
+    """构造包含 item_count 个商品行的合成订单，字段结构与 parse_order_data 的输出一致。"""
+    line_items = []
+    for i in range(item_count):
+        line_items.append({
+            "name": f"{CJK_ITEM_NAMES[i % len(CJK_ITEM_NAMES)]}·{i + 1}号",
+            "quantity": (i % 3) + 1,
+            "option_values": CJK_OPTION_VALUES[:(i % len(CJK_OPTION_VALUES)) + 1],
+        })
+
+    return {
+        "shop_name": "一品滋味（基准测试）",
+        "order_id": f"BENCH{item_count:04d}",
+        "created_at": datetime.datetime(2024, 1, 1, 12, 0, 0).isoformat(),
+        "contact_email": "bench@example.com",
+        "customer_message": "请尽快送达，到楼下请打电话，谢谢！" * 3,
+        "shipping_address": {
+            "address1": "广东省深圳市南山区科技园南区高新南一道创维大厦A座",
+            "address2": "十八楼一八零八室前台代收",
+            "zip": "518057",
+            "countryCode": "CN",
+            "firstName": "张",
+            "lastName": "伟",
+            "phone": "13812345678",
+        },
+        "line_items": line_items,
+        "total_price": {"amount": f"{item_count * 38.5:.2f}", "currency_code": "CNY"},
+        "customer_info": {"firstName": "张", "lastName": "伟", "phone": "13812345678"},
+    }
+
+
+def measure(func, repeat):
+    """多次调用 func，返回耗时中位数(毫秒)和内存峰值(KiB)。
+
+    tracemalloc 本身会拖慢执行，因此计时和内存测量分开进行。
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        durations.append((time.perf_counter() - start) * 1000)
+        if result is None or result is False:
+            raise RuntimeError("渲染函数返回失败结果")
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return statistics.median(durations), peak / 1024
+
+
+def build_cases():
+    """返回 {用例名: 以订单为参数的渲染函数}。导入失败的渲染后端会被跳过。"""
+    cases = {}
+    try:
+        import print_helper
+        cases["escpos_text"] = print_helper.generate_print_text
+    except ImportError as e:
+        logger.warning(f"无法导入 print_helper，跳过 ESC/POS 基准: {e}")
+
+    try:
+        import print_helper_pdf
+    except ImportError as e:
+        logger.warning(f"无法导入 print_helper_pdf，跳过 HTML/PDF 基准: {e}")
+        return cases
+
+    cases["receipt_html"] = print_helper_pdf.generate_receipt_html
+
+    if print_helper_pdf.WEASYPRINT_AVAILABLE:
+        def render_pdf(order_data):
+            html_content = print_helper_pdf.generate_receipt_html(order_data)
+            fd, pdf_filepath = tempfile.mkstemp(suffix=".pdf", prefix="bench_")
+            os.close(fd)
+            try:
+                return print_helper_pdf.generate_pdf_from_html_content(html_content, pdf_filepath)
+            finally:
+                os.unlink(pdf_filepath)
+
+        cases["receipt_pdf"] = render_pdf
+    else:
+        logger.warning("WeasyPrint 不可用，跳过 PDF 基准。")
+    return cases
+
+
+def run_benchmarks(sizes, repeat):
+    """执行所有用例，返回 {"用例名/商品行数": {"ms": ..., "peak_kib": ...}}。"""
+    results = {}
+    for case_name, render in build_cases().items():
+        for size in sizes:
+            order_data = build_sample_order(size)
+            render(order_data)  # 预热：模板编译、字体加载等一次性开销不计入结果
+            ms, peak_kib = measure(lambda: render(order_data), repeat)
+            key = f"{case_name}/{size}"
+            results[key] = {"ms": round(ms, 3), "peak_kib": round(peak_kib, 1)}
+            logger.info(f"{key:<20} {ms:10.2f} ms {peak_kib:10.1f} KiB")
+    return results
+
+
+def load_baselines(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (json.JSONDecodeError, IOError) as e:
+        logger.error(f"读取基线文件 {path} 失败: {e}")
+        return {}
+
+
+def save_baselines(path, results):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=4, sort_keys=True)
+    logger.info(f"基线已写入 {path}")
+
+
+def compare_with_baselines(results, baselines, threshold):
+    """返回退化用例列表，每项为 (用例, 指标, 基线值, 当前值)。"""
+    regressions = []
+    for key, current in results.items():
+        baseline = baselines.get(key)
+        if not baseline:
+            logger.info(f"{key}: 无基线，跳过比较。")
+            continue
+        for metric in ("ms", "peak_kib"):
+            base_value = baseline.get(metric)
+            if not base_value:
+                continue
+            ratio = current[metric] / base_value
+            if ratio > threshold:
+                regressions.append((key, metric, base_value, current[metric]))
+                logger.error(f"{key} {metric} 退化: 基线 {base_value}，当前 {current[metric]} ({ratio:.2f}x)")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="小票渲染基准测试")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="商品行数列表")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="每个用例的重复次数")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="相对基线的退化阈值倍数")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="基线文件路径")
+    parser.add_argument("--update-baseline", action="store_true", help="以本次结果覆盖基线")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    # WeasyPrint 的布局日志会严重干扰计时
+    logging.getLogger('weasyprint').setLevel(logging.WARNING)
+
+    results = run_benchmarks(args.sizes, args.repeat)
+    if not results:
+        logger.error("没有可运行的基准用例。")
+        return 2
+
+    if args.update_baseline:
+        save_baselines(args.baseline, results)
+        return 0
+
+    regressions = compare_with_baselines(results, load_baselines(args.baseline), args.threshold)
+    if regressions:
+        logger.error(f"共 {len(regressions)} 项超过阈值 {args.threshold}x，基准测试未通过。")
+        return 1
+    logger.info("基准测试通过。")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,15 @@
 import datetime
 import os
 import sqlite3
-import json
 import logging
 
+import order_search
+from kitchen_prep import FULFILLED_STATUSES, prep_list
+import sales_stats
+from order_codec import encode_order, decode_order
+
 DB_NAME = 'orders.db'
+NEW_ORDER_STATUS = '未打印'  # 刚入库、尚未决定是否打印的订单状态
 logger = logging.getLogger(__name__)
 
 def get_db_connection():
@@ -44,6 +49,18 @@ def init_db():
             cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('default_printer', '')")
             cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('auto_print_enabled', 'false')")
             cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('polling_enabled', 'false')")
+            cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('business_hours', '')")
+            cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('retention_days', '90')")
+            # 订单全文检索索引；已有订单但索引为空时（首次升级）补建索引
+            if order_search.create_search_index(conn):
+                indexed = cursor.execute(f"SELECT count(*) FROM {order_search.FTS_TABLE}").fetchone()[0]
+                if not indexed and cursor.execute("SELECT 1 FROM orders LIMIT 1").fetchone():
+                    rebuild_search_index(conn)
+            # 销售统计汇总表；已有订单但汇总为空时（首次升级）根据订单重建
+            sales_stats.create_tables(conn)
+            if (not cursor.execute("SELECT 1 FROM sales_hourly LIMIT 1").fetchone()
+                    and cursor.execute("SELECT 1 FROM orders LIMIT 1").fetchone()):
+                sales_stats.rebuild(conn, decode_order)
             #cursor.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('print_method', 'text')")
             conn.commit()
 
@@ -65,8 +82,8 @@ def set_setting(key, value):
             cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
             conn.commit()
 
-def insert_or_update_order(order_data):
-    """插入或更新订单。"""
+def insert_or_update_order(order_data, status=NEW_ORDER_STATUS):
+    """插入或更新订单。status 为 None 时更新已有订单的内容但保留其状态。"""
     with get_db_connection() as conn:
         if conn:
             cursor = conn.cursor()
@@ -76,28 +93,103 @@ def insert_or_update_order(order_data):
                 return None
 
             # 检查订单是否已存在
-            existing_order = cursor.execute("SELECT id FROM orders WHERE order_id = ?", (order_id,)).fetchone()
-            order_json_str = json.dumps(order_data, ensure_ascii=False)
+            existing_order = cursor.execute("SELECT id, order_json, status FROM orders WHERE order_id = ?",
+                                            (order_id,)).fetchone()
+            order_blob = encode_order(order_data)
 
             if existing_order:
                 # 更新现有订单
+                if status is None:
+                    status = existing_order["status"]
                 cursor.execute("UPDATE orders SET order_json=?, status=? WHERE order_id=?",
-                               (order_json_str, "未打印", order_id)) # 使用 order_id 更新
+                               (order_blob, status, order_id)) # 使用 order_id 更新
+                order_search.index_order(conn, existing_order["id"], order_data)
+                sales_stats.replace_order(conn, _decode_or_none(existing_order["order_json"]), order_data)
+                conn.commit()
+                prep_list.record_order(existing_order["id"], order_data, status)
                 logger.info(f"更新订单 {order_id}。")
                 return existing_order["id"]
             else:
                 # 插入新订单
+                status = status or NEW_ORDER_STATUS
                 cursor.execute("INSERT INTO orders (order_id, order_json, status) VALUES (?, ?, ?)",
-                               (order_id, order_json_str, "未打印"))
+                               (order_id, order_blob, status))
+                order_search.index_order(conn, cursor.lastrowid, order_data)
+                sales_stats.apply_order(conn, order_data)
                 conn.commit()
+                prep_list.record_order(cursor.lastrowid, order_data, status)
                 logger.info(f"插入新订单 {order_id}。")
                 return cursor.lastrowid
     return None
 
+def _decode_or_none(order_blob):
+    """解码旧的订单内容用于扣除统计；无法解析时返回 None（只计入新内容）。"""
+    try:
+        return decode_order(order_blob)
+    except ValueError:
+        return None
+
+def _archived_db_id(conn, order_id):
+    """已归档订单（主库中只剩 order_summaries 摘要）的原数据库 ID，未归档时返回 None。"""
+    try:
+        row = conn.execute("SELECT db_id FROM order_summaries WHERE order_id = ?", (order_id,)).fetchone()
+    except sqlite3.OperationalError:  # 尚未创建归档摘要表
+        return None
+    return row["db_id"] if row else None
+
+def _update_archived_status(conn, status_by_db_id):
+    """主库中找不到的订单可能已归档：同步更新摘要和归档库中的状态。"""
+    try:
+        conn.executemany("UPDATE order_summaries SET status=? WHERE db_id=?",
+                         [(status, db_id) for db_id, status in status_by_db_id.items()])
+    except sqlite3.OperationalError:
+        return
+    from retention import update_archived_status  # retention 依赖本模块，延迟导入避免循环
+    update_archived_status(status_by_db_id)
+
+def order_exists(order_id):
+    """检查指定 order_id（订单 name）的订单是否已入库，包括已归档的订单。"""
+    if not order_id:
+        return False
+    with get_db_connection() as conn:
+        if conn:
+            row = conn.execute("SELECT 1 FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+            return row is not None or _archived_db_id(conn, order_id) is not None
+    return False
+
+def get_order_state(order_id):
+    """订单的 {"id", "status", "archived"}，包括已归档的订单；未入库时返回 None。"""
+    if not order_id:
+        return None
+    with get_db_connection() as conn:
+        if conn:
+            row = conn.execute("SELECT id, status FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+            if row:
+                return {"id": row["id"], "status": row["status"], "archived": False}
+            try:
+                row = conn.execute("SELECT db_id, status FROM order_summaries WHERE order_id = ?",
+                                   (order_id,)).fetchone()
+            except sqlite3.OperationalError:  # 尚未创建归档摘要表
+                return None
+            if row:
+                return {"id": row["db_id"], "status": row["status"], "archived": True}
+    return None
+
+def _not_fulfilled_clause():
+    """只匹配尚未完成（出餐、完成、取消）的订单的 SQL 条件及其参数。"""
+    return ("".join(" AND COALESCE(status, '') NOT LIKE ?" for _ in FULFILLED_STATUSES),
+            [f"{done}%" for done in FULFILLED_STATUSES])
+
+def _is_main_order(conn, db_id):
+    return conn.execute("SELECT 1 FROM orders WHERE id=?", (db_id,)).fetchone() is not None
+
 # 在 database.py 中
 
-def update_order(db_id, status, other_fields=None): # 1. 参数名从 order_id 改为 db_id，更清晰
-    """更新订单状态和其他字段，基于数据库主键 ID。"""
+def update_order(db_id, status, other_fields=None, keep_fulfilled=False): # 1. 参数名从 order_id 改为 db_id，更清晰
+    """
+    更新订单状态和其他字段，基于数据库主键 ID。
+    keep_fulfilled 为 True 时（打印结果等），已完成的订单保留原状态，重打已出餐的订单不会让它回到备餐汇总。
+    """
     with get_db_connection() as conn:
         if conn:
             cursor = conn.cursor()
@@ -111,9 +203,19 @@ def update_order(db_id, status, other_fields=None): # 1. 参数名从 order_id 
 
             update_query += " WHERE id=?"  # 2. SQL查询条件改为 WHERE id=?
             params.append(db_id)          # 3. 将传入的 db_id 作为参数
+            if keep_fulfilled:
+                clause, clause_params = _not_fulfilled_clause()
+                update_query += clause
+                params += clause_params
 
             cursor.execute(update_query, params)
+            if cursor.rowcount == 0:
+                if keep_fulfilled and _is_main_order(conn, db_id):
+                    logger.info(f"订单记录 ID {db_id} 已完成，保留原状态（不更新为 {status}）。")
+                    return
+                _update_archived_status(conn, {db_id: status})
             conn.commit()
+            prep_list.record_status(db_id, status)
             logger.info(f"更新数据库订单记录 ID {db_id} 的状态为 {status}。")
 
 def get_all_orders():
@@ -126,11 +228,11 @@ def get_all_orders():
             orders = []
             for row in rows:
                 try:
-                    order_json = json.loads(row["order_json"])
+                    order_json = decode_order(row["order_json"])
                     # 确保 order_json 中包含 order_id 字段
                     if "order_id" not in order_json:
                         order_json["order_id"] = row["order_id"]
-                except json.JSONDecodeError:
+                except ValueError:
                     logger.error(f"解析订单 JSON 失败，订单 ID: {row['id']}")
                     order_json = {"order_id": row["order_id"]}  # 至少包含 order_id
                 orders.append({
@@ -153,10 +255,10 @@ def get_order_by_db_id(db_id): # 1. 函数名和参数名修改，表明是通
             row = cursor.fetchone()
             if row:
                 try:
-                    order_json = json.loads(row["order_json"])
+                    order_json = decode_order(row["order_json"])
                     if "order_id" not in order_json:
                         order_json["order_id"] = row["order_id"]
-                except json.JSONDecodeError:
+                except ValueError:
                     logger.error(f"解析订单 JSON 失败，数据库 ID: {row['id']}")
                     order_json = {"order_id": row["order_id"]}
                 return {
@@ -166,4 +268,231 @@ def get_order_by_db_id(db_id): # 1. 函数名和参数名修改，表明是通
                     "status": row["status"],
                     "created_at": row["created_at"], # 从数据库记录中获取创建时间
                 }
-    return None
\ No newline at end of file
+    return None
+
+def rebuild_search_index(conn, batch_size=500):
+    """根据 orders 表重建全文检索索引。"""
+    conn.execute(f"DELETE FROM {order_search.FTS_TABLE}")
+    last_id = 0
+    while True:
+        rows = conn.execute("SELECT id, order_id, order_json FROM orders WHERE id > ? ORDER BY id LIMIT ?",
+                            (last_id, batch_size)).fetchall()
+        if not rows:
+            break
+        for row in rows:
+            try:
+                order_json = decode_order(row["order_json"])
+            except ValueError:
+                order_json = {}
+            order_json.setdefault("order_id", row["order_id"])
+            order_search.index_order(conn, row["id"], order_json)
+        last_id = rows[-1]["id"]
+    conn.commit()
+    logger.info("订单全文检索索引已重建。")
+
+def search_orders(query, page=1, per_page=20):
+    """全文检索订单，返回 (按相关度排序的当前页订单列表, 命中总数)。"""
+    page = max(int(page), 1)
+    with get_db_connection() as conn:
+        if conn:
+            db_ids, total = order_search.search(conn, query, per_page, (page - 1) * per_page)
+            if not db_ids:
+                return [], total
+            placeholders = ",".join("?" * len(db_ids))
+            rows = conn.execute(f"SELECT id, order_id, order_json, status, created_at FROM orders "
+                                f"WHERE id IN ({placeholders})", db_ids).fetchall()
+            by_id = {row["id"]: row for row in rows}
+            orders = []
+            for db_id in db_ids:
+                row = by_id.get(db_id)
+                if not row:
+                    continue
+                try:
+                    order_json = decode_order(row["order_json"])
+                    if "order_id" not in order_json:
+                        order_json["order_id"] = row["order_id"]
+                except ValueError:
+                    logger.error(f"解析订单 JSON 失败，数据库 ID: {row['id']}")
+                    order_json = {"order_id": row["order_id"]}
+                orders.append({
+                    "id": row["id"],
+                    "order_id": row["order_id"],
+                    "order_json": order_json,
+                    "status": row["status"],
+                    "created_at": row["created_at"],
+                })
+            return orders, total
+    return [], 0
+
+def get_orders_by_db_ids(db_ids):
+    """一次查询获取多个订单，按传入的 ID 顺序返回（不存在的 ID 被忽略）。"""
+    if not db_ids:
+        return []
+    with get_db_connection() as conn:
+        if conn:
+            placeholders = ",".join("?" * len(db_ids))
+            rows = conn.execute(f"SELECT id, order_id, order_json, status, created_at FROM orders "
+                                f"WHERE id IN ({placeholders})", list(db_ids)).fetchall()
+            by_id = {row["id"]: row for row in rows}
+            orders = []
+            for db_id in db_ids:
+                row = by_id.get(int(db_id))
+                if not row:
+                    continue
+                try:
+                    order_json = decode_order(row["order_json"])
+                    if "order_id" not in order_json:
+                        order_json["order_id"] = row["order_id"]
+                except ValueError:
+                    logger.error(f"解析订单 JSON 失败，数据库 ID: {row['id']}")
+                    order_json = {"order_id": row["order_id"]}
+                orders.append({
+                    "id": row["id"],
+                    "order_id": row["order_id"],
+                    "order_json": order_json,
+                    "status": row["status"],
+                    "created_at": row["created_at"],
+                })
+            return orders
+    return []
+
+def find_order_db_ids(status_prefix=None, created_date=None):
+    """按状态前缀（如 "打印失败" 可匹配 "打印失败 (未配置打印机)"）和本地日期 (YYYY-MM-DD) 筛选订单 ID。"""
+    query = "SELECT id FROM orders WHERE 1=1"
+    params = []
+    if status_prefix:
+        query += " AND substr(status, 1, ?) = ?"
+        params.extend([len(status_prefix), status_prefix])
+    if created_date:
+        query += " AND date(created_at, 'localtime') = ?"
+        params.append(created_date)
+    query += " ORDER BY id"
+    with get_db_connection() as conn:
+        if conn:
+            return [row["id"] for row in conn.execute(query, params).fetchall()]
+    return []
+
+def update_orders_status(status_by_db_id, keep_fulfilled=False):
+    """
+    在一个事务中批量更新订单状态。status_by_db_id: {数据库 ID: 状态}。
+    keep_fulfilled 与 update_order 相同：已完成的订单保留原状态。
+    """
+    if not status_by_db_id:
+        return
+    clause, clause_params = _not_fulfilled_clause() if keep_fulfilled else ("", [])
+    with get_db_connection() as conn:
+        if conn:
+            archived = {db_id: status for db_id, status in status_by_db_id.items()
+                        if conn.execute("UPDATE orders SET status=? WHERE id=?" + clause,
+                                        [status, db_id] + clause_params).rowcount == 0
+                        and not (keep_fulfilled and _is_main_order(conn, db_id))}
+            if archived:
+                _update_archived_status(conn, archived)
+            conn.commit()
+            for db_id, status in status_by_db_id.items():
+                prep_list.record_status(db_id, status)
+            logger.info(f"批量更新 {len(status_by_db_id)} 个订单的状态。")
+
+def iter_orders(created_from=None, created_before=None, status_prefix=None, batch_size=500):
+    """
+    按数据库 ID 顺序逐行产出订单，内存占用与订单总数无关，供导出使用。
+    created_from / created_before 为 UTC 时间字符串 (YYYY-MM-DD HH:MM:SS)，左闭右开。
+    """
+    query = "SELECT id, order_id, order_json, status, created_at FROM orders WHERE 1=1"
+    params = []
+    if created_from:
+        query += " AND created_at >= ?"
+        params.append(created_from)
+    if created_before:
+        query += " AND created_at < ?"
+        params.append(created_before)
+    if status_prefix:
+        query += " AND substr(status, 1, ?) = ?"
+        params.extend([len(status_prefix), status_prefix])
+    query += " ORDER BY id"
+
+    conn = get_db_connection()
+    if not conn:
+        return
+    try:
+        cursor = conn.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                try:
+                    order_json = decode_order(row["order_json"])
+                except ValueError:
+                    logger.error(f"解析订单 JSON 失败，订单 ID: {row['id']}")
+                    order_json = {"order_id": row["order_id"]}
+                yield {
+                    "id": row["id"],
+                    "order_id": row["order_id"],
+                    "order_json": order_json,
+                    "status": row["status"],
+                    "created_at": row["created_at"],
+                }
+    finally:
+        conn.close()
+
+def upsert_orders(records):
+    """
+    在一个事务中批量写入订单，以 order_id 为键幂等覆盖，返回写入的行数。
+    records: [{"order_id", "order_json"(dict), "status"(可为 None), "created_at"(可为 None)}]
+    已归档的订单跳过，避免重新写回主库。
+    """
+    if not records:
+        return 0
+    with get_db_connection() as conn:
+        if conn:
+            cursor = conn.cursor()
+            imported_ids = []
+            for record in records:
+                if _archived_db_id(conn, record["order_id"]) is not None:
+                    logger.info(f"订单 {record['order_id']} 已归档，跳过导入。")
+                    continue
+                existing = cursor.execute("SELECT order_json FROM orders WHERE order_id = ?",
+                                          (record["order_id"],)).fetchone()
+                # 导入行没有状态或创建时间（单纯的订单字典）时保留已有行的值，新行才使用默认值
+                cursor.execute('''
+                    INSERT INTO orders (order_id, order_json, status, created_at)
+                    VALUES (?, ?, COALESCE(?, '未打印'), COALESCE(?, CURRENT_TIMESTAMP))
+                    ON CONFLICT(order_id) DO UPDATE SET
+                        order_json = excluded.order_json,
+                        status = COALESCE(?, orders.status),
+                        created_at = COALESCE(?, orders.created_at)
+                ''', (record["order_id"], encode_order(record["order_json"]), record.get("status"),
+                      record.get("created_at"), record.get("status"), record.get("created_at")))
+                row = cursor.execute("SELECT id, status FROM orders WHERE order_id = ?",
+                                     (record["order_id"],)).fetchone()
+                db_id = row["id"]
+                order_search.index_order(conn, db_id, record["order_json"])
+                imported_ids.append((db_id, row["status"], record))
+                sales_stats.replace_order(conn, _decode_or_none(existing["order_json"]) if existing else None,
+                                          record["order_json"])
+            conn.commit()
+            for db_id, status, record in imported_ids:
+                prep_list.record_order(db_id, record["order_json"], status)
+            return len(imported_ids)
+    return 0
+
+def get_sales_report(period, start_date, end_date):
+    """按日 / 周 / 月等周期汇总 [start_date, end_date] 的销售数据，见 sales_stats.sales_report。"""
+    with get_db_connection() as conn:
+        if conn:
+            return sales_stats.sales_report(conn, period, start_date, end_date)
+    return None
+
+def load_prep_list():
+    """启动时从最近的订单载入备餐汇总，之后由写入和状态更新增量维护。"""
+    since = (datetime.datetime.utcnow() - prep_list.window).strftime("%Y-%m-%d %H:%M:%S")
+    rows = []
+    with get_db_connection() as conn:
+        if conn:
+            for row in conn.execute("SELECT id, order_json, status FROM orders WHERE created_at >= ?", (since,)):
+                try:
+                    rows.append((row["id"], decode_order(row["order_json"]), row["status"]))
+                except ValueError:
+                    logger.error(f"解析订单 JSON 失败，备餐汇总跳过数据库 ID {row['id']}")
+    prep_list.load(rows)
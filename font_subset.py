@@ -0,0 +1,167 @@
+# font_subset.py
+"""
+PDF 小票的中文字体子集。
+
+SimSun / Microsoft YaHei 等中文字体文件有十几 MB，WeasyPrint 每次渲染都要加载并裁剪整个字体。
+这里预先用 fontTools 生成只包含常用字符的子集字体，并通过 @font-face 提供给模板，
+模板的 font-family 把 RECEIPT_FONT_FAMILY 放在第一位。
+
+子集的字符集是固定的：ASCII、常用中文标点、模板中的固定文字、GB2312 一级汉字（3755 个常用字），
+以及环境变量 RECEIPT_FONT_EXTRA_CHARS 中的字符（例如菜单里的生僻字）。子集在后台线程中生成一次并
+缓存在 font_cache/ 目录中，打印路径上不会生成子集，也不需要等待锁。子集中没有的字符（少见的姓名、
+地址用字）由模板 font-family 中后面的系统字体逐字补齐。子集尚未生成完成时使用系统字体。
+
+字体来源由环境变量 RECEIPT_FONT 指定（"路径" 或 "路径#TTC 序号"），默认依次尝试 Windows 的
+宋体和微软雅黑。未安装 fontTools 或找不到字体时不使用子集。生成失败时在 RETRY_INTERVAL 秒后重试。
+"""
+
+import hashlib
+import logging
+import os
+import pathlib
+import re
+import string
+import tempfile
+import threading
+import time
+
+try:
+    from fontTools import subset as ft_subset
+    from fontTools import ttLib
+
+    FONTTOOLS_AVAILABLE = True
+except ImportError:
+    FONTTOOLS_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+RECEIPT_FONT_FAMILY = "ReceiptCJK"
+FONT_CACHE_DIR = "font_cache"
+RETRY_INTERVAL = 600  # 秒
+DEFAULT_FONT_CANDIDATES = [
+    os.path.join(os.environ.get("WINDIR", r"C:\Windows"), "Fonts", "simsun.ttc") + "#0",
+    os.path.join(os.environ.get("WINDIR", r"C:\Windows"), "Fonts", "msyh.ttc") + "#0",
+]
+BASE_CHARS = (string.ascii_letters + string.digits + string.punctuation + " "
+              + "，。、：；！？（）【】《》“”‘’·—…￥¥×")
+_MARKUP = re.compile(r"<[^>]*>|\{[{%#].*?[}%#]\}", re.S)
+
+
+def _parse_font_spec(spec):
+    path, _, index = spec.partition("#")
+    return path, int(index or 0)
+
+
+def find_source_font():
+    """返回 (字体路径, TTC 序号)；找不到时返回 None。"""
+    configured = os.environ.get("RECEIPT_FONT")
+    for spec in ([configured] if configured else DEFAULT_FONT_CANDIDATES):
+        path, index = _parse_font_spec(spec)
+        if os.path.exists(path):
+            return path, index
+    return None
+
+
+def common_hanzi():
+    """GB2312 一级汉字（按拼音排序的 3755 个常用字）。"""
+    chars = []
+    for high in range(0xB0, 0xD8):
+        for low in range(0xA1, 0xFF):
+            try:
+                chars.append(bytes((high, low)).decode("gb2312"))
+            except UnicodeDecodeError:
+                pass  # 0xD7FA 之后的空位
+    return "".join(chars)
+
+
+def template_visible_text(template_source):
+    """去掉模板中的 HTML 标签和 Jinja 语法，只保留会出现在小票上的固定文字。"""
+    return _MARKUP.sub(" ", template_source)
+
+
+class FontSubsetter:
+    def __init__(self, source=None, cache_dir=FONT_CACHE_DIR, family=RECEIPT_FONT_FAMILY, base_text=""):
+        self.source = source if source is not None else find_source_font()
+        self.cache_dir = cache_dir
+        self.family = family
+        self._chars = "".join(sorted(set(BASE_CHARS) | set(common_hanzi()) | set(base_text)
+                                     | set(os.environ.get("RECEIPT_FONT_EXTRA_CHARS", ""))))
+        self._lock = threading.Lock()  # 只保护下面的状态，生成子集时不持有
+        self._css = None
+        self._building = False
+        self._failed_at = None
+        self.available = FONTTOOLS_AVAILABLE and self.source is not None
+        if not FONTTOOLS_AVAILABLE:
+            logger.info("fontTools 未安装，PDF 小票使用系统中文字体。")
+        elif self.source is None:
+            logger.info("未找到可用于子集化的中文字体，PDF 小票使用系统中文字体。")
+
+    def _subset_file(self):
+        path, index = self.source
+        key = f"{path}#{index}|{os.path.getmtime(path)}|{self._chars}"
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:12]
+        return os.path.join(self.cache_dir, f"{self.family}-{digest}.ttf")
+
+    def _build_subset(self, target):
+        path, index = self.source
+        font = ttLib.TTFont(path, fontNumber=index)
+        options = ft_subset.Options()
+        options.name_IDs = ["*"]
+        options.notdef_outline = True
+        subsetter = ft_subset.Subsetter(options)
+        subsetter.populate(text=self._chars)
+        subsetter.subset(font)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        os.close(fd)
+        font.save(tmp_path)
+        font.close()
+        os.replace(tmp_path, target)
+        logger.info(f"已生成字体子集 {target}（{len(self._chars)} 个字符，{os.path.getsize(target) // 1024} KB）。")
+
+    def _remove_stale(self, keep):
+        """删除字体或字符集变化前生成的子集文件。"""
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.startswith(self.family + "-") and entry.path != keep:
+                try:
+                    os.unlink(entry.path)
+                except OSError:
+                    pass  # 可能仍被其他进程打开，下次再清理
+
+    def _prepare(self):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            target = self._subset_file()
+            if not os.path.exists(target):
+                self._build_subset(target)
+            self._remove_stale(target)
+        except Exception as e:
+            logger.error(f"生成字体子集失败，{RETRY_INTERVAL} 秒后重试，期间使用系统中文字体: {e}", exc_info=True)
+            with self._lock:
+                self._building = False
+                self._failed_at = time.monotonic()
+            return
+        css = (f"@font-face {{ font-family: '{self.family}'; "
+               f"src: url('{pathlib.Path(os.path.abspath(target)).as_uri()}'); }}")
+        with self._lock:
+            self._css = css
+            self._building = False
+            self._failed_at = None
+
+    def warm(self):
+        """在后台线程中准备子集（已就绪、正在生成或距上次失败不足 RETRY_INTERVAL 时无操作）。"""
+        if not self.available:
+            return
+        with self._lock:
+            if self._css is not None or self._building:
+                return
+            if self._failed_at is not None and time.monotonic() - self._failed_at < RETRY_INTERVAL:
+                return
+            self._building = True
+        threading.Thread(target=self._prepare, name="font-subset", daemon=True).start()
+
+    def font_face_css(self):
+        """子集字体的 @font-face CSS；子集不可用或尚未生成完成时返回 None（使用系统字体）。"""
+        self.warm()
+        with self._lock:
+            return self._css
@@ -0,0 +1,117 @@
+# kitchen_prep.py
+"""
+厨房备餐汇总：所有未完成订单中每道菜（按商品名 + 规格区分）还需要做多少份。
+
+汇总保存在内存中，由 database.py 在订单入库和状态变化时增量更新，查询时不扫描 orders 表。
+状态为 FULFILLED_STATUSES 之一的订单视为已完成并移出汇总。打印成功不代表菜已做好，
+因此由厨房在订单列表中点击"出餐"（POST /orders/<ID>/fulfill，状态设为 FULFILLED_STATUS）
+或通过 /orders/bulk-status 批量标记；创建超过 PREP_WINDOW 的订单也会在查询时过期移出，
+避免没有人标记完成的旧订单一直留在汇总里。重打和打印重试只在订单尚未完成时写入打印结果
+（database.update_order 的 keep_fulfilled），重打已出餐的订单不会让它在重启后回到汇总。
+应用启动时调用 load() 从数据库载入一次最近的订单。
+"""
+
+import collections
+import datetime
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+FULFILLED_STATUS = "已出餐"  # 订单列表"出餐"按钮设置的状态
+FULFILLED_STATUSES = (FULFILLED_STATUS, "已完成", "已取消")
+PREP_WINDOW = datetime.timedelta(hours=12)
+
+
+def is_outstanding(status):
+    return not any((status or "").startswith(done) for done in FULFILLED_STATUSES)
+
+
+def _created_at(order_data):
+    try:
+        created = datetime.datetime.fromisoformat(str(order_data.get("created_at")).replace("Z", "+00:00"))
+        if created.tzinfo is None:
+            created = created.replace(tzinfo=datetime.timezone.utc)
+        return created
+    except ValueError:
+        return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _item_counts(order_data):
+    counts = collections.Counter()
+    for item in order_data.get("line_items") or []:
+        key = (item.get("name") or "未知商品", tuple(item.get("option_values") or ()))
+        try:
+            counts[key] += int(item.get("quantity") or 0)
+        except (TypeError, ValueError):
+            pass
+    return counts
+
+
+class PrepList:
+    def __init__(self, window=PREP_WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        self._orders = {}  # 数据库 ID -> (创建时间, Counter)
+        self._totals = collections.Counter()
+
+    def _add(self, db_id, created, counts):
+        self._remove(db_id)
+        self._orders[db_id] = (created, counts)
+        self._totals.update(counts)
+
+    def _remove(self, db_id):
+        entry = self._orders.pop(db_id, None)
+        if entry:
+            self._totals.subtract(entry[1])
+            self._totals += collections.Counter()  # 去掉数量为 0 的键
+
+    def _expire(self, now):
+        cutoff = now - self.window
+        for db_id in [db_id for db_id, (created, _) in self._orders.items() if created < cutoff]:
+            self._remove(db_id)
+
+    def record_order(self, db_id, order_data, status):
+        """订单入库或内容更新。"""
+        created = _created_at(order_data)
+        recent = created >= datetime.datetime.now(datetime.timezone.utc) - self.window
+        with self._lock:
+            if is_outstanding(status) and recent:
+                self._add(db_id, created, _item_counts(order_data))
+            else:
+                self._remove(db_id)
+
+    def record_status(self, db_id, status):
+        """订单状态变化。只移出已完成的订单；不在汇总中的订单无需处理。"""
+        if is_outstanding(status):
+            return
+        with self._lock:
+            self._remove(db_id)
+
+    def load(self, rows):
+        """rows: (数据库 ID, 订单数据, 状态) 的可迭代对象，替换当前汇总。"""
+        with self._lock:
+            self._orders.clear()
+            self._totals.clear()
+            for db_id, order_data, status in rows:
+                if is_outstanding(status):
+                    self._add(db_id, _created_at(order_data), _item_counts(order_data))
+            logger.info(f"备餐汇总已载入 {len(self._orders)} 个未完成订单。")
+
+    def snapshot(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            self._expire(now)
+            items = [{"name": name, "option_values": list(options), "quantity": quantity}
+                     for (name, options), quantity in self._totals.items() if quantity > 0]
+            order_count = len(self._orders)
+        items.sort(key=lambda entry: (-entry["quantity"], entry["name"], entry["option_values"]))
+        return {
+            "generated_at": now.isoformat(),
+            "window_hours": self.window.total_seconds() / 3600,
+            "orders": order_count,
+            "items": items,
+        }
+
+
+prep_list = PrepList()
@@ -0,0 +1,179 @@
+# leases.py
+"""
+多实例协调：基于共享数据库的租约。
+
+多个实例（例如另一台电脑上的热备实例）共用同一个数据库时，用租约保证同一项工作同一时间只有一个实例在做：
+    - ingest:<店铺>        轮询和启动补单，由一个实例长期持有，每 RENEW_INTERVAL 秒续约；
+    - order:<店铺>:<nodeId> 处理单个订单（入库并首次打印），处理完成后释放；
+    - print_job:<作业 ID>   处理一个打印重试作业；
+    - retention            每日归档任务。
+租约在 LEASE_TTL 秒内没有续约即过期，其他实例可以接手，实例崩溃后几秒内它的工作就会被接管。
+只有一个实例时总能拿到租约，行为与之前相同。
+
+租约的过期时间使用各实例的系统时间，多台电脑之间需要保持时钟同步（误差应远小于 LEASE_TTL）。
+实例 ID 由环境变量 INSTANCE_ID 指定，默认为 "主机名-进程号"。
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from database import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+LEASE_TTL = 15  # 秒
+RENEW_INTERVAL = 5  # 秒
+STALE_LEASE_SECONDS = 3600  # 过期超过该时间的租约记录会被清理
+
+
+def default_instance_id():
+    return os.environ.get("INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+
+def init_lease_tables():
+    with get_db_connection() as conn:
+        if conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+            conn.commit()
+
+
+class LeaseManager:
+    def __init__(self, owner=None, ttl=LEASE_TTL):
+        self.owner = owner or default_instance_id()
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._held = {}  # 租约名称 -> 过期时间
+        self._kept = {}  # 需要长期持有的租约名称 -> (获得时回调, 失去时回调)
+        self._kept_state = {}  # 长期租约上一次确认的持有状态
+
+    def try_acquire(self, name):
+        """尝试获得（或续约）租约，返回是否成功。租约由其他实例持有且未过期时失败。"""
+        now = time.time()
+        expires_at = now + self.ttl
+        with get_db_connection() as conn:
+            if not conn:
+                return False
+            cursor = conn.execute('''
+                INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+            ''', (name, self.owner, expires_at, now))
+            conn.commit()
+        acquired = cursor.rowcount > 0
+        with self._lock:
+            if acquired:
+                self._held[name] = expires_at
+            else:
+                self._held.pop(name, None)
+        return acquired
+
+    def release(self, name):
+        with self._lock:
+            self._held.pop(name, None)
+        with get_db_connection() as conn:
+            if conn:
+                conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, self.owner))
+                conn.commit()
+
+    def holds(self, name):
+        """本实例当前是否持有该租约（按本地记录的过期时间判断，不访问数据库）。"""
+        with self._lock:
+            return self._held.get(name, 0) > time.time()
+
+    @contextmanager
+    def claim(self, name):
+        """在 with 块内持有租约，产出是否获得；获得的租约在退出时释放。"""
+        acquired = self.try_acquire(name)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                try:
+                    self.release(name)
+                except Exception as e:  # 租约会自行过期，不影响已完成的工作
+                    logger.error(f"释放租约 {name} 失败: {e}")
+
+    def run_exclusive(self, name, func, *args, **kwargs):
+        """只有获得租约时才执行 func，否则跳过并返回 None。"""
+        with self.claim(name) as acquired:
+            if not acquired:
+                logger.info(f"{name} 正由其他实例执行，本实例跳过。")
+                return None
+            return func(*args, **kwargs)
+
+    def keep(self, name, on_acquired=None, on_lost=None):
+        """登记需要长期持有的租约：立即尝试获取，之后由 renew() 续约或在其他实例失效后接管。"""
+        with self._lock:
+            self._kept[name] = (on_acquired, on_lost)
+        self._refresh_kept(name)
+
+    def _refresh_kept(self, name):
+        try:
+            has = self.try_acquire(name)
+        except Exception as e:
+            logger.error(f"续约 {name} 失败: {e}")
+            has = self.holds(name)  # 数据库暂时不可用，本地记录过期前仍视为持有
+        with self._lock:
+            had = self._kept_state.get(name, False)
+            self._kept_state[name] = has
+        if has == had:
+            return
+        on_acquired, on_lost = self._kept.get(name, (None, None))
+        if has:
+            logger.info(f"实例 {self.owner} 获得租约 {name}。")
+        else:
+            logger.warning(f"实例 {self.owner} 失去租约 {name}。")
+        callback = on_acquired if has else on_lost
+        if callback:
+            try:
+                callback()
+            except Exception as e:
+                logger.exception(f"处理租约 {name} 变化时出错: {e}")
+
+    def renew(self):
+        """续约所有长期租约，并尝试接管其他实例已过期的租约。"""
+        with self._lock:
+            names = list(self._kept)
+        for name in names:
+            self._refresh_kept(name)
+        with get_db_connection() as conn:
+            if conn:
+                conn.execute("DELETE FROM leases WHERE expires_at < ?", (time.time() - STALE_LEASE_SECONDS,))
+                conn.commit()
+
+    def start(self, scheduler):
+        scheduler.add_job(func=self.renew, trigger="interval", seconds=RENEW_INTERVAL, id='lease_renew_job',
+                          replace_existing=True, max_instances=1, coalesce=True)
+
+    def release_all(self):
+        """退出时释放本实例的所有租约，其他实例无需等待过期即可接管。"""
+        with self._lock:
+            self._kept.clear()
+            self._kept_state.clear()
+        with get_db_connection() as conn:
+            if conn:
+                conn.execute("DELETE FROM leases WHERE owner = ?", (self.owner,))
+                conn.commit()
+        with self._lock:
+            self._held.clear()
+
+    def status(self):
+        now = time.time()
+        with self._lock:
+            return {
+                "instance": self.owner,
+                "held": sorted(name for name, expires_at in self._held.items() if expires_at > now),
+            }
+
+
+lease_manager = LeaseManager()
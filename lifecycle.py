@@ -0,0 +1,47 @@
+# lifecycle.py
+"""进程生命周期管理：跟踪进行中的订单/打印任务，并在退出前等待其完成。"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class InFlightTracker:
+    """按类别统计进行中的任务数量，供优雅退出时等待排空。"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._counts = {}
+        self.draining = False
+
+    @contextmanager
+    def track(self, kind):
+        with self._cond:
+            self._counts[kind] = self._counts.get(kind, 0) + 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._counts[kind] -= 1
+                self._cond.notify_all()
+
+    def snapshot(self):
+        with self._cond:
+            return {kind: count for kind, count in self._counts.items() if count}
+
+    def wait_idle(self, timeout):
+        """等待所有任务结束。返回 True 表示已排空，False 表示超时。"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while any(self._counts.values()):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+
+inflight = InFlightTracker()
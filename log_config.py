@@ -0,0 +1,213 @@
+# log_config.py
+"""
+日志配置：队列化、结构化、可按 logger 调整级别和限流。
+
+- 所有 logger 的记录先经过根 logger 上的 QueueHandler 放入内存队列，由 QueueListener 后台线程写控制台
+  （以及 LOG_FILE 指定的文件，按大小轮转），订单处理线程不再等待控制台或磁盘 I/O；
+- LOG_FORMAT=json（默认）时每条记录输出一行 JSON，包含时间、级别、logger、线程、消息，以及通过
+  log_context() 或 extra 传入的 order_id / stage / shop 字段，便于 grep 或导入日志工具；
+  LOG_FORMAT=text 时输出与之前相同的文本格式，字段附加在行尾；
+- LOG_LEVEL 设置根级别（默认 INFO），LOG_LEVELS 按 logger 设置级别，例如
+  "weasyprint=WARNING,apscheduler=WARNING,print_retry=DEBUG"，未设置的使用 DEFAULT_LEVELS；
+- LOG_RATE_LIMITS 限制嘈杂 logger 每秒的记录数，例如 "weasyprint=5,fontTools=2"，超出的记录在入队前丢弃，
+  下一条通过的记录带上被丢弃的数量 (suppressed)。
+"""
+
+import atexit
+import contextlib
+import contextvars
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+CONTEXT_FIELDS = ("order_id", "stage", "shop")
+DEFAULT_LEVELS = {
+    "weasyprint": logging.WARNING,  # 之前为 DEBUG，每次 PDF 渲染都会输出大量排版日志
+    "fontTools": logging.WARNING,
+    "apscheduler": logging.WARNING,  # 心跳、打印重试等每隔几秒执行一次的任务
+}
+DEFAULT_RATE_LIMITS = {"weasyprint": 5.0, "fontTools": 5.0}
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_FILE_MAX_BYTES = 10 * 1024 * 1024
+LOG_FILE_BACKUPS = 5
+
+_context = contextvars.ContextVar("log_context", default={})
+_listener = None
+_configure_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """在 with 块内记录的日志都带上这些字段（例如 order_id、stage）。只对当前线程有效。"""
+    merged = dict(_context.get())
+    merged.update({key: value for key, value in fields.items() if value is not None})
+    token = _context.set(merged)
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def update_log_context(**fields):
+    """在外层 log_context() 内补充字段（例如解析订单后得到的订单号），随外层 with 块结束一起失效。"""
+    merged = dict(_context.get())
+    merged.update({key: value for key, value in fields.items() if value is not None})
+    _context.set(merged)
+
+
+def _parse_pairs(text, convert):
+    """解析 "name=value,name=value"，格式无效的项忽略。"""
+    result = {}
+    for item in (text or "").split(","):
+        name, sep, value = item.partition("=")
+        if not sep or not name.strip():
+            continue
+        try:
+            result[name.strip()] = convert(value.strip())
+        except (TypeError, ValueError):
+            continue
+    return result
+
+
+def _level(value):
+    level = logging.getLevelName(value.upper())
+    if not isinstance(level, int):
+        raise ValueError(value)
+    return level
+
+
+class ContextFilter(logging.Filter):
+    """在记录日志的线程中把 log_context() 的字段复制到记录上。"""
+
+    def filter(self, record):
+        for key, value in _context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """按 logger 名称前缀的令牌桶限流，WARNING 及以上的记录不受限。"""
+
+    def __init__(self, limits):
+        super().__init__()
+        self._limits = limits
+        self._lock = threading.Lock()
+        self._buckets = {}  # 前缀 -> [令牌数, 上次补充时间, 丢弃数]
+
+    def _prefix(self, name):
+        for prefix in self._limits:
+            if name == prefix or name.startswith(prefix + "."):
+                return prefix
+        return None
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        prefix = self._prefix(record.name)
+        if prefix is None:
+            return True
+        rate = self._limits[prefix]
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.setdefault(prefix, [rate, now, 0])
+            bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            if bucket[2]:
+                record.suppressed = bucket[2]
+                bucket[2] = 0
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """只在当前线程合并消息参数和异常文本，格式化留给监听线程。"""
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        for key in CONTEXT_FIELDS + ("suppressed",):
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__(TEXT_FORMAT)
+
+    def format(self, record):
+        text = super().format(record)
+        fields = [f"{key}={getattr(record, key)}" for key in CONTEXT_FIELDS + ("suppressed",)
+                  if getattr(record, key, None) is not None]
+        if fields:
+            first_line, sep, rest = text.partition("\n")
+            text = f"{first_line} [{' '.join(fields)}]{sep}{rest}"
+        return text
+
+
+def configure_logging():
+    """配置根 logger（重复调用无副作用），返回后台的 QueueListener。"""
+    global _listener
+    with _configure_lock:
+        if _listener is not None:
+            return _listener
+
+        formatter = JsonFormatter() if os.environ.get("LOG_FORMAT", "json") == "json" else TextFormatter()
+        handlers = [logging.StreamHandler()]
+        log_file = os.environ.get("LOG_FILE")
+        if log_file:
+            handlers.append(logging.handlers.RotatingFileHandler(
+                log_file, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS, encoding="utf-8"))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        log_queue = queue.SimpleQueue()
+        queue_handler = _QueueHandler(log_queue)
+        queue_handler.addFilter(ContextFilter())
+        rate_limits = dict(DEFAULT_RATE_LIMITS)
+        rate_limits.update(_parse_pairs(os.environ.get("LOG_RATE_LIMITS"), float))
+        queue_handler.addFilter(RateLimitFilter({name: rate for name, rate in rate_limits.items() if rate > 0}))
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(queue_handler)
+        root.setLevel(_parse_pairs(f"root={os.environ.get('LOG_LEVEL', 'INFO')}", _level).get("root", logging.INFO))
+
+        levels = dict(DEFAULT_LEVELS)
+        levels.update(_parse_pairs(os.environ.get("LOG_LEVELS"), _level))
+        for name, level in levels.items():
+            logging.getLogger(name).setLevel(level)
+
+        _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)  # 退出前写完队列中剩余的记录
+        return _listener
@@ -0,0 +1,185 @@
+# order_codec.py
+"""
+订单数据 (order_json 列) 的序列化格式。
+
+新写入的数据为带版本头的二进制格式：
+    b'AVO' + 版本(1字节) + 编码(1字节) + 压缩(1字节) + 负载
+编码和压缩方式都可插拔：编码支持紧凑 JSON 和 MessagePack，压缩支持 zlib 和 zstd
+（zstd 需要安装 zstandard）。旧版本写入的 JSON 文本行仍可直接读取。
+
+迁移已有数据:
+    python order_codec.py migrate [--db orders.db] [--batch-size 500]
+"""
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import zlib
+
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'AVO'
+FORMAT_VERSION = 1
+HEADER_SIZE = len(MAGIC) + 3
+COMPRESS_MIN_SIZE = 256  # 负载小于该字节数时不压缩，压缩收益不足以抵消开销
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _json_loads(payload):
+    return json.loads(payload.decode('utf-8'))
+
+
+def _msgpack_dumps(obj):
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def _msgpack_loads(payload):
+    return msgpack.unpackb(payload, raw=False)
+
+
+# 编号写入数据头，只能追加，不能修改已有编号
+ENCODINGS = {
+    0: ('json', _json_dumps, _json_loads),
+    1: ('msgpack', _msgpack_dumps, _msgpack_loads),
+}
+
+COMPRESSIONS = {
+    0: ('none', lambda data: data, lambda data: data),
+    1: ('zlib', lambda data: zlib.compress(data, 6), zlib.decompress),
+}
+if ZSTD_AVAILABLE:
+    COMPRESSIONS[2] = ('zstd', lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+                       lambda data: zstandard.ZstdDecompressor().decompress(data))
+
+
+def _code_for(table, name):
+    for code, entry in table.items():
+        if entry[0] == name:
+            return code
+    raise ValueError(f"未知的格式: {name}")
+
+
+def _default_codec():
+    """从环境变量 ORDER_CODEC (如 "msgpack+zlib") 读取默认格式，不可用时退回 JSON。"""
+    spec = os.environ.get("ORDER_CODEC", "msgpack+zlib")
+    encoding, _, compression = spec.partition("+")
+    if encoding == "msgpack" and not MSGPACK_AVAILABLE:
+        encoding = "json"
+    if compression == "zstd" and not ZSTD_AVAILABLE:
+        compression = "zlib"
+    return _code_for(ENCODINGS, encoding), _code_for(COMPRESSIONS, compression or "none")
+
+
+_encoding_code, _compression_code = _default_codec()
+
+
+def configure(encoding, compression="zlib"):
+    """设置新写入数据使用的编码和压缩方式。"""
+    global _encoding_code, _compression_code
+    _encoding_code = _code_for(ENCODINGS, encoding)
+    _compression_code = _code_for(COMPRESSIONS, compression)
+
+
+def encode_order(order_data):
+    """将订单字典序列化为带版本头的字节串。"""
+    payload = ENCODINGS[_encoding_code][1](order_data)
+    compression_code = _compression_code if len(payload) >= COMPRESS_MIN_SIZE else 0
+    payload = COMPRESSIONS[compression_code][1](payload)
+    return MAGIC + bytes((FORMAT_VERSION, _encoding_code, compression_code)) + payload
+
+
+def is_encoded(value):
+    return isinstance(value, (bytes, memoryview)) and bytes(value[:len(MAGIC)]) == MAGIC
+
+
+def decode_order(value):
+    """反序列化 order_json 列的值，兼容旧的 JSON 文本。格式错误时抛出 ValueError。"""
+    if value is None:
+        raise ValueError("order_json 为空")
+    if isinstance(value, str):
+        return json.loads(value)
+    value = bytes(value)
+    if not value.startswith(MAGIC):
+        return json.loads(value.decode('utf-8'))
+
+    version, encoding_code, compression_code = value[len(MAGIC):HEADER_SIZE]
+    if version != FORMAT_VERSION:
+        raise ValueError(f"不支持的订单数据版本: {version}")
+    try:
+        decompress = COMPRESSIONS[compression_code][2]
+        loads = ENCODINGS[encoding_code][2]
+    except KeyError:
+        raise ValueError(f"不支持的订单数据格式: 编码 {encoding_code}，压缩 {compression_code}")
+    try:
+        return loads(decompress(value[HEADER_SIZE:]))
+    except ValueError:
+        raise
+    except Exception as e:  # zlib.error、msgpack 异常等
+        raise ValueError(f"解码订单数据失败: {e}") from e
+
+
+def migrate(db_name, batch_size=500):
+    """将 orders 表中的 JSON 文本行分批改写为当前二进制格式，返回改写的行数。"""
+    conn = sqlite3.connect(db_name)
+    migrated = 0
+    last_id = 0
+    try:
+        while True:
+            rows = conn.execute(
+                "SELECT id, order_json FROM orders WHERE id > ? AND typeof(order_json) = 'text' ORDER BY id LIMIT ?",
+                (last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            updates = []
+            for db_id, order_json in rows:
+                try:
+                    updates.append((encode_order(json.loads(order_json)), db_id))
+                except json.JSONDecodeError:
+                    logger.error(f"订单 JSON 无法解析，跳过数据库 ID {db_id}")
+            with conn:
+                conn.executemany("UPDATE orders SET order_json = ? WHERE id = ?", updates)
+            migrated += len(updates)
+            last_id = rows[-1][0]
+            logger.info(f"已迁移 {migrated} 行 (至数据库 ID {last_id})")
+    finally:
+        conn.close()
+    return migrated
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="订单数据格式工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="将 JSON 文本行改写为二进制格式")
+    migrate_parser.add_argument("--db", default="orders.db")
+    migrate_parser.add_argument("--batch-size", type=int, default=500)
+    migrate_parser.add_argument("--codec", default=None, help="目标格式，如 msgpack+zlib、json+zstd")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.codec:
+        encoding, _, compression = args.codec.partition("+")
+        configure(encoding, compression or "none")
+    count = migrate(args.db, args.batch_size)
+    logger.info(f"迁移完成，共改写 {count} 行。可执行 VACUUM 回收空间。")
+
+
+if __name__ == "__main__":
+    main()
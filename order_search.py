@@ -0,0 +1,122 @@
+# order_search.py
+"""
+订单全文检索（SQLite FTS5）。
+
+索引字段：订单号、顾客姓名、电话、地址、商品名（含规格）、客户留言。
+FTS5 的 unicode61 分词器会把连续的中文当作一个词，因此写入和查询时都把每个汉字
+拆成单独的词，再用短语查询匹配相邻的字，这样"牛肉"可以命中"红烧牛肉面"。
+电话号码额外索引末四位，方便按尾号查找。
+
+本模块只处理给定的数据库连接，由 database.py 在写入订单时调用。
+"""
+
+import logging
+import re
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = "orders_fts"
+
+# 中日韩统一表意文字、兼容汉字、日文假名和韩文音节
+_CJK_RE = re.compile(r'([㐀-䶿一-鿿豈-﫿぀-ヿ가-힯])')
+_QUERY_TERM_RE = re.compile(r'\S+')
+
+
+def create_search_index(conn):
+    """创建 FTS5 虚表。当前 SQLite 未编译 FTS5 时返回 False。"""
+    try:
+        conn.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+                order_id, customer_name, phone, address, items, message,
+                tokenize = 'unicode61'
+            )
+        ''')
+        return True
+    except sqlite3.OperationalError as e:
+        logger.warning(f"SQLite 不支持 FTS5，订单搜索不可用: {e}")
+        return False
+
+
+def search_index_available(conn):
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (FTS_TABLE,)).fetchone()
+    return row is not None
+
+
+def tokenize_cjk(text):
+    """在每个汉字两侧插入空格，使其成为独立的词。"""
+    return _CJK_RE.sub(r' \1 ', text or '')
+
+
+def build_document(order_data):
+    """从订单数据中提取需要索引的各字段文本。"""
+    shipping = order_data.get("shipping_address") or {}
+    customer = order_data.get("customer_info") or {}
+
+    names = [shipping.get("firstName"), shipping.get("lastName"),
+             customer.get("firstName"), customer.get("lastName")]
+    phones = {p for p in (shipping.get("phone"), customer.get("phone")) if p}
+    digits = [re.sub(r'\D', '', p) for p in phones]
+    phone_text = " ".join(list(phones) + [d[-4:] for d in digits if len(d) > 4])
+    address = [shipping.get(key) for key in ("address1", "address2", "city", "province", "zip")]
+    items = []
+    for item in order_data.get("line_items") or []:
+        items.append(item.get("name") or "")
+        items.extend(item.get("option_values") or [])
+
+    def join(values):
+        return tokenize_cjk(" ".join(v for v in values if v))
+
+    return (
+        tokenize_cjk(order_data.get("order_id") or ""),
+        join(names),
+        phone_text,
+        join(address),
+        join(items),
+        tokenize_cjk(order_data.get("customer_message") or ""),
+    )
+
+
+def index_order(conn, db_id, order_data):
+    """写入或替换订单的索引行 (rowid 与 orders.id 相同)。调用方负责提交事务。"""
+    if not search_index_available(conn):
+        return
+    conn.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = ?", (db_id,))
+    conn.execute(
+        f"INSERT INTO {FTS_TABLE} (rowid, order_id, customer_name, phone, address, items, message) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (db_id, *build_document(order_data))
+    )
+
+
+def remove_from_index(conn, db_ids):
+    if not search_index_available(conn):
+        return
+    conn.executemany(f"DELETE FROM {FTS_TABLE} WHERE rowid = ?", [(db_id,) for db_id in db_ids])
+
+
+def build_match_query(query):
+    """
+    将用户输入转换为 FTS5 查询：空格分隔的每个词都必须命中，
+    每个词作为短语查询并允许前缀匹配（如电话号码前几位）。
+    """
+    phrases = []
+    for term in _QUERY_TERM_RE.findall(query or ""):
+        tokens = [t.replace('"', '""') for t in tokenize_cjk(term).split()]
+        tokens = [t for t in tokens if t.strip('"')]
+        if tokens:
+            phrases.append('"' + " ".join(tokens) + '"*')
+    return " ".join(phrases)
+
+
+def search(conn, query, limit, offset):
+    """返回 (按相关度排序的 orders.id 列表, 命中总数)。"""
+    match = build_match_query(query)
+    if not match or not search_index_available(conn):
+        return [], 0
+    total = conn.execute(f"SELECT count(*) FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH ?", (match,)).fetchone()[0]
+    rows = conn.execute(
+        f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH ? ORDER BY rank, rowid DESC LIMIT ? OFFSET ?",
+        (match, limit, offset)
+    ).fetchall()
+    return [row[0] for row in rows], total
@@ -0,0 +1,202 @@
+# order_transfer.py
+"""
+订单导出 / 导入。
+
+导出直接从数据库游标逐行生成 NDJSON 或 CSV，内存占用恒定，可按本地日期和状态筛选；
+导入读取 NDJSON（导出格式或单纯的订单字典），分批在事务中按 order_id 幂等写入，
+重复导入同一文件不会产生重复订单。
+
+命令行:
+    python order_transfer.py export --format csv --since 2024-01-01 --until 2024-12-31 -o orders.csv
+    python order_transfer.py import old_orders.ndjson --db orders.db
+"""
+
+import argparse
+import csv
+import datetime
+import io
+import json
+import logging
+import sys
+
+import database
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("ndjson", "csv")
+IMPORT_BATCH_SIZE = 500
+CSV_COLUMNS = ["order_id", "created_at", "status", "customer_name", "phone", "address",
+               "items", "total_amount", "currency", "customer_message"]
+
+
+def local_date_to_utc(date_str, next_day=False):
+    """将本地日期 YYYY-MM-DD 转换为数据库使用的 UTC 时间字符串；next_day 为 True 时取次日零点。"""
+    if not date_str:
+        return None
+    day = datetime.datetime.strptime(date_str, "%Y-%m-%d")
+    if next_day:
+        day += datetime.timedelta(days=1)
+    return day.astimezone(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def iter_export_rows(since=None, until=None, status=None):
+    """since / until 为本地日期（均包含），status 为状态前缀。"""
+    return database.iter_orders(created_from=local_date_to_utc(since),
+                                created_before=local_date_to_utc(until, next_day=True),
+                                status_prefix=status)
+
+
+def iter_ndjson(rows):
+    for row in rows:
+        record = {
+            "order_id": row["order_id"],
+            "status": row["status"],
+            "created_at": row["created_at"],
+            "order": row["order_json"],
+        }
+        yield json.dumps(record, ensure_ascii=False) + "\n"
+
+
+def _csv_fields(row):
+    order = row["order_json"]
+    customer = order.get("customer_info") or {}
+    address = order.get("shipping_address") or {}
+    total = order.get("total_price") or {}
+    items = []
+    for item in order.get("line_items") or []:
+        text = f"{item.get('name') or ''} x{item.get('quantity') or 0}"
+        if item.get("option_values"):
+            text += f" ({', '.join(item['option_values'])})"
+        items.append(text)
+    return [
+        row["order_id"],
+        row["created_at"],
+        row["status"],
+        f"{customer.get('lastName') or ''}{customer.get('firstName') or ''}",
+        address.get("phone") or customer.get("phone") or "",
+        " ".join(filter(None, [address.get("province"), address.get("city"),
+                               address.get("address1"), address.get("address2")])),
+        "; ".join(items),
+        total.get("amount") or "",
+        total.get("currency_code") or "",
+        order.get("customer_message") or "",
+    ]
+
+
+def iter_csv(rows, bom=True):
+    """逐行生成 CSV 文本。bom 为 True 时输出 UTF-8 BOM，Excel 打开时中文不会乱码。"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        value = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+        return value
+
+    writer.writerow(CSV_COLUMNS)
+    yield ("\ufeff" if bom else "") + flush()
+    for row in rows:
+        writer.writerow(_csv_fields(row))
+        yield flush()
+
+
+def export_lines(fmt, since=None, until=None, status=None, bom=True):
+    rows = iter_export_rows(since, until, status)
+    if fmt == "csv":
+        return iter_csv(rows, bom=bom)
+    if fmt == "ndjson":
+        return iter_ndjson(rows)
+    raise ValueError(f"不支持的导出格式: {fmt}")
+
+
+def parse_import_line(line):
+    """解析一行 NDJSON，返回 upsert_orders 需要的记录；空行返回 None，格式错误抛出 ValueError。"""
+    line = line.strip()
+    if not line:
+        return None
+    data = json.loads(line)
+    if not isinstance(data, dict):
+        raise ValueError("每行必须是 JSON 对象")
+    order = data.get("order") if isinstance(data.get("order"), dict) else data
+    order_id = data.get("order_id") or order.get("order_id")
+    if not order_id:
+        raise ValueError("缺少 order_id")
+    order.setdefault("order_id", order_id)
+    return {
+        "order_id": order_id,
+        "order_json": order,
+        "status": data.get("status") if "order" in data else None,  # 未提供时保留已有状态
+        "created_at": data.get("created_at") if "order" in data else None,
+    }
+
+
+def import_ndjson(lines, batch_size=IMPORT_BATCH_SIZE):
+    """分批导入 NDJSON 行，返回 (写入行数, 跳过行数)。"""
+    imported = skipped = 0
+    batch = []
+    for line_no, line in enumerate(lines, 1):
+        try:
+            record = parse_import_line(line)
+        except ValueError as e:  # json.JSONDecodeError 也是 ValueError
+            logger.warning(f"第 {line_no} 行无法导入: {e}")
+            skipped += 1
+            continue
+        if record is None:
+            continue
+        batch.append(record)
+        if len(batch) >= batch_size:
+            imported += database.upsert_orders(batch)
+            batch = []
+            logger.info(f"已导入 {imported} 个订单 (至第 {line_no} 行)")
+    imported += database.upsert_orders(batch)
+    return imported, skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="订单导出 / 导入工具")
+    parser.add_argument("--db", default=database.DB_NAME)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="导出订单为 NDJSON 或 CSV")
+    export_parser.add_argument("--format", choices=FORMATS, default="ndjson")
+    export_parser.add_argument("--since", help="起始本地日期 YYYY-MM-DD（包含）")
+    export_parser.add_argument("--until", help="结束本地日期 YYYY-MM-DD（包含）")
+    export_parser.add_argument("--status", help="状态前缀，如 已打印、打印失败")
+    export_parser.add_argument("-o", "--output", help="输出文件，默认标准输出")
+
+    import_parser = subparsers.add_parser("import", help="从 NDJSON 导入订单（按 order_id 覆盖）")
+    import_parser.add_argument("input", help="NDJSON 文件，- 表示标准输入")
+    import_parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    database.DB_NAME = args.db
+    database.init_db()
+
+    if args.command == "export":
+        lines = export_lines(args.format, args.since, args.until, args.status, bom=bool(args.output))
+        out = open(args.output, "w", encoding="utf-8", newline="") if args.output else sys.stdout
+        try:
+            count = -1 if args.format == "csv" else 0  # CSV 表头不计入
+            for line in lines:
+                out.write(line)
+                count += 1
+        finally:
+            if args.output:
+                out.close()
+        logger.info(f"导出完成，共 {count} 个订单。")
+        return 0
+
+    source = sys.stdin if args.input == "-" else open(args.input, "r", encoding="utf-8-sig")
+    try:
+        imported, skipped = import_ndjson(source, args.batch_size)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+    logger.info(f"导入完成：写入 {imported} 个订单，跳过 {skipped} 行。")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
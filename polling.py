@@ -0,0 +1,180 @@
+# polling.py
+"""
+自适应轮询调度。
+
+根据 Webhook 的健康状况和最近轮询的结果动态调整下一次轮询的间隔：
+    - Webhook 异常（营业时间内长时间没有推送、最近出现签名校验失败）或最近轮询
+      发现了遗漏订单时，按最短间隔频繁轮询；
+    - Webhook 正常推送时逐步退避，营业时间内最长不超过 BUSINESS_MAX_INTERVAL；
+    - 营业时间外按 MAX_INTERVAL 低频轮询。
+同一时刻最多只有一个轮询在执行。
+"""
+
+import collections
+import datetime
+import logging
+import threading
+
+from database import get_setting
+
+logger = logging.getLogger(__name__)
+
+MIN_INTERVAL = 60                # 最短轮询间隔（秒）
+BUSINESS_MAX_INTERVAL = 15 * 60  # 营业时间内 Webhook 正常时的最长间隔
+MAX_INTERVAL = 60 * 60           # 营业时间外的间隔
+WEBHOOK_SILENCE_THRESHOLD = 15 * 60  # 营业时间内超过该秒数没有收到 Webhook 视为异常
+SIGNATURE_FAILURE_WINDOW = 15 * 60   # 统计签名失败的时间窗口
+RECENT_POLLS_WINDOW = 3          # 最近几次轮询中发现过遗漏订单就保持高频
+
+
+class WebhookHealth:
+    """记录 Webhook 的到达情况和签名校验失败。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.last_delivery = None
+        self._signature_failures = collections.deque(maxlen=100)
+
+    def record_delivery(self):
+        with self._lock:
+            self.last_delivery = datetime.datetime.now()
+
+    def record_signature_failure(self):
+        with self._lock:
+            self._signature_failures.append(datetime.datetime.now())
+
+    def recent_signature_failures(self, now, window=SIGNATURE_FAILURE_WINDOW):
+        cutoff = now - datetime.timedelta(seconds=window)
+        with self._lock:
+            return sum(1 for t in self._signature_failures if t >= cutoff)
+
+    def seconds_since_delivery(self, now):
+        with self._lock:
+            if self.last_delivery is None:
+                return None
+            return (now - self.last_delivery).total_seconds()
+
+
+def parse_business_hours(value):
+    """解析 "HH:MM-HH:MM" 格式的营业时间，支持跨午夜。格式无效或为空时返回 None（视为全天营业）。"""
+    if not value:
+        return None
+    try:
+        start_str, end_str = value.split("-", 1)
+        start = datetime.datetime.strptime(start_str.strip(), "%H:%M").time()
+        end = datetime.datetime.strptime(end_str.strip(), "%H:%M").time()
+        return start, end
+    except ValueError:
+        logger.warning(f"营业时间格式无效: {value!r}，应为 HH:MM-HH:MM。")
+        return None
+
+
+def in_business_hours(now, business_hours):
+    if business_hours is None:
+        return True
+    start, end = business_hours
+    current = now.time()
+    if start <= end:
+        return start <= current < end
+    return current >= start or current < end
+
+
+class AdaptivePoller:
+    """基于 APScheduler 的自适应轮询器。每次轮询结束后重新计算并安排下一次执行。"""
+
+    def __init__(self, scheduler, poll_func, health, job_id='poll_orders_job', get_setting=get_setting):
+        """
+        poll_func 执行一次轮询并返回本次发现的遗漏订单数量。
+        get_setting 用于读取营业时间，多店铺时传入店铺的 Shop.get_setting。
+        """
+        self.scheduler = scheduler
+        self.poll_func = poll_func
+        self.health = health
+        self.get_setting = get_setting
+        self.job_id = job_id
+        self.poll_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._recent_found = collections.deque(maxlen=RECENT_POLLS_WINDOW)
+        self._interval = MIN_INTERVAL
+        self.running = False
+        self.next_run_at = None
+
+    def start(self):
+        with self._state_lock:
+            if self.running:
+                return
+            self.running = True
+        if not self.scheduler.running:
+            self.scheduler.start()
+        self._schedule(MIN_INTERVAL)
+        logger.info("已启动自适应轮询任务。")
+
+    def stop(self):
+        with self._state_lock:
+            if not self.running:
+                return
+            self.running = False
+        try:
+            self.scheduler.remove_job(self.job_id)
+        except Exception as e:  # 任务可能正在执行，尚未重新安排
+            logger.debug(f"移除轮询任务时出错: {e}")
+        logger.info("已停止轮询任务。")
+
+    def poll_now(self):
+        """立即执行一次轮询。已有轮询在执行时直接返回 None。"""
+        if not self.poll_lock.acquire(blocking=False):
+            logger.info("上一次轮询尚未结束，跳过本次轮询。")
+            return None
+        try:
+            found = self.poll_func() or 0
+        except Exception as e:
+            logger.exception(f"轮询失败: {e}")
+            found = 0
+        finally:
+            self.poll_lock.release()
+        with self._state_lock:
+            self._recent_found.append(found)
+        return found
+
+    def _run(self):
+        self.poll_now()
+        if self.running:
+            self._schedule(self.next_interval(datetime.datetime.now()))
+
+    def _schedule(self, seconds):
+        with self._state_lock:
+            self._interval = seconds
+            self.next_run_at = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+            run_date = self.next_run_at
+        self.scheduler.add_job(func=self._run, trigger="date", run_date=run_date, id=self.job_id,
+                               replace_existing=True, max_instances=1, misfire_grace_time=MIN_INTERVAL)
+        logger.debug(f"下一次轮询安排在 {seconds} 秒后。")
+
+    def next_interval(self, now):
+        """根据营业时间、Webhook 健康状况和最近轮询结果计算下一次轮询间隔（秒）。"""
+        if not in_business_hours(now, parse_business_hours(self.get_setting('business_hours'))):
+            return MAX_INTERVAL
+
+        with self._state_lock:
+            found_recently = any(self._recent_found)
+            previous = self._interval
+
+        if found_recently:
+            return MIN_INTERVAL
+        if self.health.recent_signature_failures(now):
+            return MIN_INTERVAL
+        silence = self.health.seconds_since_delivery(now)
+        if silence is None or silence > WEBHOOK_SILENCE_THRESHOLD:
+            return MIN_INTERVAL
+
+        # Webhook 正常推送：逐步退避
+        return min(max(previous, MIN_INTERVAL) * 2, BUSINESS_MAX_INTERVAL)
+
+    def status(self):
+        with self._state_lock:
+            return {
+                "running": self.running,
+                "interval_seconds": self._interval,
+                "next_run_at": self.next_run_at.isoformat() if self.next_run_at else None,
+                "recent_found": list(self._recent_found),
+            }
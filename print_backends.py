@@ -0,0 +1,73 @@
+# print_backends.py
+"""
+打印后端注册表。
+
+后端按名称注册为模块路径，首次使用时才导入。PDF 后端会在导入时加载 WeasyPrint
+及其 Pango/cairo 依赖，耗时较长，使用 ESC/POS 打印时不应为此付出启动代价。
+每个后端模块需提供 print_order(order_data, ...) 函数。
+"""
+
+import importlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_registry = {}
+_loaded = {}
+_lock = threading.Lock()
+
+
+def register_backend(name, module_name):
+    """注册打印后端。重复注册会覆盖之前的模块路径。"""
+    with _lock:
+        _registry[name] = module_name
+        _loaded.pop(name, None)
+
+
+def registered_backends():
+    """返回 {后端名称: 模块路径}。"""
+    with _lock:
+        return dict(_registry)
+
+
+def is_loaded(name):
+    with _lock:
+        return name in _loaded
+
+
+def get_backend(name):
+    """获取打印后端模块，首次调用时导入。未注册的名称抛出 KeyError。"""
+    with _lock:
+        module = _loaded.get(name)
+        if module is not None:
+            return module
+        module_name = _registry[name]
+
+    # 导入过程不持有注册表锁，避免加载 PDF 后端时阻塞其他后端；import 自身保证同一模块只初始化一次
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    with _lock:
+        if name not in _loaded:
+            logger.info(f"已加载打印后端 '{name}' ({module_name})，耗时 {(time.perf_counter() - start) * 1000:.1f} ms")
+            _loaded[name] = module
+    return module
+
+
+def preload_async(name):
+    """在后台线程中预先导入指定后端，避免第一张小票承担导入耗时。"""
+    def _load():
+        try:
+            get_backend(name)
+        except (KeyError, ImportError) as e:
+            logger.warning(f"预加载打印后端 '{name}' 失败: {e}")
+
+    thread = threading.Thread(target=_load, name=f"preload-{name}", daemon=True)
+    thread.start()
+    return thread
+
+
+register_backend("escpos", "print_helper")
+register_backend("pdf", "print_helper_pdf")
+register_backend("text", "print_helper_old")
@@ -4,36 +4,46 @@ import datetime
 
 logger = logging.getLogger(__name__)
 
+TEMPLATE_VERSION = "1"  # 修改小票格式时递增，使预渲染缓存失效
+
+MAX_WIDTH = 32  # 根据你的打印机和纸张宽度调整
+
+# ESC/POS 指令序列，小票、厨房单和备餐汇总单共用
+INIT = b'\x1B\x40'  # 初始化打印机
+SET_UTF8_ENCODING = b'\x1C\x28\x43\x01\x00\x30\x32'
+SELECT_SIMPLIFIED_CHINESE_FONT = b'\x1C\x28\x43\x03\x00\x3C\x00\x14'
+SELECT_CHINESE = b'\x1B\x26\x03'  # 选择中文字符集
+TXT_NORMAL = b'\x1B\x21\x00'  # 正常字体
+TXT_DOUBLE_HEIGHT = b'\x1B\x21\x10'  # 倍高字体
+TXT_DOUBLE_WIDTH = b'\x1B\x21\x20'  # 倍宽字体
+TXT_DOUBLE_SIZE = b'\x1B\x21\x30'  # 倍高 + 倍宽
+ALIGN_LEFT = b'\x1B\x61\x00'
+ALIGN_CENTER = b'\x1B\x61\x01'
+ALIGN_RIGHT = b'\x1B\x61\x02'
+CUT = b'\x1D\x56\x41\x10'  # 切纸指令 (根据你的打印机修改)
+LF = b'\x0A'  # 换行
+# 中文可以用gbk或utf-8编码, 具体取决于你的打印机设置, 通常情况下, 打印机需要被设置为支持中文 (例如 SimSun) 才能正确打印中文
+ENCODING = 'utf-8'  # 或 'gbk'
+
+
+def _line(text):
+    return text.encode(ENCODING) + LF
+
 
 def generate_print_text(order_data):
     """生成 ESC/POS 打印指令序列。"""
 
-    MAX_WIDTH = 32  # 根据你的打印机和纸张宽度调整
-
     def escpos_center_text(text):
         """ESC/POS 居中对齐"""
-        return b'\x1B\x61\x01' + text.encode('utf-8') + b'\x1B\x61\x00'
+        return ALIGN_CENTER + text.encode(ENCODING) + ALIGN_LEFT
 
     def escpos_right_text(text):
         """ESC/POS 右对齐"""
-        return b'\x1B\x61\x02' + text.encode('utf-8') + b'\x1B\x61\x00'
+        return ALIGN_RIGHT + text.encode(ENCODING) + ALIGN_LEFT
 
     def escpos_left_text(text):
         """ESC/POS 左对齐"""
-        return b'\x1B\x61\x00' + text.encode('utf-8')
-
-    # ESC/POS 指令序列
-    INIT = b'\x1B\x40'  # 初始化打印机
-    SET_UTF8_ENCODING = b'\x1C\x28\x43\x01\x00\x30\x32'
-    SELECT_SIMPLIFIED_CHINESE_FONT = b'\x1C\x28\x43\x03\x00\x3C\x00\x14'
-    TXT_NORMAL = b'\x1B\x21\x00'  # 正常字体
-    TXT_DOUBLE_HEIGHT = b'\x1B\x21\x10'  # 倍高字体
-    TXT_DOUBLE_WIDTH = b'\x1B\x21\x20'  # 倍宽字体
-    CUT = b'\x1D\x56\x41\x10'  # 切纸指令 (根据你的打印机修改)
-    LF = b'\x0A'  # 换行
-    SELECT_CHINESE = b'\x1B\x26\x03'  # 选择中文字符集
-    # 中文可以用gbk或utf-8编码, 具体取决于你的打印机设置, 通常情况下, 打印机需要被设置为支持中文 (例如 SimSun) 才能正确打印中文
-    ENCODING = 'utf-8'  # 或 'gbk'
+        return ALIGN_LEFT + text.encode(ENCODING)
 
     commands = b''
     commands += INIT
@@ -112,23 +122,126 @@ def generate_print_text(order_data):
     return commands
 
 
-def print_order(order_data):
+def generate_kitchen_ticket(order_data):
+    """生成厨房单的 ESC/POS 指令：只包含商品、规格和留言，使用大号字体。"""
+
+    commands = INIT + SET_UTF8_ENCODING + SELECT_SIMPLIFIED_CHINESE_FONT
+    commands += ALIGN_CENTER + TXT_DOUBLE_SIZE + _line("厨房单") + ALIGN_LEFT
+    commands += TXT_DOUBLE_HEIGHT + _line(f"订单号: {order_data.get('order_id', '')}")
+    commands += TXT_NORMAL + _line(f"下单时间: {(order_data.get('created_at') or '')[:19]}")
+    commands += _line("-" * MAX_WIDTH)
+
+    for item in order_data.get("line_items", []):
+        commands += TXT_DOUBLE_SIZE + _line(f"{item.get('quantity', 0)} x {item.get('name', '')}")
+        option_values = item.get("option_values", [])
+        if option_values:
+            commands += TXT_DOUBLE_HEIGHT + _line(f"  {', '.join(option_values)}")
+        commands += TXT_NORMAL + LF
+
+    customer_message = order_data.get('customer_message')
+    if customer_message:
+        commands += TXT_NORMAL + _line("-" * MAX_WIDTH)
+        commands += TXT_DOUBLE_HEIGHT + _line(f"留言: {customer_message}")
+
+    commands += TXT_NORMAL + _line("-" * MAX_WIDTH)
+    commands += ALIGN_CENTER + _line(datetime.datetime.now().strftime('%H:%M:%S')) + ALIGN_LEFT
+    commands += LF + LF + CUT
+    return commands
+
+
+def generate_prep_list_ticket(prep_list):
+    """生成备餐汇总单的 ESC/POS 指令。prep_list 为 kitchen_prep.PrepList.snapshot() 的结果。"""
+
+    commands = INIT + SET_UTF8_ENCODING + SELECT_SIMPLIFIED_CHINESE_FONT
+    commands += ALIGN_CENTER + TXT_DOUBLE_SIZE + _line("备餐汇总") + ALIGN_LEFT
+    commands += TXT_NORMAL + _line(f"待处理订单: {prep_list['orders']}")
+    commands += _line("-" * MAX_WIDTH)
+
+    for entry in prep_list["items"]:
+        commands += TXT_DOUBLE_SIZE + _line(f"{entry['quantity']} x {entry['name']}")
+        if entry["option_values"]:
+            commands += TXT_DOUBLE_HEIGHT + _line(f"  {', '.join(entry['option_values'])}")
+        commands += TXT_NORMAL + LF
+    if not prep_list["items"]:
+        commands += TXT_DOUBLE_HEIGHT + _line("暂无待处理商品") + TXT_NORMAL
+
+    commands += TXT_NORMAL + _line("-" * MAX_WIDTH)
+    commands += ALIGN_CENTER + _line(datetime.datetime.now().strftime('%H:%M:%S')) + ALIGN_LEFT
+    commands += LF + LF + CUT
+    return commands
+
+
+TEMPLATE_RENDERERS = {
+    "receipt": generate_print_text,
+    "kitchen": generate_kitchen_ticket,
+}
+
+
+def template_version(template):
+    return TEMPLATE_VERSION
+
+
+def render(order_data, template="receipt"):
+    """渲染小票，返回 ESC/POS 字节。"""
+    return TEMPLATE_RENDERERS[template](order_data)
+
+
+def send_raw(data, printer_name=None, doc_name="Order Print"):
+    """将原始字节作为一个 RAW 打印作业发送到打印机（默认使用系统默认打印机），返回实际使用的打印机名。"""
+    target_printer = printer_name or win32print.GetDefaultPrinter()
+    hPrinter = win32print.OpenPrinter(target_printer)
+    try:
+        win32print.StartDocPrinter(hPrinter, 1, (doc_name, None, "RAW"))
+        try:
+            win32print.StartPagePrinter(hPrinter)
+            win32print.WritePrinter(hPrinter, data)
+            win32print.EndPagePrinter(hPrinter)
+        finally:
+            win32print.EndDocPrinter(hPrinter)
+    finally:
+        win32print.ClosePrinter(hPrinter)
+    return target_printer
+
+
+def print_order(order_data, printer_name=None, template="receipt"):
     """
-    使用 ESC/POS 指令打印订单。
+    使用 ESC/POS 指令打印订单。未指定打印机时使用系统默认打印机。
     """
     try:
-        print_commands = generate_print_text(order_data)
-        default_printer = win32print.GetDefaultPrinter()
-        hPrinter = win32print.OpenPrinter(default_printer)
-        hJob = win32print.StartDocPrinter(hPrinter, 1, ("Order Print", None, "RAW"))
-        win32print.StartPagePrinter(hPrinter)
-        win32print.WritePrinter(hPrinter, print_commands)
-        win32print.EndPagePrinter(hPrinter)
-        win32print.EndDocPrinter(hPrinter)
-        win32print.ClosePrinter(hPrinter)
+        print_commands = TEMPLATE_RENDERERS[template](order_data)
+        default_printer = send_raw(print_commands, printer_name)
 
         logger.info(f"订单 {order_data.get('order_id')} 已发送到打印机 {default_printer}")
         return True
     except Exception as e:
         logger.error(f"打印订单 {order_data.get('order_id')} 时出现错误: {e}")
-        return False
\ No newline at end of file
+        return False
+
+
+def print_rendered(data, printer_name=None, order_id=None):
+    """发送已渲染好的 ESC/POS 字节。"""
+    try:
+        target_printer = send_raw(data, printer_name)
+        logger.info(f"订单 {order_id} 已发送到打印机 {target_printer}")
+        return True
+    except Exception as e:
+        logger.error(f"打印订单 {order_id} 时出现错误: {e}")
+        return False
+
+
+def print_orders(orders_data, printer_name=None, template="receipt"):
+    """
+    将多个订单合并为一个打印作业发送（每张小票末尾自带切纸指令）。
+    成功返回 True，任一环节失败整个作业视为失败并返回 False。
+    """
+    order_ids = [order_data.get('order_id') for order_data in orders_data]
+    try:
+        render = TEMPLATE_RENDERERS[template]
+        print_commands = b''.join(render(order_data) for order_data in orders_data)
+        default_printer = send_raw(print_commands, printer_name, doc_name=f"Order Batch ({len(orders_data)})")
+
+        logger.info(f"{len(orders_data)} 个订单已合并发送到打印机 {default_printer}: {order_ids}")
+        return True
+    except Exception as e:
+        logger.error(f"批量打印订单 {order_ids} 时出现错误: {e}")
+        return False
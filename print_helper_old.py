@@ -149,13 +149,13 @@ def generate_print_text(order_data, print_method):
         return "\r\n".join(lines)
 
 
-def print_order(order_data, print_method="text"):
+def print_order(order_data, print_method="text", printer_name=None, template=None):
     """
-    根据新版 order_data 打印订单。
+    根据新版 order_data 打印订单。旧版格式不区分模板，template 参数仅为与其他打印后端保持一致。
     """
     try:
         print_text = generate_print_text(order_data, print_method)
-        default_printer = win32print.GetDefaultPrinter()
+        default_printer = printer_name or win32print.GetDefaultPrinter()
         hPrinter = win32print.OpenPrinter(default_printer)
         hJob = win32print.StartDocPrinter(hPrinter, 1, ("Print Job", None, "RAW"))
         win32print.StartPagePrinter(hPrinter)
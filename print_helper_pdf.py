@@ -2,16 +2,24 @@
 
 import logging
 import datetime
+import hashlib
 import os
 import subprocess
 import tempfile
 import win32print
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 
+from font_subset import FontSubsetter, template_visible_text
+
 
 try:
     from weasyprint import HTML, CSS
 
+    try:
+        from weasyprint.text.fonts import FontConfiguration
+    except ImportError:  # WeasyPrint 53 之前的版本
+        from weasyprint.fonts import FontConfiguration
+
     WEASYPRINT_AVAILABLE = True
 except ImportError:
     WEASYPRINT_AVAILABLE = False
@@ -24,28 +32,82 @@ except OSError as e:
 
 logger = logging.getLogger(__name__)
 
+TEMPLATE_FOLDER = 'templates'
+TEMPLATE_FILES = {
+    "receipt": "receipt_template.html",
+    "kitchen": "kitchen_template.html",
+}
+PAGE_CSS = '@page { size: 72mm auto; margin: 0; }'
+_template_versions = {}
+
+
+def _template_text():
+    """模板中的固定文字，作为字体子集的基础字符。"""
+    text = ""
+    for template_file in TEMPLATE_FILES.values():
+        try:
+            with open(os.path.join(TEMPLATE_FOLDER, template_file), "r", encoding="utf-8") as f:
+                text += template_visible_text(f.read())
+        except OSError:
+            pass
+    return text
+
+
+font_subsetter = FontSubsetter(base_text=_template_text())
+font_subsetter.warm()  # 后台生成或载入字体子集，不占用首次打印的时间
 
-def generate_receipt_html(order_data):
-    template_folder_path = 'templates'
+
+def stylesheets_for():
+    """
+    返回 (样式表列表, FontConfiguration)：页面尺寸样式，以及中文字体子集（已就绪时）。
+    @font-face 只有在 CSS 和 write_pdf 使用同一个 FontConfiguration 时才会生效。
+    """
+    font_config = FontConfiguration()
+    stylesheets = [CSS(string=PAGE_CSS, font_config=font_config)]
+    font_css = font_subsetter.font_face_css()
+    if font_css:
+        stylesheets.append(CSS(string=font_css, font_config=font_config))
+    return stylesheets, font_config
+
+
+def template_version(template):
+    """模板文件内容的哈希，模板修改后预渲染缓存自动失效。"""
+    path = os.path.join(TEMPLATE_FOLDER, TEMPLATE_FILES[template])
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return "missing"
+    cached = _template_versions.get(template)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, "rb") as f:
+        version = hashlib.sha256(f.read() + PAGE_CSS.encode("utf-8")).hexdigest()[:12]
+    _template_versions[template] = (mtime, version)
+    return version
+
+
+def generate_receipt_html(order_data, template="receipt"):
+    template_folder_path = TEMPLATE_FOLDER
+    template_file = TEMPLATE_FILES[template]
 
     try:
         env = Environment(
             loader=FileSystemLoader(searchpath=template_folder_path),
             autoescape=select_autoescape(['html', 'xml'])
         )
-        template = env.get_template('receipt_template.html')  # 模板文件名
+        jinja_template = env.get_template(template_file)
 
         context = {
             'order': order_data,
             'current_print_time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         }
-        html_output = template.render(context)
+        html_output = jinja_template.render(context)
         return html_output
     except ImportError:
         logger.error("Jinja2库似乎未正确安装。")
         return None
     except Exception as e:
-        logger.error(f"渲染HTML模板 'receipt_template.html' 时出错: {e}", exc_info=True)
+        logger.error(f"渲染HTML模板 '{template_file}' 时出错: {e}", exc_info=True)
         return None
 
 
@@ -55,11 +117,11 @@ def generate_pdf_from_html_content(html_content, pdf_filepath):
         logger.error("PDF模块: WeasyPrint库不可用，无法生成PDF。")
         return False
     try:
-        page_style = CSS(string='@page { size: 72mm auto; margin: 0; }')
-
+        stylesheets, font_config = stylesheets_for()
         HTML(string=html_content, base_url=os.getcwd()).write_pdf(
             pdf_filepath,
-            stylesheets = [page_style]
+            stylesheets = stylesheets,
+            font_config = font_config
         )
         logger.info(f"PDF文件已生成: {pdf_filepath}")
         return True
@@ -68,6 +130,22 @@ def generate_pdf_from_html_content(html_content, pdf_filepath):
         return False
 
 
+def render(order_data, template="receipt"):
+    """渲染小票并直接返回 PDF 字节，失败时返回 None。"""
+    if not WEASYPRINT_AVAILABLE:
+        logger.error("PDF模块: WeasyPrint库不可用，无法生成PDF。")
+        return None
+    html_content = generate_receipt_html(order_data, template)
+    if not html_content:
+        logger.error("PDF模块: 生成HTML内容失败。")
+        return None
+    try:
+        stylesheets, font_config = stylesheets_for()
+        return HTML(string=html_content, base_url=os.getcwd()).write_pdf(stylesheets=stylesheets,
+                                                                         font_config=font_config)
+    except Exception as e:
+        logger.error(f"从HTML生成PDF时出错: {e}", exc_info=True)
+        return None
 
 
 def silent_print_pdf_windows(pdf_filepath, printer_name=None):
@@ -141,38 +219,14 @@ def silent_print_pdf_windows(pdf_filepath, printer_name=None):
             return False
 
 
-def print_order(order_data, printer_name=None, keep_pdf_for_internal_debug=False):
-    """
-    主接口函数：生成订单PDF并尝试静默打印。
-    app.py 应确保 order_data 中包含 'shop_name' 等模板所需信息。
-    """
-    logger.info(f"PDF模块: 处理订单 {order_data.get('order_id')}，打印机: '{printer_name if printer_name else '默认'}'")
-
-    if not WEASYPRINT_AVAILABLE:
-        logger.error("PDF模块: WeasyPrint库或其依赖不可用，无法执行打印。")
-        return False
-
-    if 'shop_name' not in order_data:
-        logger.warning("PDF模块: order_data 中缺少 'shop_name'。HTML模板将使用默认值或可能出错。")
-
-    html_content = generate_receipt_html(order_data)
-    if not html_content:
-        logger.error("PDF模块: 生成HTML内容失败。")
-        return False
-
+def print_rendered(pdf_bytes, printer_name=None, order_id=None, keep_pdf_for_internal_debug=False):
+    """将已生成的 PDF 字节写入临时文件并静默打印。"""
     # 使用 tempfile 创建临时PDF文件
     fd, pdf_filepath = tempfile.mkstemp(suffix=".pdf", prefix="receipt_")
-    os.close(fd)  # 关闭文件描述符，以便其他进程可以写入该路径
+    with os.fdopen(fd, "wb") as f:  # 写完即关闭，以便打印程序可以读取该路径
+        f.write(pdf_bytes)
 
-    logger.debug(f"PDF模块: 临时PDF文件路径: {pdf_filepath}")
-
-    if not generate_pdf_from_html_content(html_content, pdf_filepath):
-        if os.path.exists(pdf_filepath):
-            try:
-                os.unlink(pdf_filepath)
-            except OSError:
-                logger.debug(f"PDF模块: 清理生成失败的临时文件 {pdf_filepath} 时出错 (可能文件未完全创建)。")
-        return False
+    logger.debug(f"PDF模块: 订单 {order_id} 的临时PDF文件路径: {pdf_filepath}")
 
     print_success = False
     if os.name == 'nt':  # Windows特定静默打印逻辑
@@ -194,6 +248,27 @@ def print_order(order_data, printer_name=None, keep_pdf_for_internal_debug=False
     return print_success
 
 
+def print_order(order_data, printer_name=None, keep_pdf_for_internal_debug=False, template="receipt"):
+    """
+    主接口函数：生成订单PDF并尝试静默打印。
+    app.py 应确保 order_data 中包含 'shop_name' 等模板所需信息。
+    """
+    logger.info(f"PDF模块: 处理订单 {order_data.get('order_id')}，打印机: '{printer_name if printer_name else '默认'}'")
+
+    if not WEASYPRINT_AVAILABLE:
+        logger.error("PDF模块: WeasyPrint库或其依赖不可用，无法执行打印。")
+        return False
+
+    if 'shop_name' not in order_data:
+        logger.warning("PDF模块: order_data 中缺少 'shop_name'。HTML模板将使用默认值或可能出错。")
+
+    pdf_bytes = render(order_data, template)
+    if not pdf_bytes:
+        return False
+
+    return print_rendered(pdf_bytes, printer_name, order_data.get('order_id'), keep_pdf_for_internal_debug)
+
+
 if __name__ == '__main__':
     # 配置基本日志，方便模块独立测试时查看输出
     logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -0,0 +1,286 @@
+# print_retry.py
+"""
+打印失败自动重试。
+
+打印失败按错误类别处理：
+- no_printer / config / render：未配置打印机、打印方式无效或渲染失败，重试也不会成功，只记录；
+- printer_unavailable / spool：打印机离线、缺纸或发送到打印队列失败，按指数退避加随机抖动重试，
+  最多 MAX_ATTEMPTS 次（含第一次打印）。
+
+每个订单的每个打印目标最多有一个待重试作业（print_jobs），每次尝试都记录在 print_attempts 中；
+第一次就打印成功的目标也记录为已完成的作业，订单的最终状态根据所有目标最近一次的结果决定。
+作业保存在主库里，应用重启后会继续重试。到期时目标打印机仍不健康则顺延，不消耗重试次数；
+打印机恢复健康（如换纸后）时立即重试该打印机上的所有待重试作业。
+多个实例共用数据库时，每个作业先获得 print_job:<ID> 租约再处理，同一作业只由一个实例打印。
+"""
+
+import datetime
+import json
+import logging
+import random
+
+from database import get_db_connection
+from leases import lease_manager
+from printer_inventory import printer_inventory
+
+logger = logging.getLogger(__name__)
+
+ERROR_NO_PRINTER = "no_printer"
+ERROR_CONFIG = "config"
+ERROR_RENDER = "render"
+ERROR_PRINTER_UNAVAILABLE = "printer_unavailable"
+ERROR_SPOOL = "spool"
+RETRYABLE_ERRORS = (ERROR_PRINTER_UNAVAILABLE, ERROR_SPOOL)
+
+MAX_ATTEMPTS = 6
+BASE_DELAY_SECONDS = 15
+MAX_DELAY_SECONDS = 15 * 60
+RETRY_MAX_AGE = datetime.timedelta(hours=6)  # 打印机一直不恢复时，超过该时间放弃
+POLL_INTERVAL = 10  # 秒
+BATCH_SIZE = 20
+
+STATE_PENDING = "pending"
+STATE_DONE = "done"
+STATE_FAILED = "failed"  # 不可重试的错误
+STATE_ABANDONED = "abandoned"  # 重试次数或时间用尽
+
+
+def init_print_retry_tables():
+    with get_db_connection() as conn:
+        if conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS print_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    db_id INTEGER NOT NULL,
+                    target_name TEXT NOT NULL,
+                    printer TEXT,
+                    target_json TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error_class TEXT,
+                    last_error TEXT,
+                    next_attempt_at TIMESTAMP,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS print_attempts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id INTEGER NOT NULL,
+                    attempted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    success INTEGER NOT NULL,
+                    error_class TEXT,
+                    error TEXT
+                )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_print_jobs_due ON print_jobs (state, next_attempt_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_print_jobs_order ON print_jobs (db_id, target_name)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_print_attempts_job ON print_attempts (job_id)")
+            conn.commit()
+
+
+def _utc_text(dt):
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def backoff_delay(attempts):
+    """第 attempts 次失败后的等待秒数：指数增长，上限 MAX_DELAY_SECONDS，并加入 50%~100% 的随机抖动。"""
+    delay = min(MAX_DELAY_SECONDS, BASE_DELAY_SECONDS * 2 ** max(attempts - 1, 0))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def _pending_job(conn, db_id, target_name):
+    return conn.execute("SELECT * FROM print_jobs WHERE db_id = ? AND target_name = ? AND state = ?",
+                        (db_id, target_name, STATE_PENDING)).fetchone()
+
+
+def record_failure(db_id, target, error_class, message):
+    """记录一次失败的打印尝试，并决定是否安排重试。返回作业的新状态。"""
+    now = datetime.datetime.utcnow()
+    with get_db_connection() as conn:
+        if not conn:
+            return None
+        job = _pending_job(conn, db_id, target["name"])
+        if job is None:
+            cursor = conn.execute(
+                "INSERT INTO print_jobs (db_id, target_name, printer, target_json, state) VALUES (?, ?, ?, ?, ?)",
+                (db_id, target["name"], target.get("printer"), json.dumps(target, ensure_ascii=False), STATE_PENDING))
+            job_id, attempts, created_at = cursor.lastrowid, 0, now
+        else:
+            job_id, attempts = job["id"], job["attempts"]
+            created_at = datetime.datetime.fromisoformat(job["created_at"])
+        attempts += 1
+
+        if error_class not in RETRYABLE_ERRORS:
+            state, next_attempt_at = STATE_FAILED, None
+        elif attempts >= MAX_ATTEMPTS or now - created_at > RETRY_MAX_AGE:
+            state, next_attempt_at = STATE_ABANDONED, None
+        else:
+            state = STATE_PENDING
+            next_attempt_at = _utc_text(now + datetime.timedelta(seconds=backoff_delay(attempts)))
+
+        conn.execute("UPDATE print_jobs SET state = ?, attempts = ?, error_class = ?, last_error = ?, "
+                     "next_attempt_at = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                     (state, attempts, error_class, message, next_attempt_at, job_id))
+        conn.execute("INSERT INTO print_attempts (job_id, success, error_class, error) VALUES (?, 0, ?, ?)",
+                     (job_id, error_class, message))
+        conn.commit()
+
+    if state == STATE_PENDING:
+        logger.warning(f"订单 {db_id} 打印到 {target['name']} 失败 ({error_class}: {message})，"
+                       f"第 {attempts} 次，将在 {next_attempt_at} (UTC) 重试。")
+    else:
+        logger.error(f"订单 {db_id} 打印到 {target['name']} 失败 ({error_class}: {message})，不再重试。")
+    return state
+
+
+def record_success(db_id, target):
+    """
+    打印成功（包括第一次打印和手动重打）：结束该目标的待重试作业；没有待重试作业时记录一个已完成的作业，
+    使 order_print_results 能看到第一次就打印成功的目标。返回是否结束了待重试作业。
+    """
+    with get_db_connection() as conn:
+        if not conn:
+            return False
+        job = _pending_job(conn, db_id, target["name"])
+        if job is None:
+            cursor = conn.execute(
+                "INSERT INTO print_jobs (db_id, target_name, printer, target_json, state, attempts) "
+                "VALUES (?, ?, ?, ?, ?, 1)",
+                (db_id, target["name"], target.get("printer"), json.dumps(target, ensure_ascii=False), STATE_DONE))
+            conn.execute("INSERT INTO print_attempts (job_id, success) VALUES (?, 1)", (cursor.lastrowid,))
+            conn.commit()
+            return False
+        conn.execute("UPDATE print_jobs SET state = ?, attempts = attempts + 1, next_attempt_at = NULL, "
+                     "updated_at = CURRENT_TIMESTAMP WHERE id = ?", (STATE_DONE, job["id"]))
+        conn.execute("INSERT INTO print_attempts (job_id, success) VALUES (?, 1)", (job["id"],))
+        conn.commit()
+    logger.info(f"订单 {db_id} 打印到 {target['name']} 重试成功。")
+    return True
+
+
+def has_print_history(db_id):
+    """订单是否已经尝试打印过（无论成败）。"""
+    with get_db_connection() as conn:
+        if not conn:
+            return False
+        return conn.execute("SELECT 1 FROM print_jobs WHERE db_id = ? LIMIT 1", (db_id,)).fetchone() is not None
+
+
+def order_print_results(db_id):
+    """订单各打印目标最近一次作业的结果 {目标名称: 是否成功}，不包含仍在重试中的目标。"""
+    with get_db_connection() as conn:
+        if not conn:
+            return {}
+        rows = conn.execute("SELECT target_name, state FROM print_jobs WHERE id IN "
+                            "(SELECT max(id) FROM print_jobs WHERE db_id = ? GROUP BY target_name)",
+                            (db_id,)).fetchall()
+    if any(row["state"] == STATE_PENDING for row in rows):
+        return None
+    return {row["target_name"]: row["state"] == STATE_DONE for row in rows}
+
+
+class PrintRetryQueue:
+    """
+    定时处理到期的重试作业。
+    attempt_func(order_data, target) 返回 (是否成功, 错误类别, 错误信息)；
+    load_order_func(db_id) 返回订单数据或 None；on_finished(db_id) 在作业结束（成功或放弃）后调用。
+    """
+
+    def __init__(self, attempt_func, load_order_func, on_finished=None):
+        self.attempt_func = attempt_func
+        self.load_order_func = load_order_func
+        self.on_finished = on_finished
+
+    def start(self, scheduler):
+        scheduler.add_job(func=self.process_due, trigger="interval", seconds=POLL_INTERVAL, id='print_retry_job',
+                          replace_existing=True, max_instances=1, coalesce=True)
+        printer_inventory.add_recovery_listener(self.wake_printer)
+
+    def _due_jobs(self):
+        with get_db_connection() as conn:
+            if not conn:
+                return []
+            return conn.execute("SELECT * FROM print_jobs WHERE state = ? AND next_attempt_at <= ? "
+                                "ORDER BY next_attempt_at LIMIT ?",
+                                (STATE_PENDING, _utc_text(datetime.datetime.utcnow()), BATCH_SIZE)).fetchall()
+
+    def _defer(self, job, reason):
+        """打印机仍不健康：顺延而不消耗重试次数，超过 RETRY_MAX_AGE 后放弃。返回作业是否已结束。"""
+        now = datetime.datetime.utcnow()
+        if now - datetime.datetime.fromisoformat(job["created_at"]) > RETRY_MAX_AGE:
+            target = json.loads(job["target_json"])
+            return record_failure(job["db_id"], target, ERROR_PRINTER_UNAVAILABLE, reason) != STATE_PENDING
+        next_attempt_at = _utc_text(now + datetime.timedelta(seconds=backoff_delay(job["attempts"])))
+        with get_db_connection() as conn:
+            if conn:
+                conn.execute("UPDATE print_jobs SET next_attempt_at = ?, last_error = ?, "
+                             "updated_at = CURRENT_TIMESTAMP WHERE id = ?", (next_attempt_at, reason, job["id"]))
+                conn.commit()
+        return False
+
+    def _still_due(self, job_id):
+        """获得租约后重新读取作业，其他实例可能刚刚处理过。"""
+        with get_db_connection() as conn:
+            if not conn:
+                return None
+            return conn.execute("SELECT * FROM print_jobs WHERE id = ? AND state = ? AND next_attempt_at <= ?",
+                                (job_id, STATE_PENDING, _utc_text(datetime.datetime.utcnow()))).fetchone()
+
+    def process_due(self):
+        """处理所有到期的重试作业，返回本实例处理的数量。"""
+        processed = 0
+        for job in self._due_jobs():
+            with lease_manager.claim(f"print_job:{job['id']}") as claimed:
+                job = claimed and self._still_due(job["id"])
+                if job:
+                    self._process(job)
+                    processed += 1
+        return processed
+
+    def _process(self, job):
+        target = json.loads(job["target_json"])
+        problem = printer_inventory.health_problem(target.get("printer"))
+        if problem:
+            if self._defer(job, problem) and self.on_finished:
+                self.on_finished(job["db_id"])
+            return
+
+        order_data = self.load_order_func(job["db_id"])
+        if order_data is None:
+            record_failure(job["db_id"], target, ERROR_CONFIG, "订单不存在")
+            if self.on_finished:
+                self.on_finished(job["db_id"])
+            return
+        try:
+            ok, error_class, message = self.attempt_func(order_data, target)
+        except Exception as e:
+            logger.exception(f"重试打印订单 {job['db_id']} 时发生未知错误: {e}")
+            ok, error_class, message = False, ERROR_SPOOL, str(e)
+
+        if ok:
+            record_success(job["db_id"], target)
+            finished = True
+        else:
+            finished = record_failure(job["db_id"], target, error_class, message) != STATE_PENDING
+        if finished and self.on_finished:
+            self.on_finished(job["db_id"])
+
+    def wake_printer(self, printer_name):
+        """打印机恢复健康：该打印机上的待重试作业立即到期。"""
+        with get_db_connection() as conn:
+            if not conn:
+                return
+            cursor = conn.execute("UPDATE print_jobs SET next_attempt_at = ? WHERE state = ? AND printer = ?",
+                                  (_utc_text(datetime.datetime.utcnow()), STATE_PENDING, printer_name))
+            conn.commit()
+        if cursor.rowcount:
+            logger.info(f"打印机 {printer_name} 已恢复，立即重试 {cursor.rowcount} 个打印作业。")
+
+    def status(self):
+        with get_db_connection() as conn:
+            if not conn:
+                return {}
+            rows = conn.execute("SELECT state, count(*) AS n FROM print_jobs GROUP BY state").fetchall()
+        return {row["state"]: row["n"] for row in rows}
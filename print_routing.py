@@ -0,0 +1,175 @@
+# print_routing.py
+"""
+多打印机分发路由。
+
+路由规则保存在设置项 print_routes 中（JSON 数组），每一项是一个打印目标，例如:
+    [
+        {"name": "kitchen", "printer": "Kitchen-80", "method": "escpos", "template": "kitchen",
+         "item_keywords": ["面", "饭"], "priority": 0},
+        {"name": "front", "printer": "Front-Desk", "method": "pdf", "template": "receipt", "priority": 1}
+    ]
+item_keywords 为空表示整单；否则只打印名称包含任一关键字的商品，没有匹配商品时跳过该目标。
+未配置路由时退回到 default_printer / print_method 的单一目标。
+
+所有目标并行分发，按 priority 从小到大提交（厨房单优先），慢的目标不会拖慢其他目标。
+"""
+
+import concurrent.futures
+import copy
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+TEMPLATES = ("receipt", "kitchen")
+METHODS = ("escpos", "pdf", "text")
+MAX_PARALLEL_TARGETS = 8
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_PARALLEL_TARGETS, thread_name_prefix="print")
+
+
+def normalize_target(raw, index):
+    """校验并补全单个打印目标，格式错误时抛出 ValueError。"""
+    if not isinstance(raw, dict):
+        raise ValueError(f"第 {index + 1} 个打印目标必须是对象")
+    printer = (raw.get("printer") or "").strip()
+    if not printer:
+        raise ValueError(f"第 {index + 1} 个打印目标缺少 printer")
+    method = raw.get("method") or "escpos"
+    if method not in METHODS:
+        raise ValueError(f"打印目标 {printer} 的 method 无效: {method}")
+    template = raw.get("template") or "receipt"
+    if template not in TEMPLATES:
+        raise ValueError(f"打印目标 {printer} 的 template 无效: {template}")
+    keywords = raw.get("item_keywords") or []
+    if not isinstance(keywords, list):
+        raise ValueError(f"打印目标 {printer} 的 item_keywords 必须是数组")
+    return {
+        "name": raw.get("name") or f"{template}@{printer}",
+        "printer": printer,
+        "method": method,
+        "template": template,
+        "item_keywords": [str(k) for k in keywords if k],
+        "priority": int(raw.get("priority", 0 if template == "kitchen" else 1)),
+    }
+
+
+def parse_routes(text):
+    """解析设置项中的路由 JSON，返回按优先级排序的目标列表。空字符串返回空列表。"""
+    if not text or not text.strip():
+        return []
+    try:
+        raw_targets = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"打印路由不是有效的 JSON: {e}")
+    if not isinstance(raw_targets, list):
+        raise ValueError("打印路由必须是 JSON 数组")
+    targets = [normalize_target(raw, i) for i, raw in enumerate(raw_targets)]
+    return sorted(targets, key=lambda target: target["priority"])
+
+
+def load_targets(get_setting):
+    """读取当前生效的打印目标。路由配置无效时记录错误并退回默认打印机。"""
+    try:
+        targets = parse_routes(get_setting('print_routes'))
+    except ValueError as e:
+        logger.error(f"打印路由配置无效，使用默认打印机: {e}")
+        targets = []
+    if targets:
+        return targets
+
+    default_printer = get_setting('default_printer')
+    if not default_printer:
+        return []
+    return [{
+        "name": "default",
+        "printer": default_printer,
+        "method": get_setting('print_method') or 'escpos',
+        "template": "receipt",
+        "item_keywords": [],
+        "priority": 0,
+    }]
+
+
+def select_items(order_data, target):
+    """返回该目标需要打印的订单副本；按关键字筛选后没有商品时返回 None。"""
+    keywords = target["item_keywords"]
+    if not keywords:
+        return order_data
+    items = [item for item in order_data.get("line_items", [])
+             if any(keyword in (item.get("name") or "") for keyword in keywords)]
+    if not items:
+        return None
+    subset = copy.copy(order_data)
+    subset["line_items"] = items
+    return subset
+
+
+def dispatch_to_targets(order_data, targets, print_func, executor=None):
+    """
+    将订单并行分发到所有目标，print_func(order_subset, target) 返回是否成功。
+    executor 默认为共享的打印线程池，多店铺时各店铺使用自己的线程池。
+    返回 {目标名称: 是否成功}，被跳过的目标不出现在结果中。
+    """
+    executor = executor or _executor
+    futures = {}
+    for target in targets:  # 已按优先级排序，厨房单先提交
+        subset = select_items(order_data, target)
+        if subset is None:
+            continue
+        futures[executor.submit(print_func, subset, target)] = target["name"]
+
+    results = {}
+    for future in concurrent.futures.as_completed(futures):
+        name = futures[future]
+        try:
+            results[name] = bool(future.result())
+        except Exception as e:
+            logger.exception(f"打印目标 {name} 执行出错: {e}")
+            results[name] = False
+    return results
+
+
+def dispatch_batch_to_targets(orders_data, targets, print_batch_func, executor=None, db_ids=None):
+    """
+    批量版本：每个目标收到一个订单子集列表，各目标并行执行。
+    print_batch_func(order_subsets, target) 返回与子集一一对应的成功标志列表；传入与 orders_data
+    一一对应的 db_ids 时调用 print_batch_func(order_subsets, target, 子集的 db_ids)，用于记录打印结果。
+    executor 与 dispatch_to_targets 相同，多店铺时传入订单所属店铺的线程池。
+    返回与 orders_data 一一对应的 {目标名称: 是否成功} 列表。
+    """
+    executor = executor or _executor
+    results = [{} for _ in orders_data]
+    futures = {}
+    for target in targets:
+        indexed = [(i, select_items(order_data, target)) for i, order_data in enumerate(orders_data)]
+        indexed = [(i, subset) for i, subset in indexed if subset is not None]
+        if indexed:
+            args = [[subset for _, subset in indexed], target]
+            if db_ids is not None:
+                args.append([db_ids[i] for i, _ in indexed])
+            future = executor.submit(print_batch_func, *args)
+            futures[future] = (target["name"], [i for i, _ in indexed])
+
+    for future in concurrent.futures.as_completed(futures):
+        name, indices = futures[future]
+        try:
+            flags = future.result()
+        except Exception as e:
+            logger.exception(f"打印目标 {name} 批量执行出错: {e}")
+            flags = [False] * len(indices)
+        for i, ok in zip(indices, flags):
+            results[i][name] = bool(ok)
+    return results
+
+
+def summarize_status(results):
+    """根据各目标结果生成订单状态文本。"""
+    if not results:
+        return "打印失败 (无匹配的打印目标)"
+    failed = [name for name, ok in results.items() if not ok]
+    if not failed:
+        return "已打印"
+    if len(failed) == len(results):
+        return "打印失败"
+    return f"打印失败 (部分: {', '.join(failed)})"
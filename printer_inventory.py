@@ -0,0 +1,203 @@
+# printer_inventory.py
+"""
+打印机清单和健康状态。
+
+后台定时刷新打印机列表和每台打印机的状态（是否在线、缺纸、队列中的作业数），设置页面和
+打印流程都读取缓存结果，不再在请求中同步调用 EnumPrinters。
+
+打印前通过 health_problem() 检查目标打印机；不健康时打印流程最多等待 PRINT_HOLD_SECONDS
+等它恢复，仍不健康则直接跳过，不再对离线或缺纸的打印机发送注定失败的作业。
+
+后端可插拔：Windows 上默认使用 win32print，其他系统（或 PRINTER_BACKEND=fake）使用
+FakePrinterBackend，方便在 Linux 上测试。
+"""
+
+import datetime
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+REFRESH_INTERVAL = 15  # 秒
+PRINT_HOLD_SECONDS = 5
+
+# winspool.h 中的 PRINTER_STATUS_* 标志
+PRINTER_STATUS_FLAGS = {
+    0x00000001: "已暂停",
+    0x00000002: "错误",
+    0x00000008: "卡纸",
+    0x00000010: "缺纸",
+    0x00000040: "纸张问题",
+    0x00000080: "离线",
+    0x00001000: "不可用",
+    0x00040000: "墨粉不足",
+    0x00100000: "需要人工干预",
+    0x00400000: "机盖打开",
+}
+UNHEALTHY_STATUS_MASK = 0x00000001 | 0x00000002 | 0x00000008 | 0x00000010 | 0x00000040 | 0x00000080 | \
+                        0x00001000 | 0x00100000 | 0x00400000
+PRINTER_ATTRIBUTE_WORK_OFFLINE = 0x00000400
+
+
+def describe_status(status, attributes=0):
+    """将 Windows 打印机状态位转换为 (是否在线, 是否缺纸, 问题列表)。"""
+    problems = [text for flag, text in PRINTER_STATUS_FLAGS.items() if status & flag]
+    online = not (status & 0x00000080) and not (attributes & PRINTER_ATTRIBUTE_WORK_OFFLINE)
+    if not online and "离线" not in problems:
+        problems.append("离线")
+    healthy = online and not (status & UNHEALTHY_STATUS_MASK)
+    return {
+        "online": online,
+        "paper_out": bool(status & 0x00000010),
+        "problems": problems,
+        "healthy": healthy,
+    }
+
+
+class Win32PrinterBackend:
+    name = "win32"
+
+    def list_printers(self):
+        import win32print  # 只在 Windows 后端中导入
+
+        flags = win32print.PRINTER_ENUM_LOCAL | win32print.PRINTER_ENUM_CONNECTIONS
+        printers = []
+        for info in win32print.EnumPrinters(flags, None, 2):
+            entry = {"name": info["pPrinterName"], "jobs": info.get("cJobs", 0)}
+            entry.update(describe_status(info.get("Status", 0), info.get("Attributes", 0)))
+            printers.append(entry)
+        return printers
+
+
+class FakePrinterBackend:
+    """内存中的假打印机，用 set_status() 模拟缺纸、离线等状态。"""
+    name = "fake"
+
+    def __init__(self, names=("Fake-Receipt-80", "Fake-Kitchen-80")):
+        self._lock = threading.Lock()
+        self._printers = {name: {"status": 0, "attributes": 0, "jobs": 0} for name in names}
+
+    def set_status(self, name, status=None, attributes=None, jobs=None):
+        with self._lock:
+            printer = self._printers.setdefault(name, {"status": 0, "attributes": 0, "jobs": 0})
+            for key, value in (("status", status), ("attributes", attributes), ("jobs", jobs)):
+                if value is not None:
+                    printer[key] = value
+
+    def remove(self, name):
+        with self._lock:
+            self._printers.pop(name, None)
+
+    def list_printers(self):
+        with self._lock:
+            printers = []
+            for name, printer in self._printers.items():
+                entry = {"name": name, "jobs": printer["jobs"]}
+                entry.update(describe_status(printer["status"], printer["attributes"]))
+                printers.append(entry)
+            return printers
+
+
+def default_backend():
+    choice = os.environ.get("PRINTER_BACKEND") or ("win32" if os.name == "nt" else "fake")
+    if choice == "fake":
+        return FakePrinterBackend()
+    return Win32PrinterBackend()
+
+
+class PrinterInventory:
+    def __init__(self, backend=None, interval=REFRESH_INTERVAL):
+        self.backend = backend or default_backend()
+        self.interval = interval
+        self._cond = threading.Condition()
+        self._printers = {}
+        self.refreshed_at = None
+        self.last_error = None
+        self._recovery_listeners = []
+
+    def add_recovery_listener(self, listener):
+        """打印机从异常恢复健康时调用 listener(打印机名称)。"""
+        self._recovery_listeners.append(listener)
+
+    def refresh(self):
+        """刷新打印机清单。后端出错时保留上一次的结果。"""
+        try:
+            printers = self.backend.list_printers()
+        except Exception as e:
+            logger.error(f"刷新打印机列表失败: {e}")
+            with self._cond:
+                self.last_error = str(e)
+            return False
+        with self._cond:
+            previous = self._printers
+            self._printers = {printer["name"]: printer for printer in printers}
+            self.refreshed_at = datetime.datetime.now()
+            self.last_error = None
+            self._cond.notify_all()
+        for name, printer in self._printers.items():
+            old = previous.get(name)
+            if old and old["healthy"] != printer["healthy"]:
+                state = "已恢复" if printer["healthy"] else f"异常: {', '.join(printer['problems'])}"
+                logger.warning(f"打印机 {name} {state}")
+                if printer["healthy"]:
+                    for listener in self._recovery_listeners:
+                        try:
+                            listener(name)
+                        except Exception as e:
+                            logger.error(f"处理打印机 {name} 恢复事件失败: {e}")
+        return True
+
+    def start(self, scheduler):
+        self.refresh()
+        scheduler.add_job(func=self.refresh, trigger="interval", seconds=self.interval, id='printer_inventory_job',
+                          replace_existing=True, max_instances=1, coalesce=True)
+
+    def printers(self):
+        with self._cond:
+            return sorted(self._printers.values(), key=lambda printer: printer["name"])
+
+    def printer_names(self):
+        return [printer["name"] for printer in self.printers()]
+
+    def health_problem(self, printer_name):
+        """返回打印机的问题描述，健康或无法判断（尚未刷新、未指定打印机）时返回 None。"""
+        if not printer_name:
+            return None
+        with self._cond:
+            if self.refreshed_at is None:
+                return None
+            printer = self._printers.get(printer_name)
+            if printer is None:
+                return "未找到打印机"
+            if printer["healthy"]:
+                return None
+            return ", ".join(printer["problems"]) or "状态异常"
+
+    def wait_until_healthy(self, printer_name, timeout=PRINT_HOLD_SECONDS):
+        """等待打印机恢复健康，返回最终的问题描述（None 表示可以打印）。"""
+        deadline = datetime.datetime.now() + datetime.timedelta(seconds=timeout)
+        problem = self.health_problem(printer_name)
+        while problem:
+            remaining = (deadline - datetime.datetime.now()).total_seconds()
+            if remaining <= 0:
+                break
+            self.refresh()  # 主动刷新一次，不必等下一个周期
+            problem = self.health_problem(printer_name)
+            if problem:
+                with self._cond:
+                    self._cond.wait(min(remaining, 1.0))
+                problem = self.health_problem(printer_name)
+        return problem
+
+    def status(self):
+        with self._cond:
+            return {
+                "backend": self.backend.name,
+                "refreshed_at": self.refreshed_at.isoformat() if self.refreshed_at else None,
+                "last_error": self.last_error,
+                "printers": sorted(self._printers.values(), key=lambda printer: printer["name"]),
+            }
+
+
+printer_inventory = PrinterInventory()
@@ -0,0 +1,124 @@
+# rate_limiter.py
+"""
+AllValue API 客户端限流。
+
+所有 GraphQL 请求共享一个 ApiLimiter：
+- 令牌桶限制请求速率（ALLVALUE_RATE 次/秒，突发 ALLVALUE_BURST 次）；
+- 并发上限按 AIMD 自适应：请求成功且延迟正常时加性增加，延迟过高时小幅下调，
+  遇到 HTTP 429 或 GraphQL 限流错误时减半，并暂停所有请求直到 Retry-After 或退避时间结束；
+- 两级优先级：实时 Webhook 拉取 (PRIORITY_LIVE) 有等待时，补单请求 (PRIORITY_BACKFILL) 让行。
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_LIVE = 0
+PRIORITY_BACKFILL = 1
+
+DEFAULT_RATE = float(os.environ.get("ALLVALUE_RATE", "2"))
+DEFAULT_BURST = int(os.environ.get("ALLVALUE_BURST", "4"))
+DEFAULT_MAX_CONCURRENCY = int(os.environ.get("ALLVALUE_MAX_CONCURRENCY", "8"))
+TARGET_LATENCY = 2.0  # 秒，超过则认为服务端开始吃紧
+LATENCY_DECREASE = 0.8
+THROTTLE_DECREASE = 0.5
+MAX_BACKOFF = 60.0
+
+
+class ApiLimiter:
+    """令牌桶 + AIMD 自适应并发 + 优先级，线程安全。"""
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 min_concurrency=1, target_latency=TARGET_LATENCY):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.target_latency = target_latency
+        self._cond = threading.Condition()
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._limit = float(max(min_concurrency, max_concurrency // 2))
+        self._in_flight = 0
+        self._waiting = {PRIORITY_LIVE: 0, PRIORITY_BACKFILL: 0}
+        self._paused_until = 0.0
+        self._consecutive_throttles = 0
+        self.throttled_total = 0
+        self.requests_total = 0
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _wait_time(self, priority, now):
+        """返回 0 表示可以立即发送，否则返回建议等待的秒数（None 表示等待其他请求完成）。"""
+        if now < self._paused_until:
+            return self._paused_until - now
+        if priority != PRIORITY_LIVE and self._waiting[PRIORITY_LIVE]:
+            return None
+        if self._in_flight >= int(self._limit):
+            return None
+        self._refill(now)
+        if self._tokens < 1:
+            return (1 - self._tokens) / self.rate
+        return 0
+
+    def acquire(self, priority=PRIORITY_LIVE):
+        with self._cond:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    wait = self._wait_time(priority, time.monotonic())
+                    if wait == 0:
+                        self._tokens -= 1
+                        self._in_flight += 1
+                        self.requests_total += 1
+                        return
+                    self._cond.wait(wait)
+            finally:
+                self._waiting[priority] -= 1
+                self._cond.notify_all()  # 实时请求离开等待队列后唤醒补单请求
+
+    def release(self, latency, throttled=False, retry_after=None):
+        """
+        请求结束时调用。throttled 为 True 时并发减半并暂停所有请求，返回暂停的秒数；
+        否则根据延迟调整并发上限，返回 0。
+        """
+        with self._cond:
+            self._in_flight -= 1
+            pause = 0.0
+            if throttled:
+                self.throttled_total += 1
+                self._consecutive_throttles += 1
+                self._limit = max(self.min_concurrency, self._limit * THROTTLE_DECREASE)
+                backoff = min(MAX_BACKOFF, 2 ** (self._consecutive_throttles - 1))
+                pause = retry_after if retry_after is not None else backoff * random.uniform(0.5, 1.0)
+                self._paused_until = max(self._paused_until, time.monotonic() + pause)
+                logger.warning(f"AllValue API 限流，并发上限降至 {int(self._limit)}，暂停 {pause:.1f} 秒。")
+            elif latency is not None:
+                self._consecutive_throttles = 0
+                if latency > self.target_latency:
+                    self._limit = max(self.min_concurrency, self._limit * LATENCY_DECREASE)
+                else:
+                    self._limit = min(self.max_concurrency, self._limit + 1 / self._limit)
+            self._cond.notify_all()
+            return pause
+
+    def stats(self):
+        with self._cond:
+            return {
+                "concurrency_limit": int(self._limit),
+                "in_flight": self._in_flight,
+                "waiting_live": self._waiting[PRIORITY_LIVE],
+                "waiting_backfill": self._waiting[PRIORITY_BACKFILL],
+                "paused_for": max(0.0, round(self._paused_until - time.monotonic(), 1)),
+                "requests_total": self.requests_total,
+                "throttled_total": self.throttled_total,
+            }
+
+
+api_limiter = ApiLimiter()
@@ -0,0 +1,231 @@
+# receipt_cache.py
+"""
+预渲染小票缓存。
+
+订单入库后立即在后台渲染各打印目标需要的小票（ESC/POS 字节或 PDF 字节），
+首次自动打印时直接发送缓存的字节，不再在关键路径上渲染模板或生成 PDF。
+
+缓存键由订单号、订单内容哈希、打印方式、模板名和模板版本组成，订单内容或模板
+变化后自动失效。缓存分两级：内存（按总字节数限制）和磁盘（receipt_cache/ 目录，
+按总字节数淘汰最早渲染的文件）。同一个键同时只会渲染一次，打印线程会等待正在进行的
+后台渲染而不是重复渲染。
+
+小票上的"打印时间"是渲染时间，因此预渲染的小票只用一次：打印时取出即删除，渲染后超过
+MAX_AGE_SECONDS 秒仍未打印则作废。重打、重试和较晚的手动打印都在打印时重新渲染（不写入缓存），
+打印时间总是实际打印的时间。
+"""
+
+import collections
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = 'receipt_cache'
+MEMORY_LIMIT_BYTES = 32 * 1024 * 1024
+DISK_LIMIT_BYTES = 256 * 1024 * 1024
+RENDER_WORKERS = 2
+MAX_AGE_SECONDS = 120  # 预渲染后在此时间内打印才使用缓存，小票上的打印时间误差不超过该值
+
+
+def content_hash(order_data):
+    payload = json.dumps(order_data, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def make_key(order_data, method, template, template_version):
+    order_id = str(order_data.get('order_id') or 'unknown')
+    safe_order_id = "".join(c if c.isalnum() else "_" for c in order_id)
+    return f"{safe_order_id}-{content_hash(order_data)}-{method}-{template}-{template_version}"
+
+
+class ReceiptCache:
+    """两级缓存，值为预渲染的小票字节串，每个条目只使用一次。"""
+
+    def __init__(self, cache_dir=CACHE_DIR, memory_limit=MEMORY_LIMIT_BYTES, disk_limit=DISK_LIMIT_BYTES,
+                 max_age=MAX_AGE_SECONDS):
+        self.cache_dir = cache_dir
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._memory = collections.OrderedDict()  # 键 -> (渲染时间, 字节)，按渲染先后排列
+        self._memory_bytes = 0
+        self._pending = {}  # 正在渲染的键 -> Future
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=RENDER_WORKERS,
+                                                               thread_name_prefix="prerender")
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    # --- 内存层 ---
+    def _memory_pop(self, key):
+        entry = self._memory.pop(key, None)
+        if entry is not None:
+            self._memory_bytes -= len(entry[1])
+        return entry
+
+    def _memory_put(self, key, data, rendered_at):
+        if len(data) > self.memory_limit:
+            return
+        self._memory_pop(key)
+        self._memory[key] = (rendered_at, data)
+        self._memory_bytes += len(data)
+        while self._memory and (self._memory_bytes > self.memory_limit
+                                or next(iter(self._memory.values()))[0] < rendered_at - self.max_age):
+            _, (_, evicted) = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    # --- 磁盘层 ---
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key + ".bin")
+
+    def _disk_pop(self, key):
+        """读取并删除磁盘上的条目，返回 (渲染时间, 字节) 或 None。"""
+        path = self._disk_path(key)
+        try:
+            rendered_at = os.path.getmtime(path)
+            with open(path, "rb") as f:
+                data = f.read()
+            os.unlink(path)
+            return rendered_at, data
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning(f"读取小票缓存 {path} 失败: {e}")
+            return None
+
+    def _disk_put(self, key, data):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._disk_path(key))
+        except OSError as e:
+            logger.warning(f"写入小票缓存失败: {e}")
+            return
+        self._evict_disk()
+
+    def _evict_disk(self):
+        """删除已过期的文件，总大小仍超过上限时按渲染时间从早到晚删除。"""
+        try:
+            entries = []
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith(".bin"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            return
+        total = sum(size for _, size, _ in entries)
+        oldest_valid = time.time() - self.max_age
+        for mtime, size, path in sorted(entries):
+            if mtime >= oldest_valid and total <= self.disk_limit:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                pass
+
+    # --- 对外接口 ---
+    def take(self, key):
+        """取出预渲染的字节并从缓存中删除；不存在或已过期时返回 None。"""
+        with self._lock:
+            entry = self._memory_pop(key)
+        disk_entry = self._disk_pop(key)
+        entry = entry or disk_entry
+        if entry is None:
+            return None
+        rendered_at, data = entry
+        if time.time() - rendered_at > self.max_age:
+            with self._lock:
+                self.expired += 1
+            return None
+        return data
+
+    def put(self, key, data):
+        rendered_at = time.time()
+        with self._lock:
+            self._memory_put(key, data, rendered_at)
+        self._disk_put(key, data)
+
+    def _render_into(self, key, render, future, store):
+        """执行渲染（store 为 True 时写入缓存），结果同时设置到 future 上供等待者使用。"""
+        try:
+            data = render()
+            if data and store:
+                self.put(key, data)
+            future.set_result(data)
+            return data
+        except Exception as e:
+            logger.warning(f"渲染小票 {key} 失败: {e}")
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def _claim(self, key):
+        """返回 (future, 是否由调用方负责渲染)。已有渲染进行中时复用其 future。"""
+        with self._lock:
+            future = self._pending.get(key)
+            if future is not None:
+                return future, False
+            future = concurrent.futures.Future()
+            self._pending[key] = future
+            return future, True
+
+    def take_or_render(self, key, render):
+        """
+        打印时调用：取出预渲染的字节，或等待正在进行的后台渲染；都没有时在当前线程渲染（不写入缓存）。
+        渲染失败返回 None。
+        """
+        data = self.take(key)
+        with self._lock:
+            if data is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if data is not None:
+            return data
+        future, owner = self._claim(key)
+        try:
+            if owner:
+                return self._render_into(key, render, future, store=False)
+            data = future.result()
+        except Exception:
+            return None
+        self.take(key)  # 后台渲染已写入缓存，本次打印已使用
+        return data
+
+    def prerender(self, key, render):
+        """在后台渲染并缓存；已缓存时无操作。"""
+        with self._lock:
+            if key in self._memory or key in self._pending:
+                return
+        if os.path.exists(self._disk_path(key)):
+            return
+        future, owner = self._claim(key)
+        if owner:
+            self._executor.submit(self._render_into, key, render, future, True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "pending": len(self._pending),
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+            }
+
+
+receipt_cache = ReceiptCache()
@@ -0,0 +1,250 @@
+# retention.py
+"""
+订单保留与归档。
+
+超过保留天数（设置项 retention_days）的订单会以 order_codec 的压缩格式移入归档库 orders_archive.db，
+主库中只保留一行轻量的摘要（order_summaries），并在业务低峰期执行增量 VACUUM 回收空间，
+使主库足够小、可以完全驻留在页缓存中。已归档订单仍可通过 order_id 或原数据库 ID 查询；
+order_exists 通过摘要表识别已归档订单，补单和导入不会把它们重新写回主库，状态更新也会同步到归档库。
+"""
+
+import datetime
+import json
+import logging
+import sqlite3
+import zlib
+
+from database import get_db_connection, get_setting, get_order_by_db_id
+from order_codec import encode_order, decode_order, is_encoded
+from order_search import remove_from_index
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DB_NAME = 'orders_archive.db'
+DEFAULT_RETENTION_DAYS = 90
+ARCHIVE_BATCH_SIZE = 500
+VACUUM_PAGES_PER_RUN = 2000  # 每次增量 VACUUM 回收的最大页数
+
+
+def get_archive_connection():
+    """获取归档库连接，首次使用时建表。"""
+    try:
+        conn = sqlite3.connect(ARCHIVE_DB_NAME)
+        conn.row_factory = sqlite3.Row
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS archived_orders (
+                order_id TEXT PRIMARY KEY,
+                db_id INTEGER,
+                archive_month TEXT,
+                order_blob BLOB,
+                status TEXT,
+                created_at TIMESTAMP
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_archived_orders_db_id ON archived_orders (db_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_archived_orders_month ON archived_orders (archive_month)")
+        return conn
+    except sqlite3.Error as e:
+        logger.error(f"归档库连接错误: {e}")
+        return None
+
+
+def init_retention_tables():
+    """在主库中创建归档订单的摘要表。"""
+    with get_db_connection() as conn:
+        if conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS order_summaries (
+                    order_id TEXT PRIMARY KEY,
+                    db_id INTEGER,
+                    status TEXT,
+                    created_at TIMESTAMP,
+                    total_amount TEXT,
+                    currency_code TEXT,
+                    customer_name TEXT,
+                    phone TEXT,
+                    archive_month TEXT
+                )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders (created_at)")
+            conn.commit()
+
+
+def _to_archive_blob(order_json):
+    """主库中的值已是二进制格式时原样归档，旧的 JSON 文本行重新编码。"""
+    if is_encoded(order_json):
+        return bytes(order_json)
+    try:
+        return encode_order(decode_order(order_json))
+    except ValueError:
+        return zlib.compress((order_json or "").encode("utf-8"))
+
+
+def _summarize(order_json):
+    try:
+        order = decode_order(order_json)
+    except ValueError:
+        order = {}
+    total_price = order.get("total_price") or {}
+    shipping = order.get("shipping_address") or {}
+    customer = order.get("customer_info") or {}
+    name = f"{customer.get('firstName') or ''} {customer.get('lastName') or ''}".strip()
+    return total_price.get("amount"), total_price.get("currency_code"), name, shipping.get("phone")
+
+
+def archive_old_orders(retention_days=None, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    将创建时间早于保留期限的订单移入归档库，返回归档的订单数量。
+
+    每批先写入归档库并提交，再在主库的同一事务中写摘要、删除原行。
+    中途崩溃时重跑是安全的：归档写入是幂等的 INSERT OR REPLACE。
+    """
+    if retention_days is None:
+        retention_days = int(get_setting('retention_days') or DEFAULT_RETENTION_DAYS)
+    cutoff = (datetime.datetime.utcnow() - datetime.timedelta(days=retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+
+    archive_conn = get_archive_connection()
+    if archive_conn is None:
+        return 0
+
+    archived = 0
+    try:
+        while True:
+            with get_db_connection() as conn:
+                rows = conn.execute(
+                    "SELECT id, order_id, order_json, status, created_at FROM orders "
+                    "WHERE created_at < ? ORDER BY id LIMIT ?", (cutoff, batch_size)
+                ).fetchall()
+                if not rows:
+                    break
+
+                with archive_conn:
+                    archive_conn.executemany(
+                        "INSERT OR REPLACE INTO archived_orders "
+                        "(order_id, db_id, archive_month, order_blob, status, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                        [(row["order_id"], row["id"], (row["created_at"] or "")[:7],
+                          _to_archive_blob(row["order_json"]),
+                          row["status"], row["created_at"]) for row in rows]
+                    )
+
+                summaries = []
+                for row in rows:
+                    amount, currency, name, phone = _summarize(row["order_json"])
+                    summaries.append((row["order_id"], row["id"], row["status"], row["created_at"],
+                                      amount, currency, name, phone, (row["created_at"] or "")[:7]))
+                conn.executemany(
+                    "INSERT OR REPLACE INTO order_summaries (order_id, db_id, status, created_at, total_amount, "
+                    "currency_code, customer_name, phone, archive_month) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    summaries
+                )
+                conn.executemany("DELETE FROM orders WHERE id = ?", [(row["id"],) for row in rows])
+                remove_from_index(conn, [row["id"] for row in rows])
+                conn.commit()
+                archived += len(rows)
+    finally:
+        archive_conn.close()
+
+    if archived:
+        logger.info(f"已归档 {archived} 个早于 {cutoff} 的订单。")
+    return archived
+
+
+def ensure_incremental_vacuum():
+    """确保主库使用增量 auto_vacuum 模式。已有数据库切换模式需要一次完整 VACUUM。"""
+    with get_db_connection() as conn:
+        if not conn:
+            return
+        mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        if mode != 2:  # 2 = INCREMENTAL
+            logger.info("主库切换为增量 auto_vacuum 模式，执行一次完整 VACUUM...")
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+
+
+def incremental_vacuum(max_pages=VACUUM_PAGES_PER_RUN):
+    """回收最多 max_pages 个空闲页，返回回收前的空闲页数。"""
+    with get_db_connection() as conn:
+        if not conn:
+            return 0
+        freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if freelist:
+            conn.execute(f"PRAGMA incremental_vacuum({int(max_pages)})").fetchall()
+            logger.info(f"增量 VACUUM：空闲页 {freelist}，本次最多回收 {max_pages} 页。")
+        return freelist
+
+
+def run_retention():
+    """低峰期执行的维护任务：归档过期订单并回收空间。"""
+    try:
+        archive_old_orders()
+        ensure_incremental_vacuum()
+        incremental_vacuum()
+    except sqlite3.Error as e:
+        logger.error(f"订单归档维护失败: {e}")
+
+
+def _decode_archived(row):
+    blob = row["order_blob"]
+    try:
+        if is_encoded(blob):
+            order_json = decode_order(blob)
+        else:  # 早期归档：zlib 压缩的 JSON 文本
+            order_json = json.loads(zlib.decompress(blob).decode("utf-8"))
+    except (zlib.error, ValueError):
+        logger.error(f"解析归档订单失败，订单 ID: {row['order_id']}")
+        order_json = {}
+    order_json.setdefault("order_id", row["order_id"])
+    return {
+        "id": row["db_id"],
+        "order_id": row["order_id"],
+        "order_json": order_json,
+        "status": row["status"],
+        "created_at": row["created_at"],
+        "archived": True,
+    }
+
+
+def get_archived_order(order_id=None, db_id=None):
+    """按 order_id 或原数据库 ID 查询归档订单。"""
+    archive_conn = get_archive_connection()
+    if archive_conn is None:
+        return None
+    try:
+        if order_id is not None:
+            row = archive_conn.execute("SELECT * FROM archived_orders WHERE order_id = ?", (order_id,)).fetchone()
+        else:
+            row = archive_conn.execute("SELECT * FROM archived_orders WHERE db_id = ?", (db_id,)).fetchone()
+        return _decode_archived(row) if row else None
+    finally:
+        archive_conn.close()
+
+
+def update_archived_status(status_by_db_id):
+    """更新归档库中订单的状态（主库摘要由调用方更新），返回更新的行数。"""
+    archive_conn = get_archive_connection()
+    if archive_conn is None:
+        return 0
+    try:
+        with archive_conn:
+            cursor = archive_conn.executemany("UPDATE archived_orders SET status = ? WHERE db_id = ?",
+                                              [(status, db_id) for db_id, status in status_by_db_id.items()])
+        if cursor.rowcount > 0:
+            logger.info(f"更新 {cursor.rowcount} 个已归档订单的状态。")
+        return cursor.rowcount
+    finally:
+        archive_conn.close()
+
+
+def find_order_by_order_id(order_id):
+    """按 order_id 查询订单，主库中不存在时透明地回退到归档库。"""
+    with get_db_connection() as conn:
+        if conn:
+            row = conn.execute("SELECT id FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+            if row:
+                return get_order_by_db_id(row["id"])
+    return get_archived_order(order_id=order_id)
+
+
+def find_order_by_db_id(db_id):
+    """按数据库 ID 查询订单，包括已归档的订单。"""
+    return get_order_by_db_id(db_id) or get_archived_order(db_id=db_id)
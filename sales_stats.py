@@ -0,0 +1,222 @@
+# sales_stats.py
+"""
+销售统计聚合表。
+
+按本地时间的小时桶维护两张汇总表，在 database.py 写入订单的同一事务中增量更新：
+- sales_hourly: 每小时、每种货币的订单数和营业额（以分为单位的整数，避免浮点误差）；
+- item_hourly:  每小时各商品的销量。
+订单被更新时先扣除旧内容的贡献再加上新内容，重复写入不会重复计数；订单归档不影响统计。
+
+报表只读取汇总表的列，用 NumPy 按日 / 周 / 月分组求和，不需要逐行解码 order_json。
+NumPy 在第一次生成报表时才导入，不拖慢应用启动；未安装时退回到纯 Python 实现，结果相同。
+"""
+
+import datetime
+import decimal
+import logging
+
+logger = logging.getLogger(__name__)
+
+PERIODS = ("hour", "day", "week", "month")
+DEFAULT_CURRENCY = "CNY"
+TOP_ITEMS = 20
+
+_numpy = None
+
+
+def _load_numpy():
+    """延迟导入 NumPy（database.py 在启动路径上导入本模块），未安装时返回 None。"""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy or None
+
+
+def create_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sales_hourly (
+            bucket TEXT NOT NULL,
+            currency TEXT NOT NULL,
+            order_count INTEGER NOT NULL DEFAULT 0,
+            revenue_cents INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, currency)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS item_hourly (
+            bucket TEXT NOT NULL,
+            item_name TEXT NOT NULL,
+            quantity INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, item_name)
+        )
+    ''')
+
+
+def bucket_of(order_data):
+    """订单创建时间所在的本地小时桶，格式 YYYY-MM-DD HH。缺少创建时间时使用当前时间。"""
+    created_at = order_data.get("created_at")
+    try:
+        created = datetime.datetime.fromisoformat(str(created_at).replace("Z", "+00:00"))
+        if created.tzinfo is not None:
+            created = created.astimezone()  # 转换为本机时区
+    except ValueError:
+        created = datetime.datetime.now()
+    return created.strftime("%Y-%m-%d %H")
+
+
+def to_cents(amount):
+    try:
+        return int((decimal.Decimal(str(amount)) * 100).to_integral_value(decimal.ROUND_HALF_UP))
+    except (decimal.InvalidOperation, TypeError):
+        return 0
+
+
+def contribution(order_data):
+    """返回订单对统计的贡献: (小时桶, 货币, 金额(分), {商品名: 数量})。"""
+    total = order_data.get("total_price") or {}
+    items = {}
+    for item in order_data.get("line_items") or []:
+        name = item.get("name") or "未知商品"
+        try:
+            quantity = int(item.get("quantity") or 0)
+        except (TypeError, ValueError):
+            quantity = 0
+        items[name] = items.get(name, 0) + quantity
+    return bucket_of(order_data), total.get("currency_code") or DEFAULT_CURRENCY, to_cents(total.get("amount")), items
+
+
+def apply_order(conn, order_data, sign=1):
+    """将订单计入（sign=1）或移出（sign=-1）汇总表。调用方负责提交事务。"""
+    bucket, currency, cents, items = contribution(order_data)
+    conn.execute('''
+        INSERT INTO sales_hourly (bucket, currency, order_count, revenue_cents) VALUES (?, ?, ?, ?)
+        ON CONFLICT(bucket, currency) DO UPDATE SET
+            order_count = order_count + excluded.order_count,
+            revenue_cents = revenue_cents + excluded.revenue_cents
+    ''', (bucket, currency, sign, sign * cents))
+    conn.executemany('''
+        INSERT INTO item_hourly (bucket, item_name, quantity) VALUES (?, ?, ?)
+        ON CONFLICT(bucket, item_name) DO UPDATE SET quantity = quantity + excluded.quantity
+    ''', [(bucket, name, sign * quantity) for name, quantity in items.items()])
+
+
+def replace_order(conn, old_order_data, new_order_data):
+    """订单内容更新：扣除旧贡献并计入新贡献。old_order_data 为 None 表示新订单。"""
+    if old_order_data is not None:
+        apply_order(conn, old_order_data, -1)
+    apply_order(conn, new_order_data, 1)
+
+
+def rebuild(conn, decode_order, batch_size=500):
+    """清空并根据 orders 表重建汇总表（首次升级时使用）。"""
+    conn.execute("DELETE FROM sales_hourly")
+    conn.execute("DELETE FROM item_hourly")
+    last_id = 0
+    total = 0
+    while True:
+        rows = conn.execute("SELECT id, order_json FROM orders WHERE id > ? ORDER BY id LIMIT ?",
+                            (last_id, batch_size)).fetchall()
+        if not rows:
+            break
+        for row in rows:
+            try:
+                apply_order(conn, decode_order(row[1]))
+            except ValueError:
+                logger.error(f"解析订单 JSON 失败，统计时跳过数据库 ID {row[0]}")
+        total += len(rows)
+        last_id = rows[-1][0]
+    logger.info(f"已根据 {total} 个订单重建销售统计。")
+
+
+def _bucket_range(start_date, end_date):
+    return f"{start_date} 00", f"{end_date} 23"
+
+
+def _period_keys(np, buckets, period):
+    """将小时桶字符串转换为周期起点字符串，使用 NumPy 向量化计算。"""
+    hours = np.array([b.replace(" ", "T") for b in buckets], dtype="datetime64[h]")
+    if period == "hour":
+        return np.datetime_as_string(hours, unit="h")
+    days = hours.astype("datetime64[D]")
+    if period == "day":
+        return np.datetime_as_string(days, unit="D")
+    if period == "week":
+        # 1970-01-01 是星期四，偏移 3 天后按 7 取整得到周一
+        weekday = (days.astype("int64") + 3) % 7
+        return np.datetime_as_string(days - weekday.astype("timedelta64[D]"), unit="D")
+    return np.datetime_as_string(days.astype("datetime64[M]"), unit="M")
+
+
+def _period_key_py(bucket, period):
+    if period == "hour":
+        return bucket.replace(" ", "T")
+    day = datetime.date.fromisoformat(bucket[:10])
+    if period == "day":
+        return day.isoformat()
+    if period == "week":
+        return (day - datetime.timedelta(days=day.weekday())).isoformat()
+    return day.isoformat()[:7]
+
+
+def _group_sum(np, keys, values_list):
+    """按 keys 分组求和，返回 (有序的唯一键, [每列的分组和])。np 为 None 时使用纯 Python 实现。"""
+    if np is not None:
+        unique, inverse = np.unique(keys, return_inverse=True)
+        sums = [np.bincount(inverse, weights=np.asarray(values, dtype="float64"), minlength=len(unique))
+                for values in values_list]
+        return unique.tolist(), [s.astype("int64").tolist() for s in sums]
+    groups = {}
+    for i, key in enumerate(keys):
+        acc = groups.setdefault(key, [0] * len(values_list))
+        for j, values in enumerate(values_list):
+            acc[j] += values[i]
+    unique = sorted(groups)
+    return unique, [[groups[k][j] for k in unique] for j in range(len(values_list))]
+
+
+def sales_report(conn, period, start_date, end_date, top_items=TOP_ITEMS):
+    """
+    生成 [start_date, end_date]（本地日期，包含）内按 period 分组的销售报表。
+    返回 {"periods": [{period, currency, orders, revenue}], "items": [{name, quantity}]}。
+    """
+    if period not in PERIODS:
+        raise ValueError(f"period 必须是 {', '.join(PERIODS)} 之一")
+    low, high = _bucket_range(start_date, end_date)
+    np = _load_numpy()
+
+    rows = conn.execute("SELECT bucket, currency, order_count, revenue_cents FROM sales_hourly "
+                        "WHERE bucket BETWEEN ? AND ?", (low, high)).fetchall()
+    periods = []
+    if rows:
+        buckets, currencies, counts, cents = (list(column) for column in zip(*rows))
+        if np is not None:
+            period_keys = _period_keys(np, buckets, period).tolist()
+        else:
+            period_keys = [_period_key_py(b, period) for b in buckets]
+        keys = [f"{key}|{currency}" for key, currency in zip(period_keys, currencies)]
+        unique, (order_sums, cent_sums) = _group_sum(np, keys, [counts, cents])
+        for key, order_count, revenue_cents in zip(unique, order_sums, cent_sums):
+            period_key, currency = key.split("|", 1)
+            if order_count == 0 and revenue_cents == 0:
+                continue
+            periods.append({
+                "period": period_key,
+                "currency": currency,
+                "orders": int(order_count),
+                "revenue": f"{decimal.Decimal(int(revenue_cents)) / 100:.2f}",
+            })
+
+    item_rows = conn.execute("SELECT item_name, quantity FROM item_hourly WHERE bucket BETWEEN ? AND ?",
+                             (low, high)).fetchall()
+    items = []
+    if item_rows:
+        names, quantities = (list(column) for column in zip(*item_rows))
+        unique, (sums,) = _group_sum(np, names, [quantities])
+        items = sorted(({"name": n, "quantity": int(q)} for n, q in zip(unique, sums) if q),
+                       key=lambda item: item["quantity"], reverse=True)[:top_items]
+
+    return {"period": period, "start": start_date, "end": end_date, "periods": periods, "items": items}
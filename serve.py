@@ -0,0 +1,126 @@
+# serve.py
+"""
+生产环境启动入口：使用 Waitress 多线程 WSGI 服务器运行应用，并在退出时优雅排空。
+
+用法:
+    python serve.py [--host 0.0.0.0] [--port 5000] [--threads 8] [--request-timeout 60] [--drain-timeout 30]
+    python serve.py --startup-report      # 输出各模块导入耗时后退出
+
+各参数也可以通过环境变量 SERVE_HOST / SERVE_PORT / SERVE_THREADS /
+SERVE_REQUEST_TIMEOUT / SERVE_DRAIN_TIMEOUT 设置。
+
+退出流程 (Ctrl+C、关闭窗口或 SIGTERM)：
+    1. 停止接受新连接，等待正在处理的请求结束；
+    2. 停止轮询任务，等待进行中的订单处理和打印任务完成；
+    3. 在共享数据库中写入同步水位和心跳，然后退出。
+"""
+
+import argparse
+import logging
+import os
+import signal
+import subprocess
+import sys
+
+logger = logging.getLogger(__name__)
+
+# 启动报告中单独统计的模块：应用本身以及各打印后端
+REPORT_MODULES = ["app", "print_helper", "print_helper_pdf", "print_helper_old"]
+
+
+def measure_import_times(module_name):
+    """在独立进程中以 -X importtime 导入模块，返回 (总耗时毫秒, [(模块, 累计毫秒)]，失败时为 None)。"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module_name}"],
+        capture_output=True, text=True, encoding="utf-8", errors="replace",
+    )
+    if proc.returncode != 0:
+        return None
+
+    top_level = []
+    for line in proc.stderr.splitlines():
+        # 格式: "import time:   self [us] |  cumulative | imported package"
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, package = line[len("import time:"):].split("|", 2)
+        if package.startswith(" ") and not package.startswith("  "):  # 只保留顶层导入
+            top_level.append((package.strip(), int(cumulative) / 1000))
+    total = sum(ms for _, ms in top_level)
+    return total, top_level
+
+
+def print_startup_report(top=10):
+    """打印应用及各打印后端的冷启动导入耗时。"""
+    for module_name in REPORT_MODULES:
+        result = measure_import_times(module_name)
+        if result is None:
+            print(f"{module_name:<20} 导入失败")
+            continue
+        total, top_level = result
+        print(f"{module_name:<20} {total:10.1f} ms")
+        for package, ms in sorted(top_level, key=lambda item: item[1], reverse=True)[:top]:
+            print(f"    {package:<36} {ms:10.1f} ms")
+
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="AllValue 订单自动打印服务")
+    parser.add_argument("--host", default=os.environ.get("SERVE_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("SERVE_PORT", 5000)))
+    parser.add_argument("--threads", type=int, default=int(os.environ.get("SERVE_THREADS", 8)),
+                        help="处理请求的工作线程数")
+    parser.add_argument("--request-timeout", type=int, default=int(os.environ.get("SERVE_REQUEST_TIMEOUT", 60)),
+                        help="连接无活动超过该秒数即关闭")
+    parser.add_argument("--drain-timeout", type=int, default=int(os.environ.get("SERVE_DRAIN_TIMEOUT", 30)),
+                        help="退出时等待进行中任务完成的最长秒数")
+    parser.add_argument("--startup-report", action="store_true", help="输出各模块导入耗时后退出")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.startup_report:
+        print_startup_report()
+        return 0
+
+    # Webhook 的全局准入名额按线程数计算（见 admission.webhook_budget），需在导入 app 之前设置
+    os.environ["SERVE_THREADS"] = str(args.threads)
+    from waitress import create_server
+    from app import app, bootstrap_app, shutdown_app
+
+    server = create_server(
+        app,
+        host=args.host,
+        port=args.port,
+        threads=args.threads,
+        channel_timeout=args.request_timeout,
+        ident="allvalue-autoprint",
+    )
+
+    # Windows 上关闭控制台窗口或 Ctrl+Break 会发送 SIGBREAK
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    if hasattr(signal, "SIGBREAK"):
+        signal.signal(signal.SIGBREAK, _raise_keyboard_interrupt)
+
+    # 建表、启动轮询并在后台补单；补单进度可通过 /healthz 查看
+    bootstrap_app()
+
+    logger.info(f"服务已启动: http://{args.host}:{args.port} (线程数 {args.threads})")
+    try:
+        # Waitress 捕获 KeyboardInterrupt 后会停止接收并等待工作线程结束
+        server.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        logger.info("服务器已停止接受新请求，开始排空进行中的任务...")
+        drained = shutdown_app(drain_timeout=args.drain_timeout)
+
+    return 0 if drained else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,174 @@
+# shops.py
+"""
+多店铺配置。
+
+一个进程可以同时服务多个 AllValue 店铺，店铺列表保存在 SHOPS_CONFIG 指向的 JSON 文件（默认 shops.json）中:
+    [
+        {"key": "yipin", "name": "一品滋味", "domain": "一品滋味.myallvalue.com",
+         "webhook_secret_env": "YIPIN_WEBHOOK_SECRET", "token_env": "YIPIN_TOKEN", "token_file": "tokens/yipin.json"},
+        {"key": "noodle", "name": "面馆", "domain": "noodle.myallvalue.com",
+         "webhook_secret_env": "NOODLE_WEBHOOK_SECRET", "token_env": "NOODLE_TOKEN",
+         "settings": {"auto_print_enabled": true, "business_hours": "11:00-21:00"}}
+    ]
+每个店铺有独立的 Webhook 密钥、访问令牌、API 限流器、同步水位（保存在共享数据库中，键为店铺 key；
+旧版本的 uptime_file，默认 uptime-<key>.json，首次启动时导入）、Webhook 健康状况、Webhook 准入控制和打印线程池，一个店铺积压时不会占满其他店铺的名额；
+各店铺的 Webhook 名额是全局 webhook_admission 的均分，合计占用的服务器线程有上限。
+Webhook 按 X-AllValue-Shop-Domain 路由到对应的店铺。
+
+店铺级设置保存在 settings 表中，键名为 "设置项@店铺 key"（例如 print_routes@noodle），在设置页面中
+选择店铺后编辑；未设置时依次使用配置文件中该店铺的 "settings" 和全局设置项，各店铺可以只覆盖自己的
+打印路由、默认打印机、打印方式、营业时间或自动打印开关。
+
+不同店铺的订单号 (name) 可能重复，入库时加上 order_prefix 前缀：第一个店铺默认不加前缀，
+其余店铺默认为 "<key>:"。
+
+找不到配置文件时为单店铺模式，行为与之前相同：使用 ALLVALUE_WEBHOOK_SECRET、全局的令牌、
+限流器，水位沿用 "default" 记录（由 uptime.json 导入）。
+"""
+
+import concurrent.futures
+import functools
+import json
+import logging
+import os
+
+from admission import AdmissionController, fair_share, webhook_budget
+from database import get_setting
+from lifecycle import inflight
+from polling import WebhookHealth
+from print_routing import MAX_PARALLEL_TARGETS
+from rate_limiter import ApiLimiter, api_limiter
+from token_manager import TOKEN_ENV, TOKEN_FILE, TokenProvider, load_token_from_config, token_provider
+from uptime_store import UptimeStore, uptime_store
+
+logger = logging.getLogger(__name__)
+
+SHOPS_CONFIG = os.environ.get("SHOPS_CONFIG", "shops.json")
+DEFAULT_SHOP_NAME = "一品滋味"
+API_VERSION = "v202108"
+
+# 所有店铺共用的 Webhook 名额，按 Waitress 线程数计算，给管理页面留出线程
+webhook_admission = AdmissionController(*webhook_budget(), is_draining=lambda: inflight.draining)
+
+
+class Shop:
+    def __init__(self, key, name, domain=None, webhook_secret=None, order_prefix="",
+                 tokens=None, limiter=None, uptime=None, settings=None):
+        self.key = key
+        self.name = name
+        self.domain = domain or f"{name}.myallvalue.com"
+        self.endpoint = f"https://{self.domain}/admin/api/open/graphql/{API_VERSION}"
+        self.webhook_secret = webhook_secret
+        self.order_prefix = order_prefix
+        self.settings = settings or {}  # 配置文件中的店铺设置
+        self.token_provider = tokens or TokenProvider()
+        self.api_limiter = limiter or ApiLimiter()
+        self.uptime_store = uptime or UptimeStore(key, legacy_path=f"uptime-{key}.json")
+        self.webhook_health = WebhookHealth()
+        self.set_admission_share(1)
+        self.print_executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_PARALLEL_TARGETS,
+                                                                    thread_name_prefix=f"print-{key}")
+
+    def set_admission_share(self, shops):
+        """按店铺总数分配该店铺的 Webhook 名额，一个店铺的突发流量不会占满全局名额。"""
+        self.webhook_admission = AdmissionController(*fair_share(webhook_admission, shops),
+                                                     is_draining=lambda: inflight.draining, parent=webhook_admission)
+
+    def get_setting(self, key):
+        """店铺级设置：设置页面保存的值优先，其次是配置文件中的店铺设置，都未设置时使用全局设置。"""
+        value = get_setting(f"{key}@{self.key}") or self.settings.get(key)
+        return value if value else get_setting(key)
+
+    def order_id(self, name):
+        """AllValue 订单号 (name) 对应的本地 order_id。"""
+        return f"{self.order_prefix}{name}" if name else name
+
+    def __repr__(self):
+        return f"Shop({self.key!r}, {self.domain!r})"
+
+
+def shop_from_config(raw, index):
+    """根据配置文件中的一项创建店铺，格式错误时抛出 ValueError。"""
+    if not isinstance(raw, dict) or not raw.get("key"):
+        raise ValueError(f"第 {index + 1} 个店铺必须是包含 key 的对象")
+    key = str(raw["key"])
+    name = raw.get("name") or key
+    secret_env = raw.get("webhook_secret_env")
+    webhook_secret = os.environ.get(secret_env) if secret_env else raw.get("webhook_secret")
+    if not webhook_secret:
+        logger.warning(f"店铺 {key} 未配置 Webhook 密钥，该店铺的 Webhook 将无法通过签名验证。")
+    loader = functools.partial(load_token_from_config, token_env=raw.get("token_env") or TOKEN_ENV,
+                               token_file=raw.get("token_file") or TOKEN_FILE)
+    settings = raw.get("settings") or {}
+    if not isinstance(settings, dict):
+        raise ValueError(f"店铺 {key} 的 settings 必须是对象")
+    # 与 settings 表中的值保持相同的文本格式
+    settings = {name: (str(value).lower() if isinstance(value, bool)
+                       else json.dumps(value, ensure_ascii=False) if isinstance(value, (list, dict)) else str(value))
+                for name, value in settings.items() if value is not None}
+    order_prefix = raw.get("order_prefix")
+    if order_prefix is None:
+        order_prefix = "" if index == 0 else f"{key}:"
+    return Shop(key, name, domain=raw.get("domain"), webhook_secret=webhook_secret, order_prefix=order_prefix,
+                tokens=TokenProvider(loader), uptime=UptimeStore(key, legacy_path=raw.get("uptime_file") or f"uptime-{key}.json"),
+                settings=settings)
+
+
+def legacy_shop():
+    """单店铺模式：沿用全局的令牌、限流器，水位沿用 "default" 记录（由 uptime.json 导入）。"""
+    return Shop("default", DEFAULT_SHOP_NAME, webhook_secret=os.environ.get("ALLVALUE_WEBHOOK_SECRET"),
+                tokens=token_provider, limiter=api_limiter, uptime=uptime_store)
+
+
+class ShopRegistry:
+    def __init__(self, shops):
+        if not shops:
+            raise ValueError("至少需要配置一个店铺")
+        self.shops = list(shops)
+        self._by_key = {}
+        self._by_domain = {}
+        for shop in self.shops:
+            if shop.key in self._by_key or shop.domain.lower() in self._by_domain:
+                raise ValueError(f"店铺 key 或域名重复: {shop.key} / {shop.domain}")
+            self._by_key[shop.key] = shop
+            self._by_domain[shop.domain.lower()] = shop
+            shop.set_admission_share(len(self.shops))
+
+    @property
+    def default(self):
+        return self.shops[0]
+
+    def __iter__(self):
+        return iter(self.shops)
+
+    def __len__(self):
+        return len(self.shops)
+
+    def by_domain(self, domain):
+        return self._by_domain.get((domain or "").lower())
+
+    def by_key(self, key):
+        return self._by_key.get(key)
+
+    def for_order(self, order_data):
+        """订单所属的店铺；旧订单没有 shop_key 时属于第一个店铺。"""
+        return self.by_key((order_data or {}).get("shop_key")) or self.default
+
+
+def load_shops(path=SHOPS_CONFIG):
+    """读取店铺配置；文件不存在时返回单店铺模式的注册表。配置无效时抛出 ValueError。"""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            raw_shops = json.load(f)
+    except FileNotFoundError:
+        return ShopRegistry([legacy_shop()])
+    except json.JSONDecodeError as e:
+        raise ValueError(f"店铺配置 {path} 不是有效的 JSON: {e}")
+    if not isinstance(raw_shops, list):
+        raise ValueError(f"店铺配置 {path} 必须是 JSON 数组")
+    registry = ShopRegistry([shop_from_config(raw, i) for i, raw in enumerate(raw_shops)])
+    logger.info(f"已从 {path} 载入 {len(registry)} 个店铺: {', '.join(shop.key for shop in registry)}")
+    return registry
+
+
+shop_registry = load_shops()
@@ -30,9 +30,9 @@ echo 环境激活成功！
 
 rem --- 启动 Flask 应用服务器 ---
 echo.
-echo [步骤 2/3] 正在后台启动 Flask 服务器...
+echo [步骤 2/3] 正在后台启动服务器 (Waitress)...
 rem 使用 'start' 命令在一个新的窗口中运行服务器，这样此脚本可以继续执行
-start "Flask Server" cmd /k "python app.py"
+start "Flask Server" cmd /k "python serve.py"
 
 rem --- 等待服务器启动 ---
 echo.
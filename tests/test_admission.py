@@ -0,0 +1,62 @@
+import threading
+import time
+
+import pytest
+
+from admission import AdmissionController, Overloaded, fair_share
+
+
+def _hold(controller, started, release, outcomes):
+    """在一个线程中占住 controller 的名额，直到 release 被设置。"""
+    def run():
+        try:
+            with controller.admit():
+                started.release()
+                release.wait(5)
+            outcomes.append("ok")
+        except Overloaded as e:
+            started.release()
+            outcomes.append(e.reason)
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def test_fair_share_splits_global_budget():
+    parent = AdmissionController(max_inflight=4, max_queue=2)
+    assert fair_share(parent, 1) == (4, 2)
+    assert fair_share(parent, 2) == (2, 1)
+    assert fair_share(parent, 8) == (1, 0)
+
+
+def test_other_shop_admitted_during_burst():
+    parent = AdmissionController(max_inflight=4, max_queue=2, queue_timeout=5)
+    shop_a = AdmissionController(*fair_share(parent, 2), queue_timeout=5, parent=parent)
+    shop_b = AdmissionController(*fair_share(parent, 2), queue_timeout=5, parent=parent)
+
+    release = threading.Event()
+    started = threading.Semaphore(0)
+    outcomes = []
+    threads = [_hold(shop_a, started, release, outcomes) for _ in range(shop_a.max_inflight)]
+    for _ in threads:
+        assert started.acquire(timeout=5)
+
+    # 店铺 A 的处理名额已满，再来的请求排队直到 A 的队列也满
+    threads += [_hold(shop_a, started, release, outcomes) for _ in range(shop_a.max_queue)]
+    deadline = time.monotonic() + 5
+    while shop_a.stats()["queued"] < shop_a.max_queue and time.monotonic() < deadline:
+        time.sleep(0.01)
+    with pytest.raises(Overloaded) as excinfo:
+        with shop_a.admit():
+            pass
+    assert excinfo.value.reason == "queue_full"
+
+    # A 的突发流量没有占满全局名额，店铺 B 仍被接受
+    with shop_b.admit():
+        assert shop_b.stats()["inflight"] == 1
+
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert outcomes.count("ok") == len(threads)
+    assert parent.stats()["inflight"] == 0
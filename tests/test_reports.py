@@ -0,0 +1,31 @@
+import datetime
+
+import pytest
+
+pytest.importorskip("flask")
+
+import database  # noqa: E402
+from app import app  # noqa: E402
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # orders.db 是相对路径，每个测试使用独立的数据库
+    database.init_db()
+    return app.test_client()
+
+
+def test_reports_page_lists_items(client):
+    database.insert_or_update_order({
+        "order_id": "#1001",
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "total_price": {"amount": "36.00", "currency_code": "CNY"},
+        "line_items": [{"name": "牛肉面", "quantity": 2}],
+    })
+
+    response = client.get("/reports?period=day")
+
+    assert response.status_code == 200
+    body = response.get_data(as_text=True)
+    assert "牛肉面" in body
+    assert "36.00" in body
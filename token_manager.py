@@ -1,7 +1,111 @@
+import datetime
+import json
+import logging
 import os
+import threading
 
-def get_allvalue_access_token():
-    token = ""
+logger = logging.getLogger(__name__)
+
+TOKEN_ENV = "ALLVALUE_PERMANENT_TOKEN"
+TOKEN_FILE = os.environ.get("ALLVALUE_TOKEN_FILE", "allvalue_token.json")
+REFRESH_MARGIN_SECONDS = 300  # 令牌过期前提前刷新的时间
+
+
+class TokenUnavailableError(ValueError):
+    """无法获取 AllValue 访问令牌。"""
+    pass
+
+
+def load_token_from_config(token_env=TOKEN_ENV, token_file=TOKEN_FILE):
+    """
+    默认的令牌加载器，返回 (令牌, 过期时间或 None)。
+
+    优先读取环境变量 token_env（默认 ALLVALUE_PERMANENT_TOKEN，永久令牌，不过期）；
+    否则读取 token_file（默认 ALLVALUE_TOKEN_FILE）指向的 JSON 文件:
+    {"access_token": "...", "expires_at": "ISO 时间"}，由外部程序负责续期，过期后重新读取即可得到新令牌。
+    多店铺时每个店铺用 functools.partial 绑定自己的环境变量和令牌文件。
+    """
+    token = os.environ.get(token_env)
+    if token:
+        return token, None
+
+    try:
+        with open(token_file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        raise TokenUnavailableError(f"Missing permanent token! Please set {token_env}.")
+    except (json.JSONDecodeError, IOError) as e:
+        raise TokenUnavailableError(f"读取令牌文件 {token_file} 失败: {e}")
+
+    token = data.get("access_token")
     if not token:
-        raise ValueError("Missing permanent token! Please set ALLVALUE_PERMANENT_TOKEN.")
-    return token
\ No newline at end of file
+        raise TokenUnavailableError(f"令牌文件 {token_file} 中缺少 access_token")
+    expires_at = data.get("expires_at")
+    if expires_at:
+        expires_at = datetime.datetime.fromisoformat(expires_at)
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=datetime.timezone.utc)
+    return token, expires_at
+
+
+class TokenProvider:
+    """
+    缓存访问令牌，在过期前主动刷新。
+
+    读取缓存不加锁；需要刷新时只有一个线程调用加载器，其他线程等待同一把锁后
+    直接使用新令牌，不会同时向加载器发起请求。
+    """
+
+    def __init__(self, loader=load_token_from_config, refresh_margin=REFRESH_MARGIN_SECONDS):
+        self._loader = loader
+        self._refresh_margin = datetime.timedelta(seconds=refresh_margin)
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = None
+
+    def _is_fresh(self, token, expires_at):
+        if not token:
+            return False
+        if expires_at is None:
+            return True
+        return datetime.datetime.now(datetime.timezone.utc) < expires_at - self._refresh_margin
+
+    def get_token(self):
+        token, expires_at = self._token, self._expires_at
+        if self._is_fresh(token, expires_at):
+            return token
+        with self._lock:
+            if self._is_fresh(self._token, self._expires_at):  # 其他线程已刷新
+                return self._token
+            return self._refresh_locked()
+
+    def _refresh_locked(self):
+        token, expires_at = self._loader()
+        if not token:
+            raise TokenUnavailableError("令牌加载器未返回令牌")
+        self._token, self._expires_at = token, expires_at
+        logger.info(f"已加载 AllValue 访问令牌{'，过期时间 ' + expires_at.isoformat() if expires_at else ''}。")
+        return token
+
+    def invalidate(self, rejected_token):
+        """服务端拒绝了 rejected_token。若缓存仍是该令牌则立即刷新并返回新令牌。"""
+        with self._lock:
+            if self._token != rejected_token and self._is_fresh(self._token, self._expires_at):
+                return self._token  # 其他线程已经刷新过
+            logger.warning("AllValue 访问令牌被拒绝，重新加载。")
+            self._token = None
+            return self._refresh_locked()
+
+    def set_loader(self, loader):
+        """替换令牌加载器（例如接入 OAuth 刷新流程），并清除缓存。"""
+        with self._lock:
+            self._loader = loader
+            self._token = None
+            self._expires_at = None
+
+
+token_provider = TokenProvider()
+
+
+def get_allvalue_access_token():
+    return token_provider.get_token()
@@ -0,0 +1,160 @@
+# uptime_store.py
+"""
+运行时间记录：各店铺的同步水位和存活心跳，保存在共享数据库的 sync_state 表中。
+
+- end_time（水位）：此时间之前创建的订单都已经拉取过，由轮询和启动补单推进；
+- heartbeat（心跳）：最后一次确认订单都已处理的时间，持有店铺 ingest 租约的实例每 HEARTBEAT_INTERVAL 秒写入一次。
+
+多个实例共用数据库时，接管店铺的实例从同一份水位和心跳继续，不会因为各自机器上的文件不同而漏单或重复补单。
+进程存活期间 Webhook 会实时处理订单，所以启动补单只需要从 max(水位, 心跳 - HEARTBEAT_GRACE) 开始，
+即真正的停机时间段；HEARTBEAT_GRACE 覆盖停机前已创建但 Webhook 尚未送达的订单。
+
+心跳只能表示"此前的订单都已处理"：启动补单尚未完成、或有 Webhook 处理失败时，调用 hold(时间)，
+该时间同样记录在数据库中（hold_since），之后写入的心跳和退出时间都不会超过它，直到水位推进到它之后。
+这样即使没有启用轮询、或处理失败的是另一个实例，下次补单也会覆盖这些时间段。
+
+每次更新都是一条 SQL 语句，多个实例和线程并发写入时不会互相覆盖。旧版本的 uptime.json / uptime-<店铺>.json
+在首次启动时导入（import_legacy_file）。
+"""
+
+import datetime
+import json
+import logging
+
+from database import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+TIME_FILE = "uptime.json"  # 旧版本的水位文件，只用于导入
+HEARTBEAT_INTERVAL = 5  # 秒
+HEARTBEAT_GRACE = datetime.timedelta(minutes=5)
+
+
+def init_uptime_tables():
+    with get_db_connection() as conn:
+        if conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    name TEXT PRIMARY KEY,
+                    end_time TEXT,
+                    heartbeat TEXT,
+                    hold_since TEXT
+                )
+            ''')
+            conn.commit()
+
+
+def _text(dt):
+    """固定精度的 ISO 格式（UTC），使 SQL 中的 min() 和比较按时间先后进行。"""
+    return dt.isoformat(sep="T", timespec="microseconds")
+
+
+class UptimeStore:
+    def __init__(self, name="default", legacy_path=None):
+        self.name = name
+        self.legacy_path = legacy_path
+
+    def _execute(self, sql, *params):
+        with get_db_connection() as conn:
+            if conn:
+                conn.execute("INSERT INTO sync_state (name) VALUES (?) ON CONFLICT(name) DO NOTHING", (self.name,))
+                conn.execute(sql, params + (self.name,))
+                conn.commit()
+
+    def _get(self, column):
+        with get_db_connection() as conn:
+            if not conn:
+                return None
+            row = conn.execute(f"SELECT {column} FROM sync_state WHERE name = ?", (self.name,)).fetchone()
+        value = row[column] if row else None
+        if not value:
+            return None
+        try:
+            return datetime.datetime.fromisoformat(value)
+        except ValueError:
+            logger.error(f"店铺 {self.name} 的 {column} 格式无效: {value}")
+            return None
+
+    def import_legacy_file(self):
+        """数据库中还没有记录时，导入旧版本写在本机文件中的水位和心跳。"""
+        if not self.legacy_path:
+            return
+        try:
+            with open(self.legacy_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (json.JSONDecodeError, IOError) as e:
+            logger.warning(f"读取旧的水位文件 {self.legacy_path} 失败，忽略: {e}")
+            return
+        values = {}
+        for key in ("end_time", "heartbeat"):
+            try:
+                values[key] = _text(datetime.datetime.fromisoformat(data[key])) if data.get(key) else None
+            except (TypeError, ValueError):
+                values[key] = None
+        with get_db_connection() as conn:
+            if conn:
+                cursor = conn.execute('''
+                    INSERT INTO sync_state (name, end_time, heartbeat) VALUES (?, ?, ?)
+                    ON CONFLICT(name) DO NOTHING
+                ''', (self.name, values["end_time"], values["heartbeat"]))
+                conn.commit()
+                if cursor.rowcount > 0:
+                    logger.info(f"已将 {self.legacy_path} 中的水位和心跳导入共享数据库（店铺 {self.name}）。")
+
+    def record_watermark(self, end_time):
+        """推进水位；水位越过 hold 的时间后解除 hold。"""
+        self._execute('''
+            UPDATE sync_state SET end_time = ?,
+                hold_since = CASE WHEN hold_since < ? THEN NULL ELSE hold_since END
+            WHERE name = ?
+        ''', _text(end_time), _text(end_time))
+
+    def get_watermark(self):
+        return self._get("end_time")
+
+    def hold(self, since):
+        """since 之后的订单可能未处理：在水位推进到 since 之后之前，心跳和退出时间都不超过它。"""
+        self._execute('''
+            UPDATE sync_state SET hold_since = COALESCE(min(hold_since, ?), ?),
+                heartbeat = min(heartbeat, ?)
+            WHERE name = ?
+        ''', _text(since), _text(since), _text(since))
+
+    def held_since(self):
+        return self._get("hold_since")
+
+    def beat(self, now=None):
+        now = _text(now or datetime.datetime.utcnow())
+        self._execute("UPDATE sync_state SET heartbeat = COALESCE(min(hold_since, ?), ?) WHERE name = ?",
+                      now, now)
+
+    def get_heartbeat(self):
+        return self._get("heartbeat")
+
+    def mark_stopped(self, now=None):
+        """
+        正常退出且所有任务已完成：水位和心跳同时推进到退出时间。
+        有 hold 时水位不变，心跳停在 hold 的时间，下次启动从那里补单。
+        """
+        now = _text(now or datetime.datetime.utcnow())
+        self._execute('''
+            UPDATE sync_state SET end_time = CASE WHEN hold_since IS NULL THEN ? ELSE end_time END,
+                heartbeat = COALESCE(min(hold_since, ?), ?)
+            WHERE name = ?
+        ''', now, now, now)
+
+    def recovery_start(self):
+        """启动补单的起点（UTC）。没有任何记录时返回 None。"""
+        watermark = self.get_watermark()
+        heartbeat = self.get_heartbeat()
+        if heartbeat is None:
+            return watermark
+        gap_start = heartbeat - HEARTBEAT_GRACE
+        if watermark is None:
+            return gap_start
+        return max(watermark, gap_start)
+
+
+uptime_store = UptimeStore("default", legacy_path=TIME_FILE)